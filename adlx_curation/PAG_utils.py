@@ -1,29 +1,50 @@
 import numpy as np
 import cv2
+import warnings
 
 from einops import rearrange
 
-def npy_to_keypoints(pose_path, frame_w, frame_h, clamp=False):
-  np_skeleton = np.load(pose_path, allow_pickle=True).item()
-  
-  num_bodys = np.array(np_skeleton['nbodys']).max()
-  keypoints_all = np.array([np_skeleton[f'rgb_body{i}'] for i in range(num_bodys)])
-  njts = np_skeleton['njoints']
+def load_skeleton(pose_path, np_skeleton=None):
+  '''
+  Loads the rgb keypoints of all bodies of an NTU skeleton.
+  ** Arguments **
+  pose_path : str
+    Path to the pickled '{video}.skeleton.npy' dict
+  np_skeleton : dict
+    Already loaded skeleton dict, skips reading pose_path
+  ** Returns **
+  rgb_bodies : np.ndarray
+    Keypoints of shape (bodies, n_frame, njts, 2), in the dtype of the skeleton file
+  nbodys : np.ndarray
+    Number of bodies in each frame
+  '''
+  if np_skeleton is None:
+    np_skeleton = np.load(pose_path, allow_pickle=True).item()
+
+  nbodys = np.asarray(np_skeleton['nbodys'], dtype=np.int64)
+  num_bodys = nbodys.max()
+  rgb_bodies = np.stack([np.asarray(np_skeleton[f'rgb_body{i}']) for i in range(num_bodys)])
+
+  return rgb_bodies, nbodys
+
+def npy_to_keypoints(pose_path, frame_w, frame_h, clamp=False, np_skeleton=None):
+  keypoints_all, nbodys = load_skeleton(pose_path, np_skeleton=np_skeleton)
 
   B = keypoints_all.shape[0]
   T = keypoints_all.shape[1]
   J = keypoints_all.shape[2]
 
-  keypoints_all = rearrange(keypoints_all, 'b f n c -> f (b n) c', b=B, f=T, n=J, c=2)
+  if B > 1:
+    # Keypoint matrix contains all bodies in the video. Some bodies
+    # are not contained in every frame and those bodies keypoints are
+    # set to 0's. Here we set that bodies keypoints to the 1st bodies keypoints.
+    # Frames without a body count are left as they are
+    frame_body_count = np.full(T, B)
+    frame_body_count[:min(T, len(nbodys))] = nbodys[:T]
+    missing = np.arange(B)[:, None] >= frame_body_count[None, :] # (bodies, n_frame)
+    keypoints_all = np.where(missing[:, :, None, None], keypoints_all[:1], keypoints_all)
 
-  if num_bodys > 1:
-    for frm_idx, frm_body_count in enumerate(np_skeleton['nbodys']):
-      # Keypoint matrix contains all bodies in the video. Some bodies
-      # are not contained in every frame and those bodies keypoints are
-      # set to 0's. Here we set that bodies keypoints to the 1st bodies keypoints
-      for body_idx in range(num_bodys-1, frm_body_count-1, -1):
-        # print(f'\tsetting body {body_idx} to 1st body kpts')
-        keypoints_all[frm_idx, body_idx*J:(body_idx+1)*J, :] = keypoints_all[frm_idx, :25, :]
+  keypoints_all = rearrange(keypoints_all, 'b f n c -> f (b n) c', b=B, f=T, n=J, c=2)
 
   # Useful for get_frame function for debugging
   if clamp:
@@ -31,16 +52,51 @@ def npy_to_keypoints(pose_path, frame_w, frame_h, clamp=False):
 
   return keypoints_all
 
+def interpolate_nan_keypoints(keypoints):
+  '''
+  Linearly interpolates nan keypoints over time, separately for every joint and axis.
+  Leading and trailing nans take the closest valid value. A joint axis that is nan in
+  every frame takes the mean of the other joints in that frame (0 if there are none).
+  keypoints is of shape (n_frame, n_kpts, 2)
+  '''
+  kpts = keypoints.copy()
+  nan_columns = np.isnan(kpts).any(axis=0) # (n_kpts, 2), only these joint axes need interpolation
+  if not nan_columns.any():
+    return kpts
+
+  columns = kpts[:, nan_columns] # (n_frame, n_nan_columns)
+  valid = ~np.isnan(columns)
+  T = kpts.shape[0]
+  frame_idx = np.arange(T)[:, None]
+
+  # index of the closest valid frame before / after each frame, per joint and axis
+  prev_idx = np.maximum.accumulate(np.where(valid, frame_idx, -1), axis=0)
+  next_idx = np.minimum.accumulate(np.where(valid, frame_idx, T)[::-1], axis=0)[::-1]
+  has_prev, has_next = prev_idx >= 0, next_idx < T
+  prev_idx = np.where(has_prev, prev_idx, next_idx).clip(0, T - 1)
+  next_idx = np.where(has_next, next_idx, prev_idx).clip(0, T - 1)
+
+  prev_val = np.take_along_axis(columns, prev_idx, axis=0)
+  next_val = np.take_along_axis(columns, next_idx, axis=0)
+  span = next_idx - prev_idx
+  weight = np.divide(frame_idx - prev_idx, span, out=np.zeros(columns.shape), where=span > 0)
+  kpts[:, nan_columns] = np.where(valid, columns, prev_val + weight * (next_val - prev_val))
+
+  if np.isnan(kpts).any():
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore', RuntimeWarning) # mean of empty slice
+      frame_mean = np.nanmean(kpts, axis=1, keepdims=True)
+    kpts = np.where(np.isnan(kpts), np.nan_to_num(frame_mean), kpts)
+
+  return kpts
+
 def clamp_keypoints(keypoints, frame_w, frame_h):
   '''
   In some cases, the keypoints can be nan, or can be outside of the frame.
-  -This function replaces nan keypoints with its closest neighbor
+  -This function replaces nan keypoints by interpolating the same joint over time
   -This function bounds keypoints to the frame boundaries
   '''
-  clipped_kpts = keypoints.copy()
-
-  mask = np.isnan(clipped_kpts)
-  clipped_kpts[mask] = np.interp(np.flatnonzero(mask), np.flatnonzero(~mask), clipped_kpts[~mask])
+  clipped_kpts = interpolate_nan_keypoints(keypoints)
 
   clipped_kpts[:, :, 0] = np.clip(clipped_kpts[:, :, 0], 0, frame_w)
   clipped_kpts[:, :, 1] = np.clip(clipped_kpts[:, :, 1], 0, frame_h)
@@ -131,30 +187,11 @@ def process_frame(frame, keypoints, tlc, brc, new_shape=None):
   new_shape : tuple[int]
     Shape to resize the crop to
   '''
-  frame_w, frame_h = frame.shape[1], frame.shape[0]
-  box_w, box_h = (brc[0] - tlc[0]), (brc[1] - tlc[1])
-
-  bbox_contained_in_frame = True
-  if (tlc[0] < 0) or (tlc[1] < 0) or (brc[0] >= frame_w) or (brc[1] >= frame_h):
-    bbox_contained_in_frame = False
-
-  # pad image if bbox extends past frame boundaries
-  if not bbox_contained_in_frame:
-    bsz = (box_h, box_h, box_w, box_w) # border size (top, bot, left, right). We can always assume top=bot and left=right
-    frame = cv2.copyMakeBorder(frame, *bsz, cv2.BORDER_CONSTANT)
-  else:
-    bsz = (0, 0, 0, 0)
-
-  # adjust top-left-corner and bottom-right-corner to match padded image
-  tlc = tlc[0] + bsz[2], tlc[1] + bsz[0]
-  brc = brc[0] + bsz[2], brc[1] + bsz[0]
-
-  frame = frame[tlc[1] : brc[1], 
-                  tlc[0] : brc[0]]
+  frame = crop_frame(frame, tlc, brc)
 
-  # adjust frame keypoints to match padded image
-  keypoints[:, 0] += bsz[2] - (tlc[0])
-  keypoints[:, 1] += bsz[0] - (brc[1] - box_h)
+  # adjust frame keypoints to match the crop
+  keypoints[:, 0] -= tlc[0]
+  keypoints[:, 1] -= tlc[1]
 
   if new_shape:
     cur_shape = frame.shape
@@ -165,4 +202,51 @@ def process_frame(frame, keypoints, tlc, brc, new_shape=None):
     keypoints[:, 0] *= x_ratio
     keypoints[:, 1] *= y_ratio
 
-  return frame, keypoints
\ No newline at end of file
+  return frame, keypoints
+
+def get_bboxes(keypoints, slack=64):
+  '''
+  Vectorized get_bbox for every frame of a video at once.
+  ** Arguments **
+  keypoints : np.ndarray
+    Clamped keypoints of shape (n_frame, n_kpts, 2)
+  ** Returns **
+  tlc, brc : np.ndarray
+    Top left and bottom right corners of shape (n_frame, 2), the same boxes get_bbox returns frame by frame
+  '''
+  kpts = keypoints.astype(int)
+  mins = kpts.min(axis=1)
+  size = kpts.max(axis=1) - mins + 1 # cv2.boundingRect counts both end pixels
+  center = mins + size // 2
+  half_box = (size + slack) // 2
+
+  return center - half_box, center + half_box
+
+def crop_frame(frame, tlc, brc):
+  '''
+  Crop a frame given a bounding box. Parts of the box outside of the frame are filled with zeros,
+  only the overhang is padded instead of the whole frame.
+  '''
+  frame_h, frame_w = frame.shape[:2]
+  box_w, box_h = (brc[0] - tlc[0]), (brc[1] - tlc[1])
+
+  x0, y0 = max(tlc[0], 0), max(tlc[1], 0)
+  x1, y1 = min(brc[0], frame_w), min(brc[1], frame_h)
+
+  if (x0, y0, x1, y1) == (tlc[0], tlc[1], brc[0], brc[1]):
+    return frame[y0:y1, x0:x1]
+
+  crop = np.zeros((box_h, box_w) + frame.shape[2:], dtype=frame.dtype)
+  if x1 > x0 and y1 > y0:
+    crop[y0 - tlc[1] : y1 - tlc[1], x0 - tlc[0] : x1 - tlc[0]] = frame[y0:y1, x0:x1]
+  return crop
+
+def crop_keypoints(keypoints, tlc, brc, new_shape=None):
+  '''
+  Vectorized keypoint update of process_frame for every frame of a video at once.
+  keypoints is of shape (n_frame, n_kpts, 2), tlc and brc of shape (n_frame, 2).
+  '''
+  keypoints = keypoints - tlc[:, None, :]
+  if new_shape:
+    keypoints = keypoints * (np.asarray(new_shape) / (brc - tlc))[:, None, :]
+  return keypoints
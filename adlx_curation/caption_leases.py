@@ -0,0 +1,240 @@
+"""
+Shared lease table for step3 captioning workers.
+
+Every stitched video is a row. Workers claim a few videos at a time by taking a lease on them,
+store the captions of every finished video in the table and claim more until nothing is left.
+Leases of workers that died run out and their videos are claimed again, so workers can be added,
+stopped and restarted at any time and long videos do not hold up a fixed partition.
+
+The table is a single SQLite file. It uses the rollback journal instead of WAL, so it also works
+for workers on several machines as long as the file is on a shared filesystem with working
+POSIX locks. Writes are one short transaction per claim or finished video.
+
+    python caption_leases.py status --lease_db captions.sqlite
+    python caption_leases.py merge --lease_db captions.sqlite --output cogvlm-captions.json [cogvlm_*.json ...]
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import time
+
+STATUS_PENDING = 'pending'
+STATUS_LEASED = 'leased'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def get_worker_id(device=None):
+    worker_id = f'{socket.gethostname()}:{os.getpid()}'
+    return f'{worker_id}:{device}' if device is not None else worker_id
+
+
+class LeaseTable(object):
+    """
+    Video lease table.
+
+    Parameters:
+    path (str): SQLite file, shared by all workers.
+    lease_seconds (float): A claimed video is handed to another worker if it is not finished
+        (or its lease renewed) within this time.
+    max_attempts (int): A video whose captioning failed this many times is marked as failed.
+    """
+    def __init__(self, path, lease_seconds=3600, max_attempts=3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # connections must not be shared across fork()
+        if self._conn is None or self._pid != os.getpid():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=300, isolation_level=None)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS videos ('
+                'name TEXT PRIMARY KEY, path TEXT NOT NULL, status TEXT NOT NULL, worker TEXT, lease_until REAL, '
+                'attempts INTEGER NOT NULL DEFAULT 0, captions TEXT, error TEXT, updated_at REAL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS videos_status ON videos (status, lease_until)')
+            self._pid = os.getpid()
+        return self._conn
+
+    def _write(self, sql, params=(), many=False):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can not claim the same video
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return cursor
+
+    def add_videos(self, video_paths):
+        """
+        Register videos by path, videos that are already in the table keep their status.
+        """
+        now = time.time()
+        self._write(
+            'INSERT OR IGNORE INTO videos (name, path, status, updated_at) VALUES (?, ?, ?, ?)',
+            [(os.path.basename(path)[:-4], path, STATUS_PENDING, now) for path in video_paths], many=True
+        )
+
+    def claim(self, worker_id, num_videos=1):
+        """
+        Lease up to num_videos pending videos, or videos whose lease ran out.
+
+        Returns:
+        list: (name, path) of the claimed videos, empty when there is nothing left to claim.
+        """
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            rows = conn.execute(
+                'SELECT name, path FROM videos WHERE status = ? OR (status = ? AND lease_until < ?) '
+                'ORDER BY attempts, rowid LIMIT ?',
+                (STATUS_PENDING, STATUS_LEASED, now, num_videos)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE videos SET status = ?, worker = ?, lease_until = ?, updated_at = ? WHERE name = ?',
+                [(STATUS_LEASED, worker_id, now + self.lease_seconds, now, name) for name, _ in rows]
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def renew(self, worker_id):
+        """
+        Extend the leases of all videos held by a worker.
+        """
+        now = time.time()
+        self._write(
+            'UPDATE videos SET lease_until = ? WHERE status = ? AND worker = ?',
+            (now + self.lease_seconds, STATUS_LEASED, worker_id)
+        )
+
+    def complete(self, name, captions, worker_id=None):
+        """
+        Store the captions of a video. A result is kept even if the lease ran out in the meantime.
+        """
+        self._write(
+            'UPDATE videos SET status = ?, captions = ?, worker = ?, lease_until = NULL, error = NULL, updated_at = ? WHERE name = ?',
+            (STATUS_DONE, json.dumps(captions), worker_id, time.time(), name)
+        )
+
+    def fail(self, name, error, worker_id=None):
+        """
+        Give a video back for another attempt, or mark it as failed after max_attempts.
+        """
+        self._write(
+            'UPDATE videos SET attempts = attempts + 1, '
+            'status = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, '
+            'worker = ?, lease_until = NULL, error = ?, updated_at = ? WHERE name = ? AND status != ?',
+            (self.max_attempts, STATUS_FAILED, STATUS_PENDING, worker_id, str(error), time.time(), name, STATUS_DONE)
+        )
+
+    def release(self, worker_id):
+        """
+        Give back all unfinished videos of a worker, e.g. when it is stopped.
+        """
+        self._write(
+            'UPDATE videos SET status = ?, worker = NULL, lease_until = NULL WHERE status = ? AND worker = ?',
+            (STATUS_PENDING, STATUS_LEASED, worker_id)
+        )
+
+    def counts(self):
+        rows = self.conn.execute('SELECT status, COUNT(*) FROM videos GROUP BY status').fetchall()
+        return dict(rows)
+
+    def iter_captions(self, include_failed=False):
+        """
+        Yield (name, captions) of finished videos in the order they were added. Failed videos get the
+        'failed to get caption' message of step3 if include_failed is set.
+        """
+        cursor = self.conn.execute(
+            'SELECT name, status, captions, error FROM videos WHERE status IN (?, ?) ORDER BY rowid', (STATUS_DONE, STATUS_FAILED)
+        )
+        for name, status, captions, error in cursor:
+            if status == STATUS_DONE:
+                yield name, json.loads(captions)
+            elif include_failed:
+                yield name, f'failed to get caption with exception {error}'
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def load_caption_file(path):
+    """
+    Captions of a step3 output file, either a cogvlm_{n}.json dict or a cogvlm_{n}.jsonl written incrementally.
+    """
+    if path.endswith('.jsonl'):
+        captions = {}
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # last line of an interrupted run
+                    continue
+                captions[record['video']] = record['captions']
+        return captions
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def merge_captions(output_path, lease_db=None, caption_files=(), include_failed=False):
+    """
+    Combine the captions of the lease table and of step3 output files into the single caption JSON
+    read by step4 and step5. Captions of the lease table take precedence.
+    """
+    merged = {}
+    for path in caption_files:
+        merged.update(load_caption_file(path))
+
+    if lease_db is not None:
+        table = LeaseTable(lease_db)
+        merged.update(table.iter_captions(include_failed=include_failed))
+        table.close()
+
+    if not include_failed:
+        merged = {name: captions for name, captions in merged.items() if not isinstance(captions, str)}
+
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(merged, f, indent=4)
+    os.replace(tmp_path, output_path)
+    return merged
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Status and merge of the step3 caption lease table')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    status_parser = subparsers.add_parser('status', help='Number of videos per status')
+    status_parser.add_argument('--lease_db', type=str, required=True)
+
+    merge_parser = subparsers.add_parser('merge', help='Write the caption JSON read by step4 and step5')
+    merge_parser.add_argument('--lease_db', type=str, default=None)
+    merge_parser.add_argument('--output', type=str, required=True)
+    merge_parser.add_argument('--include_failed', action='store_true', help='Keep the failure message of videos that could not be captioned')
+    merge_parser.add_argument('caption_files', nargs='*', help='Additional cogvlm_{n}.json / .jsonl files of partitioned runs')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        table = LeaseTable(args.lease_db)
+        print(table.counts())
+        table.close()
+    else:
+        merged = merge_captions(args.output, args.lease_db, args.caption_files, args.include_failed)
+        print(f'Wrote captions of {len(merged)} videos to {args.output}')
@@ -9,9 +9,17 @@ python step2_temporal_stitching.py --cropped_ntu_dir /path/to/NTU-PAG_224x224 --
 # Step 3: Generate frame level captions from stitched videos. Will generate "./cogvlm_{args.proc_num}.json" in the current directory. You need to combine these jsons into a single one.
 ## This script can be run in parallel to speed up the process. We use 8 GPUs and run the following command.
 seq 1 7 | parallel --tag "python step3_image_frame_captions.py --num_procs 1 --stitched_vid_path /path/to/stitched/videos/ --num_procs 8 --proc_num {}"
+## Alternatively, workers claim videos from a shared lease table. Workers can be added or restarted at any time, also on other machines
+## if the lease table is on a shared filesystem. The captions are then merged into the single JSON used by step4 and step5.
+# seq 0 7 | parallel --tag "python step3_image_frame_captions.py --stitched_vid_path /path/to/stitched/videos/ --lease_db /shared/path/captions.sqlite --proc_num {}"
+# python caption_leases.py merge --lease_db /shared/path/captions.sqlite --output cogvlm-captions_FromSTEP3.json
 
 # Step 4: Generate weakly supervised video descriptions from the action labels and the frame level captions. The output will be saved to "./dense_descriptions.json"
 python step4_WS_video_desc.py --step3_description_json cogvlm-captions_FromSTEP3.json --openai_api_key openai_api_key
 
 # Step 5: Generate the QA pairs that are used to train the model
-python step5_generate_QA_pairs.py --step3_image_captions_path cogvlm-captions_FromSTEP3.json --step4_video_descriptions_path dense_descriptions.json --save_dir /directory/to/save/QA_pairs/ --openai_api_key openai_api_key
\ No newline at end of file
+python step5_generate_QA_pairs.py --step3_image_captions_path cogvlm-captions_FromSTEP3.json --step4_video_descriptions_path dense_descriptions.json --save_dir /directory/to/save/QA_pairs/ --openai_api_key openai_api_key
+
+# Alternatively, run all steps with the pipeline runner. Intermediate results are stored per video under --work_dir, keyed by
+# their inputs and parameters, so a rerun only recomputes what changed (e.g. editing the step5 prompt only regenerates the QA pairs).
+# python run_pipeline.py --ntu_data_path /path/to/NTU120 --work_dir /path/to/adlx_work --output_dir /directory/to/save/adlx/ --openai_api_key openai_api_key
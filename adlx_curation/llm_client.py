@@ -0,0 +1,256 @@
+"""
+Asynchronous chat completion client and annotation runner for the step4 and step5 generation scripts.
+
+Requests go to any OpenAI-compatible /chat/completions endpoint (the OpenAI API, a local vLLM or
+llama.cpp server, or a stub server for testing). Many requests are kept in flight at once, and a token
+bucket for requests per minute and one for tokens per minute keep them under the API quota, so the
+throughput is set by the quota instead of by the round-trip latency of one request at a time.
+Rate limit and server errors are retried with exponential backoff and jitter, honouring Retry-After.
+
+Results are appended to a JSONL checkpoint as soon as a video is done, so an interrupted run
+resumes with the videos that are missing.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+import aiohttp
+from tqdm import tqdm
+
+OPENAI_API_BASE = 'https://api.openai.com/v1'
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    """
+    Allows `rate_per_minute` units per minute with bursts of up to `capacity` units. A rate of 0 disables the limit.
+    The default capacity is 6 seconds worth of quota, APIs enforce their per minute limits over shorter windows.
+    """
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else max(1, rate_per_minute / 10)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        if self.rate <= 0:
+            return
+        if self._lock is None: # created lazily so that it belongs to the running event loop
+            self._lock = asyncio.Lock()
+        # requests larger than the bucket would wait forever, let them through once the bucket is full
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def refund(self, amount):
+        if self.rate > 0:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RequestError(Exception):
+    pass
+
+
+class AsyncChatClient(object):
+    """
+    Chat completions against an OpenAI-compatible endpoint.
+
+    Parameters:
+    api_base (str): Base url of the API, e.g. https://api.openai.com/v1 or http://localhost:8000/v1.
+    api_key (str): Sent as a bearer token, can be None for local servers.
+    model (str): Model name of the requests.
+    max_concurrency (int): Maximum number of requests in flight.
+    requests_per_minute (int): Request quota, 0 disables the limit.
+    tokens_per_minute (int): Token quota, 0 disables the limit. Prompt tokens are estimated from the characters,
+        the unused part of the estimate is given back once the response reports its usage.
+    retries (int): Attempts per request for rate limit, server and connection errors.
+    """
+    def __init__(self, api_base=OPENAI_API_BASE, api_key=None, model='gpt-3.5-turbo', max_concurrency=16,
+                 requests_per_minute=500, tokens_per_minute=160000, retries=8, backoff_base=1.0, backoff_max=60.0,
+                 timeout=300, max_completion_tokens=1024):
+        self.url = api_base.rstrip('/') + '/chat/completions'
+        self.api_key = api_key
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.max_completion_tokens = max_completion_tokens
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self._semaphore = None
+        self._session = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @property
+    def session(self):
+        if self._session is None:
+            headers = {'Authorization': f'Bearer {self.api_key}'} if self.api_key else {}
+            self._session = aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _estimate_tokens(self, messages):
+        return sum(len(message['content']) for message in messages) // 4 + self.max_completion_tokens
+
+    async def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, 1)
+        else:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        await asyncio.sleep(delay)
+
+    async def chat(self, messages, **kwargs):
+        """
+        Returns the content of the first choice. Raises RequestError once all retries are used up
+        or on errors that are not worth retrying (e.g. invalid request, authentication).
+        """
+        payload = {'model': self.model, 'messages': messages, **kwargs}
+        estimated_tokens = self._estimate_tokens(messages)
+        last_error = None
+        for attempt in range(self.retries):
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(estimated_tokens)
+            retry_after = None
+            try:
+                # only hold a slot while the request is in flight, not while backing off
+                async with self.semaphore:
+                    async with self.session.post(self.url, json=payload) as response:
+                        if response.status == 200:
+                            body = await response.json(content_type=None)
+                            used_tokens = body.get('usage', {}).get('total_tokens')
+                            if used_tokens is not None:
+                                self.token_bucket.refund(max(0, estimated_tokens - used_tokens))
+                            return body['choices'][0]['message']['content']
+                        text = await response.text()
+                        if response.status not in RETRY_STATUS:
+                            raise RequestError(f'HTTP {response.status}: {text[:500]}')
+                        last_error = RequestError(f'HTTP {response.status}: {text[:500]}')
+                        if 'Retry-After' in response.headers:
+                            try:
+                                retry_after = float(response.headers['Retry-After'])
+                            except ValueError:
+                                pass
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError) as e:
+                last_error = e
+            if attempt < self.retries - 1:
+                await self._backoff(attempt, retry_after)
+        raise RequestError(f'Request failed after {self.retries} attempts: {last_error}')
+
+
+class JsonlCheckpoint(object):
+    """
+    Results of finished videos, one {"id": ..., "result": ...} line per video. Every line is flushed and
+    fsynced when it is written, a partially written last line of an interrupted run is ignored on load.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.results = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.results[record['id']] = record['result']
+        self._file = None
+
+    def __contains__(self, video_id):
+        return video_id in self.results
+
+    def write(self, video_id, result):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps({'id': video_id, 'result': result}) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.results[video_id] = result
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+async def run_annotations(items, annotate_fn, checkpoint, max_pending=256, desc='Annotating'):
+    """
+    Runs annotate_fn(payload) concurrently for every (video_id, payload) of items that is not in the checkpoint.
+    annotate_fn returns the JSON serializable result of a video, or None if the video failed and should be
+    retried by the next run. At most max_pending videos are scheduled at once, the client limits the requests.
+
+    Returns:
+    int: Number of failed videos.
+    """
+    items = [(video_id, payload) for video_id, payload in items if video_id not in checkpoint]
+    num_failed = 0
+    progress = tqdm(total=len(items), desc=desc)
+
+    async def run_one(video_id, payload):
+        nonlocal num_failed
+        try:
+            result = await annotate_fn(payload)
+        except Exception as e:
+            print(f'Error annotating {video_id}: {e}')
+            result = None
+        if result is None:
+            num_failed += 1
+        else:
+            checkpoint.write(video_id, result)
+        progress.update(1)
+
+    pending = set()
+    for video_id, payload in items:
+        if len(pending) >= max_pending:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.add(asyncio.ensure_future(run_one(video_id, payload)))
+    if pending:
+        await asyncio.wait(pending)
+    progress.close()
+    return num_failed
+
+
+def add_client_args(parser):
+    """
+    Command line arguments of AsyncChatClient shared by step4 and step5.
+    """
+    parser.add_argument('--api_base', type=str, default=OPENAI_API_BASE, help='OpenAI-compatible API, e.g. a local server http://localhost:8000/v1')
+    parser.add_argument('--model', type=str, default='gpt-3.5-turbo')
+    parser.add_argument('--max_concurrency', type=int, default=16, help='Maximum number of requests in flight')
+    parser.add_argument('--requests_per_minute', type=int, default=500, help='Request quota of the API, 0 disables the limit')
+    parser.add_argument('--tokens_per_minute', type=int, default=160000, help='Token quota of the API, 0 disables the limit')
+    parser.add_argument('--retries', type=int, default=8, help='Attempts per request for rate limit and server errors')
+
+
+def client_from_args(args, api_key):
+    return AsyncChatClient(api_base=args.api_base, api_key=api_key, model=args.model, max_concurrency=args.max_concurrency,
+                           requests_per_minute=args.requests_per_minute, tokens_per_minute=args.tokens_per_minute, retries=args.retries)
@@ -0,0 +1,464 @@
+"""
+ADL-X curation pipeline runner.
+
+Runs steps 1-5 as a DAG of per-video artifacts:
+
+    NTU clip + skeleton --crop--> cropped clip --stitch--> stitched video --caption--> frame captions
+    frame captions + actions --describe--> description,  description + frame captions --qa--> QA pairs
+
+Every artifact is stored under --work_dir at a key that is the hash of its inputs (the content of the
+NTU files, the keys of the upstream artifacts) and of the parameters and prompts of its step. A rerun
+only computes artifacts whose key is not in the store yet, so changing e.g. the step5 prompt only
+regenerates the QA pairs, and crops, stitched videos and captions are reused. Crop and stitch run in a
+process pool, captions are batched on the GPU and descriptions and QA pairs are requested concurrently.
+Finished artifacts are never partially written, an interrupted run continues where it stopped.
+
+    python run_pipeline.py --ntu_data_path /path/to/NTU120 --work_dir /path/to/adlx_work --output_dir /path/to/adlx \\
+        --video_mapping_json video_mapping.json --action_mapping_json action_mapping.json --openai_api_key ...
+
+The outputs of the last step that was run are exported to --output_dir with the file names of the step
+scripts (cogvlm-captions.json, dense_descriptions.json, generated_QA.json, adlx_QAs_for_training.json)
+and the stitched videos are linked into --output_dir/videos.
+"""
+import argparse
+import ast
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+STAGES = ['crop', 'stitch', 'caption', 'describe', 'qa']
+
+# bump when the code of a step changes its output, parameters and prompts are part of the keys already
+STAGE_VERSIONS = {'crop': 1, 'stitch': 1, 'caption': 1, 'describe': 1, 'qa': 1}
+
+CURATION_DIR = os.path.dirname(os.path.abspath(__file__))
+CAPTION_MODEL = 'THUDM/cogvlm-chat-hf'
+
+
+def hash_json(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+def module_constants(path, names):
+    """
+    Values of top-level constant assignments of a script, read without importing it (step3 imports torch and the model code).
+    """
+    with open(path, 'r') as f:
+        tree = ast.parse(f.read())
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in names:
+                    constants[target.id] = ast.literal_eval(node.value)
+    return constants
+
+
+class FileHasher(object):
+    """
+    sha256 of input files. Hashes are cached by (path, size, mtime), so only new or modified NTU files are read again.
+    """
+    def __init__(self, cache_path, num_threads=8):
+        self.cache_path = cache_path
+        self.num_threads = num_threads
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                self.cache = json.load(f)
+
+    def _hash(self, path):
+        stat = os.stat(path)
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        self.cache[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return self.cache[path][2]
+
+    def hash_files(self, paths):
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            hashes = list(tqdm(executor.map(self._hash, paths), total=len(paths), desc='Hashing inputs'))
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_path, self.cache_path)
+        return dict(zip(paths, hashes))
+
+
+class ArtifactStore(object):
+    """
+    Content-addressed artifacts, one directory per artifact: {root}/{stage}/{key[:2]}/{key}/.
+    An artifact is built in a temporary directory and renamed into place together with its meta.json,
+    so an artifact directory is either complete or absent.
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, stage, key):
+        return os.path.join(self.root, stage, key[:2], key)
+
+    def exists(self, stage, key):
+        return os.path.exists(os.path.join(self.path(stage, key), 'meta.json'))
+
+    def tmp_dir(self, stage, key):
+        tmp_dir = os.path.join(self.root, stage, 'tmp', f'{key}.{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        return tmp_dir
+
+    def commit(self, stage, key, tmp_dir, meta):
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+        final_dir = self.path(stage, key)
+        os.makedirs(os.path.dirname(final_dir), exist_ok=True)
+        try:
+            os.rename(tmp_dir, final_dir)
+        except OSError: # built concurrently by another run, keep the existing one
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def write_json(self, stage, key, obj, meta):
+        tmp_dir = self.tmp_dir(stage, key)
+        with open(os.path.join(tmp_dir, f'{stage}.json'), 'w') as f:
+            json.dump(obj, f, indent=4)
+        self.commit(stage, key, tmp_dir, meta)
+
+    def read_json(self, stage, key):
+        with open(os.path.join(self.path(stage, key), f'{stage}.json'), 'r') as f:
+            return json.load(f)
+
+    def gc(self, live_keys):
+        """
+        Remove the artifacts of every stage that are not in live_keys[stage], and leftover temporary directories.
+        """
+        num_removed = 0
+        for stage in STAGES:
+            stage_dir = os.path.join(self.root, stage)
+            if not os.path.isdir(stage_dir):
+                continue
+            for prefix in os.listdir(stage_dir):
+                prefix_dir = os.path.join(stage_dir, prefix)
+                if prefix == 'tmp':
+                    shutil.rmtree(prefix_dir, ignore_errors=True)
+                    continue
+                for key in os.listdir(prefix_dir):
+                    if key not in live_keys.get(stage, ()):
+                        shutil.rmtree(os.path.join(prefix_dir, key), ignore_errors=True)
+                        num_removed += 1
+        return num_removed
+
+
+def plan(args, video_mapping, action_mapping, hasher):
+    """
+    Computes the key of every artifact. Returns {stage: {item: key}} and {stage: {item: inputs}}, where items are
+    NTU clip names for crop and stitched video names for the other stages.
+    """
+    from step4_WS_video_desc import build_messages as build_description_messages
+    from step5_QA_generation import build_summary_messages, build_details_messages
+
+    keys = {stage: {} for stage in STAGES}
+    inputs = {stage: {} for stage in STAGES}
+
+    # crop: content of the NTU clip and skeleton, crop parameters
+    clips = sorted({clip for clips in video_mapping.values() for clip in clips})
+    clip_files = {}
+    for clip in clips:
+        video_identifier = clip[:-8] # clip '_rgb.avi'
+        vid_path = f'{args.ntu_data_path}/rgb/{clip}'
+        pose_path = f'{args.ntu_data_path}/skeletons/{video_identifier}.skeleton.npy'
+        if os.path.exists(vid_path) and os.path.exists(pose_path):
+            clip_files[clip] = (vid_path, pose_path)
+        else:
+            print(f'Missing NTU video or skeleton of {clip}')
+    file_hashes = hasher.hash_files([path for files in clip_files.values() for path in files])
+    for clip, (vid_path, pose_path) in clip_files.items():
+        inputs['crop'][clip] = {'vid_path': vid_path}
+        keys['crop'][clip] = hash_json({
+            'stage': 'crop', 'version': STAGE_VERSIONS['crop'], 'video': file_hashes[vid_path], 'skeleton': file_hashes[pose_path],
+            'slack': args.slack, 'new_shape': list(args.new_shape),
+        })
+
+    # stitch: crops in order
+    for name, clips in video_mapping.items():
+        crop_keys = [keys['crop'][clip] for clip in clips if clip in keys['crop']]
+        if not crop_keys:
+            continue
+        inputs['stitch'][name] = {'clips': [clip for clip in clips if clip in keys['crop']]}
+        keys['stitch'][name] = hash_json({
+            'stage': 'stitch', 'version': STAGE_VERSIONS['stitch'], 'clips': crop_keys, 'force_reencode': args.force_reencode,
+        })
+
+    # caption: stitched video, captioning model, prompt and frame rate
+    caption_params = module_constants(os.path.join(CURATION_DIR, 'step3_image_frame_captions.py'), {'query', 'gen_kwargs', 'caption_rate_fps'})
+    for name, stitch_key in keys['stitch'].items():
+        keys['caption'][name] = hash_json({
+            'stage': 'caption', 'version': STAGE_VERSIONS['caption'], 'video': stitch_key, 'model': CAPTION_MODEL, **caption_params,
+        })
+
+    # describe and qa: upstream artifacts, prompts (rendered with placeholders) and judge model
+    describe_prompt = hash_json(build_description_messages(['{captions}'], '{actions}'))
+    qa_prompt = hash_json([build_summary_messages('{description}', '{captions}'), build_details_messages('{description}', '{captions}')])
+    for name, caption_key in keys['caption'].items():
+        if name not in action_mapping:
+            continue
+        inputs['describe'][name] = {'actions': action_mapping[name]}
+        keys['describe'][name] = hash_json({
+            'stage': 'describe', 'version': STAGE_VERSIONS['describe'], 'captions': caption_key, 'actions': action_mapping[name],
+            'prompt': describe_prompt, 'model': args.model,
+        })
+        keys['qa'][name] = hash_json({
+            'stage': 'qa', 'version': STAGE_VERSIONS['qa'], 'description': keys['describe'][name], 'captions': caption_key,
+            'prompt': qa_prompt, 'model': args.model,
+        })
+
+    return keys, inputs
+
+
+def run_crop(task):
+    from step1_person_augmented_generation import crop_video
+    store_root, key, clip, vid_path, ntu_data_path, new_shape, slack = task
+    store = ArtifactStore(store_root)
+    tmp_dir = store.tmp_dir('crop', key)
+    os.makedirs(f'{tmp_dir}/rgb')
+    os.makedirs(f'{tmp_dir}/skeletons')
+    try:
+        _, status = crop_video((vid_path, ntu_data_path, tmp_dir, new_shape, slack))
+    except Exception as e:
+        print(f'Error cropping {clip}: {e}')
+        status = 'error'
+    if status != 'done':
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return status
+    store.commit('crop', key, tmp_dir, {'stage': 'crop', 'clip': clip})
+    return status
+
+
+def run_stitch(task):
+    from step2_temporal_stitching import stitch_video
+    store_root, key, name, clip_paths, force_reencode = task
+    store = ArtifactStore(store_root)
+    tmp_dir = store.tmp_dir('stitch', key)
+    _, method = stitch_video((name, clip_paths, '', tmp_dir, force_reencode))
+    if method not in ('stream_copy', 'reencode'):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return method
+    store.commit('stitch', key, tmp_dir, {'stage': 'stitch', 'video': name, 'method': method})
+    return method
+
+
+def run_pool(fn, tasks, num_workers, desc):
+    counts = {}
+    if not tasks:
+        return counts
+    with Pool(num_workers) as pool:
+        for status in tqdm(pool.imap_unordered(fn, tasks), total=len(tasks), desc=desc):
+            counts[status] = counts.get(status, 0) + 1
+    return counts
+
+
+def clip_path(store, crop_key, clip):
+    return os.path.join(store.path('crop', crop_key), 'rgb', clip)
+
+
+def stitched_path(store, stitch_key, name):
+    return os.path.join(store.path('stitch', stitch_key), f'{name}.mp4')
+
+
+def run_captions(args, store, keys, names):
+    import step3_image_frame_captions as step3
+
+    class ArtifactCaptionWriter(step3.CaptionWriter):
+        def __init__(self):
+            super().__init__(None)
+
+        def fail(self, vid_name, e):
+            # not stored, so the video is captioned again by the next run
+            self.captions.pop(vid_name, None)
+            self.remaining.pop(vid_name, None)
+            print(f'Error captioning {vid_name}: {e}')
+
+        def write(self, vid_name, captions):
+            store.write_json('caption', keys['caption'][vid_name], captions, {'stage': 'caption', 'video': vid_name})
+            self.num_written += 1
+
+    model, tokenizer = step3.load_model(args.device)
+    vids = [stitched_path(store, keys['stitch'][name], name) for name in names]
+    step3.caption_videos(vids, model, tokenizer, ArtifactCaptionWriter(), args.caption_batch_size, args.num_decode_threads)
+
+
+class ArtifactCheckpoint(object):
+    """
+    llm_client.run_annotations checkpoint that stores every result as an artifact.
+    """
+    def __init__(self, store, stage, keys):
+        self.store = store
+        self.stage = stage
+        self.keys = keys
+
+    def __contains__(self, name):
+        return self.store.exists(self.stage, self.keys[name])
+
+    def write(self, name, result):
+        self.store.write_json(self.stage, self.keys[name], result, {'stage': self.stage, 'video': name})
+
+
+async def run_annotation_stages(args, store, keys, inputs, describe_names, qa_names):
+    from llm_client import client_from_args, run_annotations
+    from structured_output import QAGenerator
+    from step4_WS_video_desc import annotate as describe
+    from step5_QA_generation import annotate_video, build_mega_caption
+
+    async with client_from_args(args, args.openai_api_key) as client:
+        generator = QAGenerator(client, json_mode=not args.no_json_mode, max_attempts=args.max_attempts)
+
+        describe_items = [(name, (store.read_json('caption', keys['caption'][name]), inputs['describe'][name]['actions']))
+                          for name in describe_names]
+        num_failed = await run_annotations(describe_items, lambda payload: describe(generator, *payload),
+                                           ArtifactCheckpoint(store, 'describe', keys['describe']), desc='describe')
+
+        qa_items = []
+        for name in qa_names:
+            if not store.exists('describe', keys['describe'][name]):
+                continue
+            description = store.read_json('describe', keys['describe'][name])['A']
+            mega_caption = build_mega_caption(store.read_json('caption', keys['caption'][name]))
+            qa_items.append((name, (name, description, mega_caption)))
+        num_failed += await run_annotations(qa_items, lambda payload: annotate_video(generator, *payload),
+                                            ArtifactCheckpoint(store, 'qa', keys['qa']), desc='qa')
+    return num_failed
+
+
+def export_outputs(args, store, keys, last_stage):
+    from step5_QA_generation import build_training_data
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    def collect(stage):
+        return {name: store.read_json(stage, key) for name, key in keys[stage].items() if store.exists(stage, key)}
+
+    def dump(obj, file_name):
+        path = os.path.join(args.output_dir, file_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(obj, f, indent=4)
+        os.replace(path + '.tmp', path)
+
+    if STAGES.index(last_stage) >= STAGES.index('stitch'):
+        video_dir = os.path.join(args.output_dir, 'videos')
+        os.makedirs(video_dir, exist_ok=True)
+        for name, key in keys['stitch'].items():
+            link_path = os.path.join(video_dir, f'{name}.mp4')
+            target = stitched_path(store, key, name)
+            if store.exists('stitch', key) and (not os.path.islink(link_path) or os.readlink(link_path) != target):
+                if os.path.lexists(link_path):
+                    os.remove(link_path)
+                os.symlink(target, link_path)
+    if STAGES.index(last_stage) >= STAGES.index('caption'):
+        dump(collect('caption'), 'cogvlm-captions.json')
+    if STAGES.index(last_stage) >= STAGES.index('describe'):
+        dump(collect('describe'), 'dense_descriptions.json')
+    if STAGES.index(last_stage) >= STAGES.index('qa'):
+        results = list(collect('qa').values())
+        dump(results, 'generated_QA.json')
+        dump(build_training_data(results), 'adlx_QAs_for_training.json')
+
+
+def parse_args():
+    from llm_client import add_client_args
+
+    parser = argparse.ArgumentParser(description='Run the ADL-X curation steps, recomputing only the artifacts whose inputs changed')
+    parser.add_argument('--ntu_data_path', type=str, required=True, help='NTU120 directory containing "rgb" and "skeletons"')
+    parser.add_argument('--video_mapping_json', type=str, default=os.path.join(CURATION_DIR, 'video_mapping.json'))
+    parser.add_argument('--action_mapping_json', type=str, default=os.path.join(CURATION_DIR, 'action_mapping.json'))
+    parser.add_argument('--work_dir', type=str, required=True, help='Artifact store, reused across runs')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--until', type=str, default='qa', choices=STAGES, help='Last step to run')
+    parser.add_argument('--limit', type=int, default=None, help='Only process the first N stitched videos, for trial runs')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Processes for cropping and stitching')
+    parser.add_argument('--gc', action='store_true', help='Delete artifacts not used by this run (e.g. of old prompts) at the end')
+    # step1 / step2
+    parser.add_argument('--slack', type=int, default=64)
+    parser.add_argument('--new_shape', nargs='+', type=int, default=[224, 224])
+    parser.add_argument('--force_reencode', action='store_true')
+    # step3
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--caption_batch_size', type=int, default=8)
+    parser.add_argument('--num_decode_threads', type=int, default=4)
+    # step4 / step5
+    parser.add_argument('--openai_api_key', default=None)
+    parser.add_argument('--max_attempts', type=int, default=3)
+    parser.add_argument('--no_json_mode', action='store_true')
+    add_client_args(parser)
+    args = parser.parse_args()
+    args.new_shape = tuple(args.new_shape)
+    return args
+
+
+def main():
+    args = parse_args()
+    last_stage = args.until
+    if args.gc and args.limit is not None:
+        raise ValueError('--gc would delete the artifacts of the videos left out by --limit')
+    os.makedirs(args.work_dir, exist_ok=True)
+    store = ArtifactStore(os.path.join(args.work_dir, 'artifacts'))
+    hasher = FileHasher(os.path.join(args.work_dir, 'file_hashes.json'))
+
+    with open(args.video_mapping_json) as f:
+        video_mapping = json.load(f)
+    with open(args.action_mapping_json) as f:
+        action_mapping = json.load(f)
+    if args.limit is not None:
+        video_mapping = dict(sorted(video_mapping.items())[:args.limit])
+
+    keys, inputs = plan(args, video_mapping, action_mapping, hasher)
+
+    def todo(stage):
+        return [item for item, key in keys[stage].items() if not store.exists(stage, key)]
+
+    for stage in STAGES:
+        print(f'{stage}: {len(keys[stage])} artifacts, {len(todo(stage))} to compute')
+
+    # step1: crop every NTU clip that a stitched video uses
+    tasks = [(store.root, keys['crop'][clip], clip, inputs['crop'][clip]['vid_path'], args.ntu_data_path, args.new_shape, args.slack)
+             for clip in todo('crop')]
+    print('crop', run_pool(run_crop, tasks, args.num_workers, 'crop'))
+
+    if STAGES.index(last_stage) >= STAGES.index('stitch'):
+        tasks = []
+        for name in todo('stitch'):
+            clips = inputs['stitch'][name]['clips']
+            if all(store.exists('crop', keys['crop'][clip]) for clip in clips):
+                tasks.append((store.root, keys['stitch'][name], name, [clip_path(store, keys['crop'][clip], clip) for clip in clips], args.force_reencode))
+        print('stitch', run_pool(run_stitch, tasks, args.num_workers, 'stitch'))
+
+    if STAGES.index(last_stage) >= STAGES.index('caption'):
+        names = [name for name in todo('caption') if store.exists('stitch', keys['stitch'][name])]
+        if names:
+            run_captions(args, store, keys, names)
+
+    if STAGES.index(last_stage) >= STAGES.index('describe'):
+        describe_names = [name for name in todo('describe') if store.exists('caption', keys['caption'][name])]
+        qa_names = todo('qa') if STAGES.index(last_stage) >= STAGES.index('qa') else []
+        qa_names = [name for name in qa_names if store.exists('caption', keys['caption'][name])]
+        num_failed = asyncio.run(run_annotation_stages(args, store, keys, inputs, describe_names, qa_names))
+        if num_failed > 0:
+            print(f'{num_failed} annotations failed, run again to retry them')
+
+    for stage in STAGES[:STAGES.index(last_stage) + 1]:
+        print(f'{stage}: {len(keys[stage]) - len(todo(stage))}/{len(keys[stage])} artifacts done')
+
+    export_outputs(args, store, keys, last_stage)
+
+    if args.gc:
+        print(f'Removed {store.gc({stage: set(keys[stage].values()) for stage in STAGES})} unused artifacts')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,10 @@ import glob
 import copy
 import cv2
 import os
+import sys
+from multiprocessing import Pool
 
-from PAG_utils import npy_to_keypoints, clamp_keypoints, get_bbox, process_frame
+from PAG_utils import npy_to_keypoints, clamp_keypoints, get_bboxes, crop_frame, crop_keypoints
 
 import argparse
 parser = argparse.ArgumentParser()
@@ -16,106 +18,130 @@ parser.add_argument('--new_dataset_name', type=str, required=True,
 )
 parser.add_argument('--slack', type=int, required=False, default=64)
 parser.add_argument('--new_shape', nargs='+', type=int, required=True, help='Tuple giving shape to resize frame to after cropping. pass like "--new_shape W H"')
+parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of videos cropped in parallel')
+parser.add_argument('--yes', action='store_true', help='Do not ask for confirmation before generating (for unattended runs)')
 
-args = parser.parse_args()
-if args.ntu_data_path[-1] == '/':
-  args.ntu_data_path = args.ntu_data_path[:-1]
 
-args.new_shape = tuple(args.new_shape)
-
-
-def generate_cropped_dataset(ntu_subset_path, new_shape):
+def crop_video(task):
+    '''
+    Crops a single NTU video around its people and saves the video and the shifted keypoints.
+    Returns the video identifier and 'done', 'skipped' or 'missing_skeleton'.
+    '''
+    vid_path, ntu_subset_path, new_dataset_dir, new_shape, slack = task
+
+    # Load video, initialize video writer
+    video_path_stem, video_identifier = os.path.split(vid_path)
+    video_identifier = video_identifier[:-8] # clip '_rgb.avi'
+
+    # skip video if it is missing skeleton
+    pose_path = f'{ntu_subset_path}/skeletons/{video_identifier}.skeleton.npy'
+    if not os.path.exists(pose_path):
+        return video_identifier, 'missing_skeleton'
+
+    # the video is renamed into place after its keypoints are saved, so an existing video means the sample is complete
+    save_path = f'{new_dataset_dir}/rgb/{video_identifier}_rgb.avi'
+    if os.path.exists(save_path):
+        return video_identifier, 'skipped'
+
+    cap = cv2.VideoCapture(vid_path)
+    w, h, frame_rate, num_frames = int(cap.get(3)), int(cap.get(4)), int(cap.get(5)), int(cap.get(7))
+
+    tmp_save_path = f'{new_dataset_dir}/rgb/.{video_identifier}_rgb.tmp.avi'
+    writer = cv2.VideoWriter(tmp_save_path,
+                             cv2.VideoWriter_fourcc(*'FMP4'),
+                             frame_rate, new_shape, True
+    )
+
+    # Load keypoints
+    np_skeleton = np.load(pose_path, allow_pickle=True).item() # used when re-saving keypoints after shifting them
+    number_of_bodies_in_video = np.array(np_skeleton['nbodys']).max()
+    njts = np_skeleton['njoints']
+
+    kpts = npy_to_keypoints(pose_path, frame_h=h, frame_w=w, np_skeleton=np_skeleton) # reuses the loaded dict instead of unpickling it again
+    kpts = clamp_keypoints(kpts, frame_h=h, frame_w=w) # used to generate the multi-person crops. Will be shape (n_frame, bodies*njts, 2)
+    num_frames_with_kpts = kpts.shape[0]
+
+    # Bounding boxes and cropped keypoints of all frames in one pass
+    tlc, brc = get_bboxes(kpts, slack=slack)
+    new_kpts = crop_keypoints(kpts, tlc, brc, new_shape)
+
+    num_frames_written = 0
+    for frm_num in range(0, num_frames_with_kpts):
+        ret, frame = cap.read()
+        if not ret:
+            print(f'Video {vid_path} has {frm_num} frames but keypoints for {num_frames_with_kpts} frames')
+            break
+
+        new_frm = cv2.resize(crop_frame(frame, tlc[frm_num], brc[frm_num]), new_shape)
+        writer.write(new_frm)
+        num_frames_written += 1
+
+    writer.release()
+    cap.release()
+
+    # Update keypoints associated with the video. In npy_to_keypoints if a body leaves the frame, that bodies keypoints are
+    # set to the keypoints of the first body (which is always in the frame) to make processing easier.
+    # We dont want to save these duplicated keypoints, so we save the original keypoints for bodies not in the frame
+    nbodys = np.ones(num_frames_written, dtype=int) # frames without an nbodys entry are taken to contain a single body
+    num_frames_with_count = min(num_frames_written, len(np_skeleton['nbodys']))
+    if num_frames_with_count < num_frames_written:
+        print(f'Error indexing nbodys in {vid_path}: nbodys shape: {len(np_skeleton["nbodys"])} - kpts shape: {kpts.shape}')
+    nbodys[:num_frames_with_count] = np.asarray(np_skeleton['nbodys'][:num_frames_with_count])
+
+    for body_idx in range(number_of_bodies_in_video):
+        # the first body will always be in the frame, always update its keypoints
+        body_kpts = np.array(np_skeleton[f'rgb_body{body_idx}'])
+        in_frame = np.zeros(len(body_kpts), dtype=bool)
+        in_frame[:num_frames_written] = (nbodys > body_idx) | (body_idx == 0)
+        body_kpts[in_frame] = new_kpts[:num_frames_written][in_frame[:num_frames_written], body_idx*njts:(body_idx+1)*njts]
+        np_skeleton[f'rgb_body{body_idx}'] = body_kpts
+
+    # Save updated keypoints and indicate that all body keypoints have been updated (in the past only rgb_body0 was updated)
+    np_skeleton['all_bodies_updated'] = True
+    np.save(f'{new_dataset_dir}/skeletons/{video_identifier}.skeleton.npy', np.array(np_skeleton))
+    os.replace(tmp_save_path, save_path)
+
+    return video_identifier, 'done'
+
+
+def generate_cropped_dataset(ntu_subset_path, new_shape, new_dataset_name, slack=64, num_workers=1):
     '''
     ntu_subset_path : str
         Path to NTU. e.g. '/data/ntu/NTU'
     '''
-    all_videos = glob.glob(f'{ntu_subset_path}/rgb/*.avi')
+    all_videos = sorted(glob.glob(f'{ntu_subset_path}/rgb/*.avi'))
 
     save_dir, ntu_subset = os.path.split(ntu_subset_path)
-    os.makedirs(f'{save_dir}/{ntu_subset}_{args.new_dataset_name}/rgb', exist_ok=True)
-    os.makedirs(f'{save_dir}/{ntu_subset}_{args.new_dataset_name}/skeletons', exist_ok=True)
-
-    print(f'\tProcessing data at {ntu_subset_path}. Saving at {save_dir}/{ntu_subset}_{args.new_dataset_name}')
-
-    write_shape = new_shape
-
-    for i, vid_path in enumerate(all_videos):
-        if i % (len(all_videos) // 10) == 0:
-            print(f'\tProcessing video {i}/{len(all_videos)}')
-
-        # Load video, initialize video writer
-        video_path_stem, video_identifier = os.path.split(vid_path)
-        video_identifier = video_identifier[:-8] # clip '_rgb.avi'
-
-        # skip video if it is missing skeleton
-        if not os.path.exists(f'{ntu_subset_path}/skeletons/{video_identifier}.skeleton.npy'):
-            continue
-
-        if os.path.exists(f'{save_dir}/{ntu_subset}_{args.new_dataset_name}/rgb/{video_identifier}_rgb.avi'):
-            print('skipping {video_identifier} (already exists)')
-            continue
-
-        cap = cv2.VideoCapture(vid_path)
-        w, h, frame_rate, num_frames = int(cap.get(3)), int(cap.get(4)), int(cap.get(5)), int(cap.get(7))
-
-        writer = cv2.VideoWriter(f'{save_dir}/{ntu_subset}_{args.new_dataset_name}/rgb/{video_identifier}_rgb.avi',
-                                 cv2.VideoWriter_fourcc(*'FMP4'),
-                                 frame_rate, write_shape, True
-        )
-
-        # Load keypoints
-        pose_path = f'{ntu_subset_path}/skeletons/{video_identifier}.skeleton.npy'
-        np_skeleton = np.load(pose_path, allow_pickle=True).item() # used when re-saving keypoints after shifting them
-        number_of_bodies_in_video = np.array(np_skeleton['nbodys']).max()
-        njts = np_skeleton['njoints']
-        
-        kpts = npy_to_keypoints(pose_path, frame_h=h, frame_w=w)
-        kpts = clamp_keypoints(kpts, frame_h=h, frame_w=w) # used to generate the multi-person crops. Will be shape (n_frame, bodies*njts, 2)
-        num_frames_with_kpts = kpts.shape[0]
-
-        # Generate video and update keypoints frame-by-frame
-        error_printed = False
-        for frm_num in range(0, num_frames_with_kpts):
-            try:
-                number_of_bodies_in_frame = np_skeleton['nbodys'][frm_num]
-            except IndexError as e:
-                if not error_printed:
-                    print(f'Error indexing nbodys(frame {frm_num}) in {vid_path}: nbodys shape: {len(np_skeleton["nbodys"])} - kpts shape: {kpts.shape}')
-                    error_printed = True
-
-                number_of_bodies_in_frame = 1
-
-            ret, frame = cap.read()
-
-            tlc, brc = get_bbox(kpts, frm_num, slack=args.slack)
-            new_frm, new_kpts = process_frame(frame, kpts[frm_num], tlc, brc, new_shape)
+    new_dataset_dir = f'{save_dir}/{ntu_subset}_{new_dataset_name}'
+    os.makedirs(f'{new_dataset_dir}/rgb', exist_ok=True)
+    os.makedirs(f'{new_dataset_dir}/skeletons', exist_ok=True)
 
-            writer.write(new_frm)
+    print(f'\tProcessing data at {ntu_subset_path}. Saving at {new_dataset_dir}')
 
-            # Update keypoints associated with the video. In npy_to_keypoints if a body leaves the frame, that bodies keypoints are
-            # set to the keypoints of the first body (which is always in the frame) to make processing easier. 
-            # We dont want to save these duplicated keypoints, so we save the original keypoints for bodies not in the frame
-            for body_idx in range(number_of_bodies_in_video):
-                # the first body will always be in the frame, always update its keypoints
-                if body_idx == 0:
-                    np_skeleton['rgb_body0'][frm_num] = new_kpts[body_idx*njts:(body_idx+1)*njts]
-                else:
-                    if number_of_bodies_in_frame > body_idx: # this body is in the frame
-                        np_skeleton[f'rgb_body{body_idx}'][frm_num] = new_kpts[body_idx*njts:(body_idx+1)*njts]
-                    else: # make no changes if the body is not contained in the frame
-                        pass
+    tasks = [(vid_path, ntu_subset_path, new_dataset_dir, new_shape, slack) for vid_path in all_videos]
+    status_counts = {}
+    with Pool(num_workers) as pool:
+        for i, (video_identifier, status) in enumerate(pool.imap_unordered(crop_video, tasks)):
+            status_counts[status] = status_counts.get(status, 0) + 1
+            if i % max(len(all_videos) // 10, 1) == 0:
+                print(f'\tProcessing video {i}/{len(all_videos)}')
 
+    print(f'\tFinished: {status_counts}')
 
-        writer.release()
-        cap.release()
 
-        # Save updated keypoints and indicate that all body keypoints have been updated (in the past only rgb_body0 was updated)
-        np_skeleton['all_bodies_updated'] = True
-        np.save(f'{save_dir}/{ntu_subset}_{args.new_dataset_name}/skeletons/{video_identifier}.skeleton.npy', np.array(np_skeleton))
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.ntu_data_path[-1] == '/':
+      args.ntu_data_path = args.ntu_data_path[:-1]
 
+    args.new_shape = tuple(args.new_shape)
 
-input(f'Generating cropped dataset for NTU at path: {args.ntu_data_path}. Cropping parameters new_shape: {args.new_shape}. New dataset name {args.new_dataset_name} (will save to {args.ntu_data_path}/{args.new_dataset_name}).\nPress enter to continue or Ctrl + Z to quit!')
+    message = f'Generating cropped dataset for NTU at path: {args.ntu_data_path}. Cropping parameters new_shape: {args.new_shape}. New dataset name {args.new_dataset_name} (will save to {args.ntu_data_path}_{args.new_dataset_name}).'
+    if args.yes or not sys.stdin.isatty():
+        print(message)
+    else:
+        input(f'{message}\nPress enter to continue or Ctrl + Z to quit!')
 
-ntu_path = f'{args.ntu_data_path}'
-print('\nGenerating dataset from ({ntu_path})')
-generate_cropped_dataset(ntu_path, new_shape=args.new_shape)
\ No newline at end of file
+    ntu_path = f'{args.ntu_data_path}'
+    print(f'\nGenerating dataset from ({ntu_path})')
+    generate_cropped_dataset(ntu_path, new_shape=args.new_shape, new_dataset_name=args.new_dataset_name, slack=args.slack, num_workers=args.num_workers)
@@ -1,43 +1,159 @@
-import argparse, decord, tqdm, json, glob, os
-from PIL import Image
+import argparse, tqdm, json, os, shutil, subprocess, tempfile
+from collections import Counter
+from multiprocessing import Pool
 
 from moviepy.editor import VideoFileClip, concatenate_videoclips
 
-parser = argparse.ArgumentParser(description='Reconstruct NTU videos from cropped frames')
-parser.add_argument('--cropped_ntu_dir', type=str, help='Directory containing cropped NTU120 video dataset')
-parser.add_argument('--video_mapping_json', type=str, help='Path to video mapping JSON file')
-parser.add_argument('--save_dir', type=str)
-args = parser.parse_args()
 
-cropped_ntu_dir = args.cropped_ntu_dir
-save_dir = args.save_dir
-os.makedirs(save_dir, exist_ok=True)
+def get_ffmpeg_exe():
+    ffmpeg_exe = shutil.which('ffmpeg')
+    if ffmpeg_exe is None:
+        # moviepy depends on imageio-ffmpeg, which ships its own ffmpeg binary
+        import imageio_ffmpeg
+        ffmpeg_exe = imageio_ffmpeg.get_ffmpeg_exe()
+    return ffmpeg_exe
 
-all_video_mappings = json.load(open(args.video_mapping_json, 'r'))
 
-iterator = tqdm.tqdm(all_video_mappings.items(), total=len(all_video_mappings))
+def probe_video(video_path):
+    '''
+    Returns the properties of the first video stream that have to match for a stream copy concat
+    (codec, resolution, pixel format, frame rate, time base), or None if the video can not be probed.
+    '''
+    if shutil.which('ffprobe') is None:
+        return None
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-of', 'json',
+           '-show_entries', 'stream=codec_name,width,height,pix_fmt,r_frame_rate,time_base:format=duration', video_path]
+    try:
+        out = json.loads(subprocess.run(cmd, capture_output=True, check=True, text=True).stdout)
+    except (subprocess.CalledProcessError, json.JSONDecodeError):
+        return None
+    if not out.get('streams'):
+        return None
+    stream = out['streams'][0]
+    stream['duration'] = float(out.get('format', {}).get('duration', 0) or 0)
+    return stream
 
-for stitched_video_name, constituent_videos in iterator:
+
+def is_valid_video(video_path):
+    '''
+    An output is valid if it exists and has a decodable video stream with a positive duration.
+    Outputs are written to a temporary file and renamed, so a half written file never takes the final name.
+    '''
+    if not os.path.exists(video_path) or os.path.getsize(video_path) == 0:
+        return False
+    if shutil.which('ffprobe') is None:
+        return True
+    probe = probe_video(video_path)
+    return probe is not None and probe['duration'] > 0
+
+
+def can_stream_copy(probes):
+    keys = ['codec_name', 'width', 'height', 'pix_fmt', 'r_frame_rate', 'time_base']
+    if any(probe is None for probe in probes):
+        return False
+    return all(all(probe.get(k) == probes[0].get(k) for k in keys) for probe in probes[1:])
+
+
+def stitch_stream_copy(clip_paths, output_path):
+    '''
+    Concatenates the clips with ffmpeg's concat demuxer without decoding or encoding a single frame.
+    '''
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as list_file:
+        for clip_path in clip_paths:
+            escaped_path = os.path.abspath(clip_path).replace("'", "'\\''")
+            list_file.write(f"file '{escaped_path}'\n")
+    try:
+        cmd = [get_ffmpeg_exe(), '-y', '-v', 'error', '-fflags', '+genpts', '-f', 'concat', '-safe', '0', '-i', list_file.name,
+               '-map', '0:v', '-c', 'copy', output_path]
+        subprocess.run(cmd, capture_output=True, check=True)
+    finally:
+        os.remove(list_file.name)
+
+
+def stitch_reencode(clip_paths, output_path):
+    '''
+    Original path: decode every clip with moviepy and re-encode the concatenation with libx264.
+    Used when the clips differ in codec, resolution or frame rate.
+    '''
+    clips = [VideoFileClip(clip_path) for clip_path in clip_paths]
+    try:
+        stitched_video = concatenate_videoclips(clips)
+        stitched_video.write_videofile(output_path, codec='libx264', verbose=False, logger=None)
+        stitched_video.close()
+    finally:
+        for clip in clips:
+            clip.close()
+
+
+def stitch_video(task):
+    '''
+    Stitches one video of the mapping. Returns (stitched video name, how it was produced).
+    '''
+    stitched_video_name, constituent_videos, cropped_ntu_dir, save_dir, force_reencode = task
     stitched_video_path = os.path.join(save_dir, stitched_video_name + '.mp4')
 
-    clips_for_stitched_video = []
+    if is_valid_video(stitched_video_path):
+        return stitched_video_name, 'skipped'
 
+    clip_paths = []
     for cons_vid in constituent_videos:
         cons_vid_path = os.path.join(cropped_ntu_dir, cons_vid)
         if not os.path.exists(cons_vid_path):
             print('Missing:', cons_vid_path)
             continue
-        
-        try:
-            clip = VideoFileClip(cons_vid_path)
-            clips_for_stitched_video.append(clip)
-        except Exception as e:
-            print('Error:', cons_vid_path, e)
-    
-    if len(clips_for_stitched_video) != 0:
-        try:
-            stitched_video = concatenate_videoclips(clips_for_stitched_video)
-            stitched_video.write_videofile(stitched_video_path, codec='libx264', verbose=False, logger=None)
-            stitched_video.close()
-        except Exception as e:
-            print('Error:', stitched_video_path, e)
\ No newline at end of file
+        clip_paths.append(cons_vid_path)
+
+    if len(clip_paths) == 0:
+        return stitched_video_name, 'empty'
+
+    # write to a temporary name so that an interrupted run never leaves a truncated video behind
+    tmp_path = os.path.join(save_dir, f'.{stitched_video_name}.tmp.mp4')
+    try:
+        probes = [probe_video(clip_path) for clip_path in clip_paths]
+        if not force_reencode and can_stream_copy(probes):
+            try:
+                stitch_stream_copy(clip_paths, tmp_path)
+                method = 'stream_copy'
+            except subprocess.CalledProcessError as e:
+                print('Stream copy failed, re-encoding:', stitched_video_path, e.stderr.decode(errors='ignore').strip())
+                stitch_reencode(clip_paths, tmp_path)
+                method = 'reencode'
+        else:
+            stitch_reencode(clip_paths, tmp_path)
+            method = 'reencode'
+        os.replace(tmp_path, stitched_video_path)
+    except Exception as e:
+        print('Error:', stitched_video_path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return stitched_video_name, 'error'
+
+    return stitched_video_name, method
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruct NTU videos from cropped frames')
+    parser.add_argument('--cropped_ntu_dir', type=str, help='Directory containing cropped NTU120 video dataset')
+    parser.add_argument('--video_mapping_json', type=str, help='Path to video mapping JSON file')
+    parser.add_argument('--save_dir', type=str)
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of videos stitched in parallel')
+    parser.add_argument('--force_reencode', action='store_true', help='Always re-encode with libx264, even if the clips could be concatenated with stream copy')
+    args = parser.parse_args()
+
+    cropped_ntu_dir = args.cropped_ntu_dir
+    save_dir = args.save_dir
+    os.makedirs(save_dir, exist_ok=True)
+
+    all_video_mappings = json.load(open(args.video_mapping_json, 'r'))
+    tasks = [(stitched_video_name, constituent_videos, cropped_ntu_dir, save_dir, args.force_reencode)
+             for stitched_video_name, constituent_videos in all_video_mappings.items()]
+
+    # stream copy is bound by disk bandwidth, so the pool mostly helps the re-encode fallback and the probing
+    method_counts = Counter()
+    with Pool(args.num_workers) as pool:
+        iterator = tqdm.tqdm(pool.imap_unordered(stitch_video, tasks), total=len(tasks))
+        for stitched_video_name, method in iterator:
+            method_counts[method] += 1
+            iterator.set_description(', '.join(f'{k}: {v}' for k, v in sorted(method_counts.items())))
+
+    print('Stitched videos:', dict(method_counts))
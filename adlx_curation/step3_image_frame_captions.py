@@ -1,35 +1,14 @@
 from transformers import AutoModelForCausalLM, LlamaTokenizer, BitsAndBytesConfig
+from decord import VideoReader, cpu
 import argparse, json, torch
 
-import random, tqdm, time, glob, cv2, PIL, os
+import random, tqdm, time, glob, PIL, os
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 random.seed(0)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--proc_num', type=int, default=0, help='The process number of this job')
-parser.add_argument('--num_procs', type=int, default=1, help='The total number of processes to run')
-parser.add_argument('--stitched_vid_path', type=str, required=True)
-parser.add_argument('--save_every', type=int, default=100)
-args = parser.parse_args()
-
-DEVICE = f'cuda:{args.proc_num}'
-
-tokenizer = LlamaTokenizer.from_pretrained('lmsys/vicuna-7b-v1.5')
-
-model = AutoModelForCausalLM.from_pretrained(
-    'THUDM/cogvlm-chat-hf',
-    low_cpu_mem_usage=True,
-    # load_in_4bit=True,
-    trust_remote_code=True,
-    # device_map='auto',
-    torch_dtype=torch.float16,
-    # quantization_config=BitsAndBytesConfig(
-    #     load_in_4bit=True,
-    #     bnb_4bit_use_double_quant=True,
-    #     bnb_4bit_quant_type="nf4",
-    #     bnb_4bit_compute_dtype=torch.float16
-    # )
-).eval().to(DEVICE)
+from caption_leases import LeaseTable, get_worker_id, load_caption_file
 
 query = "A chat between a curious user and an artificial intelligence assistant. The assistant gives helpful, detailed, and polite answers to the user's questions. USER: Give a detailed description of the actions happening and describe the image, include motions and the objects interacted by the person. Do not provide any coordinates from the image ASSISTANT:"
 
@@ -38,91 +17,273 @@ gen_kwargs = {
     "max_new_tokens": 256,
     "do_sample": False} # "temperature": 0.9
 
+caption_rate_fps = 0.5
 
-# Load video paths
-vids = glob.glob(f'{args.stitched_vid_path}/*.mp4')
-random.shuffle(vids) # seed is set above, so multiproc is okay
 
-partition_size = len(vids) // args.num_procs
-if args.proc_num == args.num_procs - 1: # last process
-    vids = vids[args.proc_num * partition_size:]
-else:
-    vids = vids[args.proc_num * partition_size: (args.proc_num + 1) * partition_size]
+def load_model(device):
+    tokenizer = LlamaTokenizer.from_pretrained('lmsys/vicuna-7b-v1.5')
+    tokenizer.pad_token_id = 0 # vicuna has no pad token, pad with <unk> as in the CogVLM batch inference example
+    tokenizer.padding_side = 'left' # left padding so that generated tokens of every image start at the same position
 
-# Create json file
-output_json_path = f'./cogvlm_{args.proc_num}.json'
-if not os.path.exists(output_json_path):
-    with open(output_json_path, "w") as f:
-        json.dump({}, f)  # Create an empty JSON structure
+    model = AutoModelForCausalLM.from_pretrained(
+        'THUDM/cogvlm-chat-hf',
+        low_cpu_mem_usage=True,
+        # load_in_4bit=True,
+        trust_remote_code=True,
+        # device_map='auto',
+        torch_dtype=torch.float16,
+        # quantization_config=BitsAndBytesConfig(
+        #     load_in_4bit=True,
+        #     bnb_4bit_use_double_quant=True,
+        #     bnb_4bit_quant_type="nf4",
+        #     bnb_4bit_compute_dtype=torch.float16
+        # )
+    ).eval().to(device)
+    return model, tokenizer
 
-with open(output_json_path, "r") as f:
-    progress_data = json.load(f)
 
-batch = {}
-save_every = args.save_every
+def load_progress(output_path):
+    '''
+    Captions written so far: the legacy cogvlm_{proc_num}.json and the cogvlm_{proc_num}.jsonl written incrementally.
+    '''
+    progress_data = {}
+    json_path = output_path[:-len('.jsonl')] + '.json'
+    for path in (json_path, output_path):
+        if os.path.exists(path):
+            progress_data.update(load_caption_file(path))
+    return progress_data
 
-caption_rate_fps = 0.5
-DEVICE = model.device
 
-iterator = tqdm.tqdm(enumerate(vids), total=len(vids))
-for i, vid in iterator:
+def decode_video(vid, model, tokenizer):
+    '''
+    Decodes all caption frames of a video in one get_batch call (no seek per frame) and builds the CogVLM inputs of every frame.
+    Runs in the decode threads, so image preprocessing overlaps with generation on the GPU.
+    Returns (video name, list of model inputs or None, error message or None).
+    '''
     vid_name = vid.split('/')[-1][:-4]
+    try:
+        vr = VideoReader(vid, ctx=cpu(0))
+        num_frames, fps = len(vr), vr.get_avg_fps()
+        num_captions = int(num_frames / fps / caption_rate_fps)
+        num_captions = 1 if num_captions == 0 else num_captions
 
-    # check video is not corrupt. greater than 150 bytes
-    if os.path.getsize(vid) < 150:
-        continue
+        frame_idxs = np.linspace(0, num_frames - 1, num_captions, dtype=int)
+        frames = vr.get_batch(frame_idxs).asnumpy() # RGB
 
-    if vid_name in progress_data:
-        continue
+        features = []
+        for frame in frames:
+            image = PIL.Image.fromarray(frame).convert('RGB')
+            features.append(model.build_conversation_input_ids(tokenizer, query=query, history=[], images=[image]))
+        return vid_name, features, None
+    except Exception as e:
+        return vid_name, None, str(e)
 
-    cap = cv2.VideoCapture(vid)
-    num_frames, fps = int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS)
-    num_captions = int(num_frames / fps / caption_rate_fps)
-    num_captions = 1 if num_captions == 0 else num_captions
 
-    frame_idxs = np.linspace(0, num_frames - 1, num_captions, dtype=int)
+def iter_decoded_videos(vids, model, tokenizer, num_threads=4, prefetch=8):
+    '''
+    Yields decode_video results in order, keeping up to prefetch videos decoding ahead of the consumer.
+    '''
+    with ThreadPoolExecutor(num_threads) as executor:
+        futures = deque()
+        for vid in vids:
+            futures.append(executor.submit(decode_video, vid, model, tokenizer))
+            if len(futures) >= prefetch:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
 
-    batch[vid_name] = []
 
-    try:
-        for frame_idx in frame_idxs:
-            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-            ret, frame = cap.read()
-            if not ret:
-                continue
-
-            image = PIL.Image.fromarray(frame[..., ::-1]).convert('RGB')
-
-            input_by_model = model.build_conversation_input_ids(tokenizer, query=query, history=[], images=[image])
-
-            inputs = {
-                'input_ids': input_by_model['input_ids'].unsqueeze(0).to(DEVICE),
-                'token_type_ids': input_by_model['token_type_ids'].unsqueeze(0).to(DEVICE),
-                'attention_mask': input_by_model['attention_mask'].unsqueeze(0).to(DEVICE),
-                'images': [[input_by_model['images'][0].to(DEVICE).to(torch.float16)]] if image is not None else None,
-            }
-
-            with torch.no_grad():
-                s = time.time()
-                outputs = model.generate(**inputs, **gen_kwargs)
-                # print('Forward time:', time.time() - s)
-
-                outputs = outputs[:, inputs['input_ids'].shape[1]:]
-                response = tokenizer.decode(outputs[0])
-                response = response.split("</s>")[0]
-                batch[vid_name].append(response)
-            
-            iterator.set_description(f'Caption {len(batch[vid_name])}/{num_captions}')
-    except Exception as e:
-        print(f'Error processing {vid_name}: {e}')
-        batch[vid_name] = f'failed to get caption with exception {e}'
+def caption_batch(model, tokenizer, features, device):
+    '''
+    Captions several images with one generate call. Prompts are left padded to the same length.
+    '''
+    images = [[feature['images'][0].to(device).to(torch.float16)] for feature in features]
+    padded = tokenizer.pad([{
+        'input_ids': feature['input_ids'],
+        'token_type_ids': feature['token_type_ids'],
+        'attention_mask': feature['attention_mask'],
+    } for feature in features], return_tensors='pt')
+
+    inputs = {
+        'input_ids': padded['input_ids'].to(device),
+        'token_type_ids': padded['token_type_ids'].to(device),
+        'attention_mask': padded['attention_mask'].to(device),
+        'images': images,
+    }
+
+    with torch.no_grad():
+        outputs = model.generate(**inputs, **gen_kwargs)
+    outputs = outputs[:, inputs['input_ids'].shape[1]:]
+
+    responses = []
+    for output in outputs:
+        response = tokenizer.decode(output)
+        responses.append(response.split("</s>")[0])
+    return responses
+
+
+class CaptionWriter(object):
+    '''
+    Collects the captions of the images of a batch per video and appends a JSONL record once all captions of a video are done.
+    '''
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.captions = {}
+        self.remaining = {}
+        self.num_written = 0
+
+    def add_video(self, vid_name, num_captions):
+        self.captions[vid_name] = [None] * num_captions
+        self.remaining[vid_name] = num_captions
+        if num_captions == 0:
+            self.write(vid_name, [])
+
+    def add_caption(self, vid_name, caption_idx, caption):
+        if vid_name not in self.captions: # failed earlier
+            return
+        self.captions[vid_name][caption_idx] = caption
+        self.remaining[vid_name] -= 1
+        if self.remaining[vid_name] == 0:
+            self.write(vid_name, self.captions.pop(vid_name))
+            del self.remaining[vid_name]
+
+    def fail(self, vid_name, e):
+        self.captions.pop(vid_name, None)
+        self.remaining.pop(vid_name, None)
+        self.write(vid_name, f'failed to get caption with exception {e}')
+
+    def write(self, vid_name, captions):
+        with open(self.output_path, 'a') as f:
+            f.write(json.dumps({'video': vid_name, 'captions': captions}) + '\n')
+        self.num_written += 1
+
+
+class LeaseCaptionWriter(CaptionWriter):
+    '''
+    Stores the captions in the lease table instead of a JSONL file. Failed videos are given back to the table for another attempt.
+    '''
+    def __init__(self, table, worker_id):
+        super().__init__(None)
+        self.table = table
+        self.worker_id = worker_id
+
+    def fail(self, vid_name, e):
+        self.captions.pop(vid_name, None)
+        self.remaining.pop(vid_name, None)
+        self.table.fail(vid_name, e, self.worker_id)
+
+    def write(self, vid_name, captions):
+        self.table.complete(vid_name, captions, self.worker_id)
+        self.table.renew(self.worker_id) # the worker is alive, keep the leases of the videos in flight
+        self.num_written += 1
+
+
+def iter_claimed_videos(table, worker_id, claim_size):
+    '''
+    Yields video paths claimed from the lease table until no video is left.
+    '''
+    while True:
+        claimed = table.claim(worker_id, claim_size)
+        if not claimed:
+            return
+        for _, path in claimed:
+            yield path
+
+
+def caption_videos(vids, model, tokenizer, writer, batch_size=8, num_decode_threads=4, prefetch=8):
+    '''
+    Captions the videos with batches of batch_size images, an image batch can span several videos.
+    vids can be a list or an iterator of paths, e.g. iter_claimed_videos.
+    '''
+    device = model.device
+    pending = [] # (video name, caption index, model inputs)
+
+    def run_batch(batch):
+        try:
+            responses = caption_batch(model, tokenizer, [feature for _, _, feature in batch], device)
+        except Exception as e:
+            for vid_name in dict.fromkeys(vid_name for vid_name, _, _ in batch):
+                print(f'Error processing {vid_name}: {e}')
+                writer.fail(vid_name, e)
+            return
+        for (vid_name, caption_idx, _), response in zip(batch, responses):
+            writer.add_caption(vid_name, caption_idx, response)
+
+    iterator = tqdm.tqdm(iter_decoded_videos(vids, model, tokenizer, num_decode_threads, prefetch), total=len(vids) if hasattr(vids, '__len__') else None)
+    for vid_name, features, error in iterator:
+        if error is not None:
+            print(f'Error processing {vid_name}: {error}')
+            writer.fail(vid_name, error)
+            continue
+
+        writer.add_video(vid_name, len(features))
+        pending.extend((vid_name, caption_idx, feature) for caption_idx, feature in enumerate(features))
+        while len(pending) >= batch_size:
+            run_batch(pending[:batch_size])
+            pending = pending[batch_size:]
+        iterator.set_description(f'Videos done {writer.num_written}')
+
+    while pending:
+        run_batch(pending[:batch_size])
+        pending = pending[batch_size:]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proc_num', type=int, default=0, help='The process number of this job')
+    parser.add_argument('--num_procs', type=int, default=1, help='The total number of processes to run')
+    parser.add_argument('--stitched_vid_path', type=str, required=True)
+    parser.add_argument('--device', type=str, default=None, help='Device of the model, defaults to cuda:{proc_num modulo the number of GPUs}')
+    parser.add_argument('--batch_size', type=int, default=8, help='Number of images captioned by one generate call, images of several videos are batched together')
+    parser.add_argument('--num_decode_threads', type=int, default=4, help='Threads decoding videos while the GPU generates')
+    parser.add_argument('--prefetch', type=int, default=8, help='Number of videos decoded ahead of the GPU')
+    parser.add_argument('--lease_db', type=str, default=None,
+                        help='Shared SQLite lease table. Workers claim videos from it instead of using a fixed proc_num/num_procs partition, '
+                             'see caption_leases.py for merging the captions')
+    parser.add_argument('--claim_size', type=int, default=16, help='Number of videos claimed from the lease table at once')
+    parser.add_argument('--lease_seconds', type=float, default=3600, help='Videos of a worker that stopped renewing its leases are claimed again after this time')
+    args = parser.parse_args()
+
+    device = args.device if args.device is not None else f'cuda:{args.proc_num % torch.cuda.device_count()}'
+    model, tokenizer = load_model(device)
+
+    # Load video paths
+    vids = glob.glob(f'{args.stitched_vid_path}/*.mp4')
+
+    if args.lease_db is not None:
+        # check video is not corrupt. greater than 150 bytes
+        vids = [vid for vid in vids if os.path.getsize(vid) >= 150]
+
+        table = LeaseTable(args.lease_db, lease_seconds=args.lease_seconds)
+        table.add_videos(sorted(vids)) # a no-op for videos registered by other workers
+        worker_id = get_worker_id(device)
+        try:
+            caption_videos(iter_claimed_videos(table, worker_id, args.claim_size), model, tokenizer, LeaseCaptionWriter(table, worker_id),
+                           args.batch_size, args.num_decode_threads, args.prefetch)
+        finally:
+            table.release(worker_id)
+            print(table.counts())
+            table.close()
+    else:
+        random.shuffle(vids) # seed is set above, so multiproc is okay
+
+        partition_size = len(vids) // args.num_procs
+        if args.proc_num == args.num_procs - 1: # last process
+            vids = vids[args.proc_num * partition_size:]
+        else:
+            vids = vids[args.proc_num * partition_size: (args.proc_num + 1) * partition_size]
 
-    if len(batch) >= save_every or i == len(vids) - 1:
-        progress_data.update(batch)
+        # check video is not corrupt. greater than 150 bytes. Filtered after partitioning, so the partition of a worker
+        # does not depend on the corrupt files and matches its existing cogvlm_{proc_num} output
+        vids = [vid for vid in vids if os.path.getsize(vid) >= 150]
 
-        with open(output_json_path, "w") as f:
-            json.dump(progress_data, f, indent=4)
+        # Captions are appended to a jsonl file as soon as all captions of a video are done, so an interrupted run loses at most the videos in flight
+        output_path = f'./cogvlm_{args.proc_num}.jsonl'
+        progress_data = load_progress(output_path)
+        vids = [vid for vid in vids if vid.split('/')[-1][:-4] not in progress_data]
 
-        batch = {}
+        caption_videos(vids, model, tokenizer, CaptionWriter(output_path), args.batch_size, args.num_decode_threads, args.prefetch)
 
-    cap.release()
\ No newline at end of file
+        # Write the combined cogvlm_{proc_num}.json as before
+        with open(f'./cogvlm_{args.proc_num}.json', 'w') as f:
+            json.dump(load_progress(output_path), f, indent=4)
@@ -1,10 +1,11 @@
-import openai
 import os
 import json
-import ast
+import asyncio
 import argparse
 import warnings
-from tqdm import tqdm
+
+from llm_client import JsonlCheckpoint, add_client_args, client_from_args, run_annotations
+from structured_output import QAGenerator
 
 # Suppressing all warnings
 warnings.filterwarnings('ignore')
@@ -16,96 +17,97 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Descriptive question-answer-generation-using-GPT-3")
     parser.add_argument("--step3_description_json", required=True, help="Path to the image captions from step3.")
     parser.add_argument('--action_mapping_json', type=str, required=True, help='Path to action mapping JSON file')
-    parser.add_argument("--openai_api_key", required=True, help="OpenAI API key.")
+    parser.add_argument("--openai_api_key", default=None, help="OpenAI API key, not needed for local endpoints.")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Completions per video until one can be parsed.")
+    parser.add_argument("--no_json_mode", action="store_true", help="Do not request JSON mode (response_format), for endpoints without support.")
+    parser.add_argument("--require_all", action="store_true", help="Only write dense_descriptions.json once every video is described.")
+    add_client_args(parser)
     return parser.parse_args()
 
-def annotate(captions, action_sequence):
+def build_messages(captions, action_sequence):
+    mega_caption = " ".join(captions) + "\n"
+
+    return [
+        {
+            "role": "system",
+            "content": ("You will play two roles: a human asking questions related to describing a video and "
+                        "an intelligent chatbot designed for video description and dense captioning. "
+                        "Your task is to generate a detailed and descriptive paragraph based on the provided fragmented information about a video. "
+                        "------"
+                        "##TASK:"
+                        "Users will provide fragmented descriptions of a video, and you will generate ONE conversation-like question and answer related to describing the video in detail. "
+                        "The question should ask to describe the video content in detail. "
+                        "The answer should be a paraphrased and well-structured paragraph based on the provided description, with a minimum of 150 words and a maximum of 300 words. "
+                        "When the provided information is short, aim for a 150-word description, and when the provided information is more detailed, aim for very long descriptions up to 300-word description. "
+                        "------"
+                        "##INSTRUCTIONS:"
+                        "- The question must be like a human conversation and focused on describing the video in detail. "
+                        "- The answer must be a paraphrased version of the provided information, very detailed and descriptive, and within the specified word count. "
+                        "- Combine the information from different sections of the video into a single coherent summary, ignoring any repetitions."
+                        "- Compare the information across all fragments of video and remove or ignore any inconsistent information and do not say the summary comes from different fragments of the video."
+                        "- Give more emphasis on the actions, the objects, and the colors of the background and the objects."
+                        "- Give the sequence of actions happening in the video and the objects the person interacts with.")
+        },
+        {
+            "role": "user",
+            "content": f"The fragmented video description is: {mega_caption}. The actions performed in the video are: {action_sequence}. "
+                       '''Please generate the response in the form of a Python dictionary string with keys "Q" for question and "A" for answer. Each corresponding value should be the question and answer text respectively.'''
+                       '''For example, your response should look like this: {"Q": "Your question here...", "A": "Your answer here..."}.'''
+                       '''Emphasize that the answer should focus on describing the video content following the given instructions.'''
+        }
+    ]
+
+async def annotate(generator, captions, action_sequence):
     """
-    Generates question and answer pairs based on video captions using OpenAI GPT-3 and returns the response dictionary.
+    Generates question and answer pairs based on video captions and returns the response dictionary,
+    or None if no response could be parsed, so the video is retried by the next run.
     """
-    mega_caption = " ".join(captions) + "\n"
-    
-    # Generate completion with OpenAI GPT-3
-    try:
-        completion = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": ("You will play two roles: a human asking questions related to describing a video and "
-                                "an intelligent chatbot designed for video description and dense captioning. "
-                                "Your task is to generate a detailed and descriptive paragraph based on the provided fragmented information about a video. "
-                                "------"
-                                "##TASK:"
-                                "Users will provide fragmented descriptions of a video, and you will generate ONE conversation-like question and answer related to describing the video in detail. "
-                                "The question should ask to describe the video content in detail. "
-                                "The answer should be a paraphrased and well-structured paragraph based on the provided description, with a minimum of 150 words and a maximum of 300 words. "
-                                "When the provided information is short, aim for a 150-word description, and when the provided information is more detailed, aim for very long descriptions up to 300-word description. "
-                                "------"
-                                "##INSTRUCTIONS:"
-                                "- The question must be like a human conversation and focused on describing the video in detail. "
-                                "- The answer must be a paraphrased version of the provided information, very detailed and descriptive, and within the specified word count. "
-                                "- Combine the information from different sections of the video into a single coherent summary, ignoring any repetitions."
-                                "- Compare the information across all fragments of video and remove or ignore any inconsistent information and do not say the summary comes from different fragments of the video."
-                                "- Give more emphasis on the actions, the objects, and the colors of the background and the objects."
-                                "- Give the sequence of actions happening in the video and the objects the person interacts with.")
-                },
-                {
-                    "role": "user",
-                    "content": f"The fragmented video description is: {mega_caption}. The actions performed in the video are: {action_sequence}. "
-                               '''Please generate the response in the form of a Python dictionary string with keys "Q" for question and "A" for answer. Each corresponding value should be the question and answer text respectively.'''
-                               '''For example, your response should look like this: {"Q": "Your question here...", "A": "Your answer here..."}.'''
-                               '''Emphasize that the answer should focus on describing the video content following the given instructions.'''
-                }
-            ],
+    qa_items = await generator.generate(build_messages(captions, action_sequence), num_items=1)
+    return qa_items[0] if qa_items else None
+
+async def annotate_all(args, image_captions, action_mappings, checkpoint):
+    async with client_from_args(args, args.openai_api_key) as client:
+        generator = QAGenerator(client, json_mode=not args.no_json_mode, max_attempts=args.max_attempts)
+        items = [(video_id, (descriptions, action_mappings[video_id])) for video_id, descriptions in image_captions.items()]
+        return await run_annotations(
+            items, lambda payload: annotate(generator, *payload), checkpoint, desc='Describing videos'
         )
-        try:
-            response_data = completion.choices[0].message.content
-            response_dict = ast.literal_eval(response_data)
-        except (SyntaxError, ValueError) as e:
-            print(f"Error parsing response data: {e}. Skipping this item.")
-            response_dict = {"error": "Failed to parse response data."}
-    except openai.error.RateLimitError as e:
-        print(f"OpenAI API rate limit exceeded: {e}. Skipping this item.")
-        response_dict = {"error": "OpenAI API rate limit exceeded."}
-    except Exception as e:
-        print(f"An error occurred: {e}. Skipping this item.")
-        response_dict = {"error": "An unknown error occurred."}
-    
-    return response_dict
 
 def main():
     args = parse_args()
     
     combined_output_path = './dense_descriptions.json'
-    
-    # Check if dense_descriptions.json already exists
-    if os.path.exists(combined_output_path):
-        print(f"dense_descriptions.json already exists at {combined_output_path}. Skipping processing.")
-        return
-    
+
     with open(args.step3_description_json) as file:
         image_captions = json.load(file)
 
     with open(args.action_mapping_json) as file:
         action_mappings = json.load(file)
-    
-    openai.api_key = args.openai_api_key  # Replace with your actual API key
-    
-    combined_annotations = {}
-    save_interval = 10  # Save progress every 10 videos
-    
-    for idx, (video_id, descriptions) in enumerate(tqdm(image_captions.items())):
-        aciton_sequence = action_mappings[video_id]
-        response_dict = annotate(descriptions, aciton_sequence)
-        combined_annotations[video_id] = response_dict
-        
-        # Save progress periodically
-        if (idx + 1) % save_interval == 0 or (idx + 1) == len(image_captions):
-            with open(combined_output_path, "w") as f:
-                json.dump(combined_annotations, f, indent=4)
-
-    print(f"Completed, all annotations saved in {combined_output_path}")
+
+    # Skip only if dense_descriptions.json already has every video, a partial one is completed by this run
+    if os.path.exists(combined_output_path):
+        with open(combined_output_path) as file:
+            if set(image_captions) <= set(json.load(file)):
+                print(f"dense_descriptions.json already exists at {combined_output_path}. Skipping processing.")
+                return
+
+    # Every finished video is appended to the checkpoint, a rerun only annotates the missing videos
+    checkpoint = JsonlCheckpoint('./dense_descriptions.jsonl')
+    num_failed = asyncio.run(annotate_all(args, image_captions, action_mappings, checkpoint))
+    checkpoint.close()
+
+    if num_failed > 0 and args.require_all:
+        print(f"{num_failed} videos failed, run again to retry them. Annotations so far are in {checkpoint.path}")
+        return
+
+    combined_annotations = {video_id: checkpoint.results[video_id] for video_id in image_captions if video_id in checkpoint.results}
+    with open(combined_output_path, "w") as f:
+        json.dump(combined_annotations, f, indent=4)
+
+    if num_failed > 0:
+        print(f"{num_failed} videos failed and are missing from {combined_output_path}, run again to retry them.")
+    else:
+        print(f"Completed, all annotations saved in {combined_output_path}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,201 @@
+"""
+Structured question-answer output for the step4 and step5 generation scripts.
+
+Responses are requested in JSON mode where the endpoint supports it. Whatever comes back is parsed
+incrementally: every complete {"Q": ..., "A": ...} object is kept, even when the response is wrapped
+in text or code fences, uses Python quoting or was cut off in the middle of a later item. When fewer
+items than requested could be recovered, the model is asked for the missing items only, in the same
+conversation, instead of regenerating the whole response. After max_attempts requests the items
+recovered so far are returned, so a malformed response never stalls the pipeline.
+"""
+import ast
+import asyncio
+import json
+
+from llm_client import RequestError
+
+QUESTION_KEYS = ('q', 'question')
+ANSWER_KEYS = ('a', 'answer')
+
+JSON_LIST_FORMAT = ('Return the question and answer pairs as a JSON object of the form '
+                    '{"qa_pairs": [{"Q": "...", "A": "..."}, ...]}.')
+JSON_ITEM_FORMAT = 'Return the question and answer pair as a JSON object of the form {"Q": "...", "A": "..."}.'
+
+
+def normalize_qa_item(obj):
+    """
+    Returns {"Q": question, "A": answer} for a dict with non-empty question and answer strings
+    (keys "Q"/"A" or "question"/"answer" in any case), None otherwise.
+    """
+    if not isinstance(obj, dict):
+        return None
+    keys = {str(k).strip().lower(): v for k, v in obj.items()}
+    question = next((keys[k] for k in QUESTION_KEYS if k in keys), None)
+    answer = next((keys[k] for k in ANSWER_KEYS if k in keys), None)
+    if not isinstance(question, str) or not isinstance(answer, str) or not question.strip() or not answer.strip():
+        return None
+    return {'Q': question.strip(), 'A': answer.strip()}
+
+
+def _load(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (SyntaxError, ValueError, MemoryError, RecursionError):
+        return None
+
+
+def _items_of(value):
+    """
+    QA items of a parsed response: a single item, a list of items, or an object wrapping a list (JSON mode).
+    """
+    item = normalize_qa_item(value)
+    if item is not None:
+        return [item]
+    if isinstance(value, dict):
+        value = next((v for v in value.values() if isinstance(v, list)), None)
+    if isinstance(value, list):
+        return [item for item in map(normalize_qa_item, value) if item is not None]
+    return []
+
+
+def iter_complete_objects(text):
+    """
+    Yields the text of every brace-delimited object whose closing brace is found, innermost objects first.
+    Braces inside single or double quoted strings are ignored, so the scan survives truncated responses.
+    """
+    stack = []
+    quote = None
+    escaped = False
+    for i, char in enumerate(text):
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in '"\'':
+            # an apostrophe between two letters is part of a word, not a string delimiter
+            if char == "'" and 0 < i < len(text) - 1 and text[i - 1].isalpha() and text[i + 1].isalpha():
+                continue
+            quote = char
+        elif char == '{':
+            stack.append(i)
+        elif char == '}' and stack:
+            yield text[stack.pop():i + 1]
+
+
+def parse_qa_items(response):
+    """
+    Valid QA items of a response, in order. A fully parseable response is used as is, otherwise
+    every complete QA object found by iter_complete_objects is kept.
+    """
+    if not isinstance(response, str):
+        return []
+    text = response.strip()
+    # code fences and text around the payload
+    starts = [i for i in (text.find('['), text.find('{')) if i != -1]
+    if not starts:
+        return []
+    text = text[min(starts):]
+    end = max(text.rfind(']'), text.rfind('}'))
+    if end != -1:
+        items = _items_of(_load(text[:end + 1]))
+        if items:
+            return items
+
+    items = []
+    for obj_text in iter_complete_objects(text):
+        item = normalize_qa_item(_load(obj_text))
+        if item is not None:
+            items.append(item)
+    return items
+
+
+def missing_items_prompt(num_missing, received_items):
+    received = ' '.join(f'"{item["Q"]}"' for item in received_items)
+    prompt = f'Your response was incomplete or could not be parsed. Generate {num_missing} more question and answer pair{"s" if num_missing > 1 else ""} following the same instructions'
+    if received_items:
+        prompt += f', different from the questions you already asked: {received}'
+    return prompt + '. ' + JSON_LIST_FORMAT
+
+
+class QAGenerator(object):
+    """
+    Requests QA items from an AsyncChatClient.
+
+    json_mode asks the endpoint for a JSON object (response_format json_object). It is switched off for the
+    rest of the run if the endpoint rejects it: a 400 of the first JSON mode request that the same request without
+    JSON mode does not get, or a later 400 about response_format. Other errors are raised.
+    """
+    def __init__(self, client, json_mode=True, max_attempts=3):
+        self.client = client
+        self.json_mode = json_mode
+        self.max_attempts = max_attempts
+        self.num_requests = 0
+        self.num_repaired = 0
+        self._json_mode_checked = False
+        self._json_mode_lock = None
+
+    async def _chat_json_mode(self, messages):
+        try:
+            response = await self.client.chat(messages, response_format={'type': 'json_object'})
+        except RequestError as e:
+            # a 400 is also what a prompt over the context length gets, only an error of the unverified first JSON mode
+            # request or one about response_format means that the endpoint does not support JSON mode
+            if 'HTTP 400' not in str(e) or (self._json_mode_checked and 'response_format' not in str(e)):
+                raise
+            # raises if the request is rejected without JSON mode as well, JSON mode is then kept
+            response = await self.client.chat(messages)
+            print(f'Endpoint rejected JSON mode, continuing without it: {e}')
+            self.json_mode = False
+            return response
+        self._json_mode_checked = True
+        return response
+
+    async def _chat(self, messages):
+        self.num_requests += 1
+        if self.json_mode and not self._json_mode_checked:
+            # the first request finds out whether the endpoint supports JSON mode, the others wait for it
+            if self._json_mode_lock is None:
+                self._json_mode_lock = asyncio.Lock()
+            async with self._json_mode_lock:
+                if self.json_mode and not self._json_mode_checked:
+                    return await self._chat_json_mode(messages)
+        if self.json_mode:
+            return await self._chat_json_mode(messages)
+        return await self.client.chat(messages)
+
+    async def generate(self, messages, num_items, min_items=1):
+        """
+        Parameters:
+        messages (list): Chat messages asking for num_items QA pairs.
+        num_items (int): Number of QA pairs asked for.
+        min_items (int): Fewest items accepted once max_attempts requests are used up.
+
+        Returns:
+        list: Up to num_items {"Q", "A"} dicts, or None if fewer than min_items could be recovered.
+        """
+        format_instruction = JSON_LIST_FORMAT if num_items > 1 else JSON_ITEM_FORMAT
+        first_messages = messages[:-1] + [{**messages[-1], 'content': messages[-1]['content'] + ' ' + format_instruction}]
+
+        items = []
+        conversation = first_messages
+        for attempt in range(self.max_attempts):
+            response = await self._chat(conversation)
+            new_items = parse_qa_items(response)
+            if attempt > 0 and new_items:
+                self.num_repaired += 1
+            items.extend(new_items[:num_items - len(items)])
+            if len(items) >= num_items:
+                return items
+            # ask only for the missing items, in the same conversation
+            conversation = first_messages + [
+                {'role': 'assistant', 'content': response},
+                {'role': 'user', 'content': missing_items_prompt(num_items - len(items), items)},
+            ]
+        return items if len(items) >= min_items else None
@@ -21,6 +21,8 @@ def parse_args():
     parser.add_argument('--max_new_tokens', type=int, default=1024, help='Maximum number of new tokens.')
     parser.add_argument("--debug", action='store_true', help='Debug mode.')
     parser.add_argument("--seed", type=int, default=127, help='Random seed.')
+    parser.add_argument("--mcq_parser", type=str, default='tiered', choices=['tiered', 'llm'], help='tiered: regex, string and fuzzy matching before falling back to the LLM. llm: always ask the LLM.')
+    parser.add_argument("--mcq_embedding_model", type=str, default=None, help='sentence-transformers model for the embedding tier of the tiered parser. Disabled by default.')
     return parser.parse_args()
 
 def main():
@@ -48,6 +50,9 @@ def main():
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
+    embedder = mcq_parsing_llm.SentenceEmbedder(args.mcq_embedding_model) if args.mcq_embedding_model else None
+    mcq_parser = mcq_parsing_llm.MCQParser(embedder=embedder, local=args.mcq_parser == 'tiered')
+
     correct_count = 0
     total_count = 0
 
@@ -56,6 +61,9 @@ def main():
     else:
         iterator = enumerate(qa_data)
 
+    # each rank writes its own shard as it goes, only the counters go through the process group
+    shard_writer = ShardWriter(args.output_dir, args.output_name, global_rank)
+
     for i, sample in iterator:
         total_count += 1
 
@@ -63,6 +71,8 @@ def main():
         
         if not os.path.exists(video_path):
             print(f"Video file '{video_path}' does not exist.")
+            shard_writer.write(sample)
+            qa_data[i] = None
             continue
 
         video_frames = load_video(video_path)
@@ -81,9 +91,9 @@ def main():
             prediction = model_infer(video_frames, full_question, conv_mode, model, vision_tower, tokenizer, image_processor, video_token_len, max_new_tokens=args.max_new_tokens)
             qa_data[i]['prediction'] = prediction
 
-            prompt = mcq_parsing_llm.build_prompt(question, choices_str, prediction)
-            parsed_letter_answer_from_llm, llm_out = mcq_parsing_llm.parse_with_llama(prompt)
+            parsed_letter_answer_from_llm, parse_tier, llm_out = mcq_parser.parse(question, choices_str, prediction)
             qa_data[i]['parsed_answer_from_llm'] = parsed_letter_answer_from_llm
+            qa_data[i]['parse_tier'] = parse_tier
 
             if args.debug and local_rank == 0:
                 print(f"\n{'='*16} Question {'='*16}")
@@ -91,42 +101,39 @@ def main():
                 print(f"\n{'='*16} Answer from LLM {'='*16}")
                 print(prediction)
                 print(f"\n{'='*16} Predicted/true ans {'='*16}")
-                print(f'{parsed_letter_answer_from_llm} / {ground_truth_letter}\n')
+                print(f'{parsed_letter_answer_from_llm} / {ground_truth_letter} (parsed by {parse_tier})\n')
             
             if parsed_letter_answer_from_llm == ground_truth_letter:
                 correct_count += 1 
         except Exception as e:
             print(f"Error processing video file '{video_path}': {str(e)}")
+            shard_writer.write(sample)
+            qa_data[i] = None
             continue
 
+        # the record lives in the shard from here on
+        shard_writer.write(sample)
+        qa_data[i] = None
+
         if not args.debug or local_rank == 0:
             iterator.set_description(f"{args.output_name} (process {local_rank}) Accuracy: {correct_count / total_count * 100:.2f}%")
 
     print(f"Final Accuracy (process {local_rank}): {correct_count / total_count * 100:.2f}")
+    print(f"Answers parsed per tier (process {local_rank}): {dict(mcq_parser.tier_counts)}")
     #### End of run_inference code ####
 
     del model
     torch.cuda.empty_cache()
 
-    results = [correct_count, total_count, qa_data]
+    shard_writer.close()
 
-    gathered_results = [None for _ in range(dist.get_world_size())]
-    dist.gather_object(
-        obj=results,
-        object_gather_list=gathered_results if global_rank == 0 else None,
-        dst=0,
-    )
+    # all_reduce also acts as a barrier, so every shard is complete once it returns
+    correct_count, total_count = reduce_counters([correct_count, total_count])
 
     if global_rank == 0:
-        correct_count = sum([result[0] for result in gathered_results])
-        total_count = sum([result[1] for result in gathered_results])
-        qa_data = []
-        for result in gathered_results:
-            qa_data.extend(result[2])
-
         print(f"Final Accuracy (all processes): {correct_count / total_count * 100:.2f}%")
         save_log_file(args.output_dir, args.output_name, correct_count, total_count, args)
-        save_to_json(args.output_dir, f"{args.output_name}.json", qa_data)
+        save_to_json(args.output_dir, args.output_name, world_size)
 
     dist.barrier()
     dist.destroy_process_group()
@@ -141,10 +148,10 @@ def split_data(qa_data, num_processes, process_id):
 
     return qa_data
 
-def save_to_json(output_dir, output_name, data):
-    output_path = os.path.join(output_dir, output_name)
-    with open(output_path, 'w') as file:
-        json.dump(data, file, indent=4)
+def save_to_json(output_dir, output_name, num_shards):
+    # stream the per-rank shards into the final JSON instead of building the full list in memory
+    output_path = os.path.join(output_dir, f"{output_name}.json")
+    merge_shards(get_shard_dir(output_dir, output_name), output_path, num_shards=num_shards, remove_shards=True)
 
 def save_log_file(output_dir, output_name, correct_count, total_count, args):
     log_path = os.path.join(output_dir, f"{output_name}.log")
@@ -163,5 +170,6 @@ if __name__ == "__main__":
 
     from llavidal.eval.model_utils import initialize_model, load_video
     from llavidal.inference import llavidal_infer as model_infer
+    from llavidal.eval.result_shards import ShardWriter, reduce_counters, merge_shards, get_shard_dir
 
     main()
\ No newline at end of file
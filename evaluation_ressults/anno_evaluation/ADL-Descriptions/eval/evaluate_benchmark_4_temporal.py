@@ -5,6 +5,16 @@ import json
 import ast
 from multiprocessing.pool import Pool
 import ollama
+from llavidal.eval.judge_cache import JudgeCache, DEFAULT_JUDGE_CACHE_PATH
+from llavidal.eval.task_ledger import TaskLedger, get_ledger_path
+from llavidal.eval.batched_judge import judge_in_batches
+
+JUDGE_MODEL = "llama3.1"
+
+
+def judge_chat(messages):
+    completion = ollama.chat(model=JUDGE_MODEL, messages=messages)
+    return completion["message"]["content"]
 
 
 def parse_args():
@@ -13,60 +23,87 @@ def parse_args():
     parser.add_argument("--output_dir", required=True, help="The path to save annotation json files.")
     parser.add_argument("--output_json", required=True, help="The path to save annotation final combined json file.")
     parser.add_argument("--num_tasks", required=True, type=int, help="Number of splits.")
+    parser.add_argument("--judge_cache", default=DEFAULT_JUDGE_CACHE_PATH, help="Path to the judge response cache shared by all metrics. Pass an empty string to disable it.")
+    parser.add_argument("--judge_batch_size", default=1, type=int, help="Number of question-answer pairs scored by one judge request. 1 keeps one request per pair.")
     args = parser.parse_args()
     return args
 
 
-def annotate(prediction_set, caption_files, output_dir):
+def build_messages(qa_set):
+    """
+    Judge messages for one question-answer pair.
+    """
+    question = qa_set['q']
+    answer = qa_set['a']
+    pred = qa_set['pred']
+    return [
+        {
+            "role": "system",
+            "content":
+                "You are an intelligent chatbot designed for evaluating the temporal understanding of generative outputs for video-based question-answer pairs. "
+                "Your task is to compare the predicted answer with the correct answer and determine if they correctly reflect the temporal sequence of events in the video content. Here's how you can accomplish the task:"
+                "------"
+                "##INSTRUCTIONS: "
+                "- Focus on the temporal consistency between the predicted answer and the correct answer. The predicted answer should correctly reflect the sequence of events or details as they are presented in the video content.\n"
+                "- Consider synonyms or paraphrases as valid matches, but only if the temporal order is maintained.\n"
+                "- Evaluate the temporal accuracy of the prediction compared to the answer."
+        },
+        {
+            "role": "user",
+            "content":
+                "Please evaluate the following video-based question-answer pair:\n\n"
+                f"Question: {question}\n"
+                f"Correct Answer: {answer}\n"
+                f"Predicted Answer: {pred}\n\n"
+                "Provide your evaluation only as a temporal accuracy score where the temporal accuracy score is an integer value between 0 and 5, with 5 indicating the highest level of temporal consistency. "
+                "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the temporal accuracy score in INTEGER, not STRING."
+                "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
+                "For example, your response should look like this: {''score': 4.8}."
+        }
+    ]
+
+
+def annotate(prediction_set, task_ids, ledger_path, judge_cache_path=None, judge_batch_size=1):
     """
     Evaluates question and answer pairs using GPT-3 and
     returns a score for temporal understanding.
     """
-    for file in caption_files:
-        key = file[:-5] # Strip file extension
+    judge_cache = JudgeCache(judge_cache_path)
+    ledger = TaskLedger(ledger_path)
+
+    if judge_batch_size > 1:
+        # several pairs per judge request, the pairs the batched judge could not score go through the single-pair judge below
+        items = [(key, build_messages(prediction_set[key])) for key in task_ids]
+        scores, responses, task_ids = judge_in_batches(items, judge_chat, batch_size=judge_batch_size, cache=judge_cache,
+                                                       metric='temporal', model=JUDGE_MODEL)
+        for key, score in scores.items():
+            ledger.record(key, [{'score': score}, prediction_set[key]], response=responses[key], score=score)
+        ledger.flush()
+
+    for key in task_ids:
         qa_set = prediction_set[key]
         question = qa_set['q']
         answer = qa_set['a']
         pred = qa_set['pred']
         try:
-            completion = ollama.chat(
-                model="llama3.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content":
-                            "You are an intelligent chatbot designed for evaluating the temporal understanding of generative outputs for video-based question-answer pairs. "
-                            "Your task is to compare the predicted answer with the correct answer and determine if they correctly reflect the temporal sequence of events in the video content. Here's how you can accomplish the task:"
-                            "------"
-                            "##INSTRUCTIONS: "
-                            "- Focus on the temporal consistency between the predicted answer and the correct answer. The predicted answer should correctly reflect the sequence of events or details as they are presented in the video content.\n"
-                            "- Consider synonyms or paraphrases as valid matches, but only if the temporal order is maintained.\n"
-                            "- Evaluate the temporal accuracy of the prediction compared to the answer."
-                    },
-                    {
-                        "role": "user",
-                        "content":
-                            "Please evaluate the following video-based question-answer pair:\n\n"
-                            f"Question: {question}\n"
-                            f"Correct Answer: {answer}\n"
-                            f"Predicted Answer: {pred}\n\n"
-                            "Provide your evaluation only as a temporal accuracy score where the temporal accuracy score is an integer value between 0 and 5, with 5 indicating the highest level of temporal consistency. "
-                            "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the temporal accuracy score in INTEGER, not STRING."
-                            "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
-                            "For example, your response should look like this: {''score': 4.8}."
-                    }
-                ]
-            )
-            response_message = completion["message"]["content"]
+            messages = build_messages(qa_set)
+
+            # unchanged (prompt, inputs, judge model) triples are answered from the cache
+            response_message = judge_cache.get('temporal', JUDGE_MODEL, messages)
+            if response_message is None:
+                response_message = judge_chat(messages)
             response_dict = ast.literal_eval(response_message)
+            judge_cache.put('temporal', JUDGE_MODEL, messages, response_message)
             result_qa_pair = [response_dict, qa_set]
 
-            # Save the question-answer pairs to a json file.
-            with open(f"{output_dir}/{key}.json", "w") as f:
-                json.dump(result_qa_pair, f)
+            # Record the question-answer pair in the ledger, commits are batched.
+            ledger.record(key, result_qa_pair, response=response_message, score=response_dict.get('score'))
 
         except Exception as e:
             print(f"Error processing file '{key}': {e}")
+            ledger.record_failure(key, e)
+
+    ledger.close()
 
 
 def main():
@@ -98,7 +135,6 @@ def main():
 
     # Generating list of id's and corresponding files
     id_list = [x['video_name'] for x in new_pred_contents]
-    caption_files = [f"{id}.json" for id in id_list]
 
     output_dir = args.output_dir
     # Generate output directory if not exists.
@@ -118,46 +154,41 @@ def main():
     # Set the OpenAI API key.
     num_tasks = args.num_tasks
 
+    # Task ledger tracking which predictions are judged, resumes an interrupted run.
+    ledger_path = get_ledger_path(output_dir)
+    ledger = TaskLedger(ledger_path)
+    ledger.add_tasks(id_list)
+
     # While loop to ensure that all captions are processed.
     while True:
         try:
-            # Files that have not been processed yet.
-            completed_files = os.listdir(output_dir)
-            print(f"completed_files: {len(completed_files)}")
-
-            # Files that have not been processed yet.
-            incomplete_files = [f for f in caption_files if f not in completed_files]
-            print(f"incomplete_files: {len(incomplete_files)}")
+            # Predictions that have not been processed yet, a single indexed query.
+            incomplete_ids = ledger.pending_ids()
+            print(f"completed: {len(id_list) - len(incomplete_ids)}")
+            print(f"incomplete: {len(incomplete_ids)}")
 
-            # Break the loop when there are no incomplete files
-            if len(incomplete_files) == 0:
+            # Break the loop when there are no incomplete predictions
+            if len(incomplete_ids) == 0:
                 break
-            if len(incomplete_files) <= num_tasks:
+            if len(incomplete_ids) <= num_tasks:
                 num_tasks = 1
 
             # Split tasks into parts.
-            part_len = len(incomplete_files) // num_tasks
-            all_parts = [incomplete_files[i:i + part_len] for i in range(0, len(incomplete_files), part_len)]
-            task_args = [(prediction_set, part, args.output_dir) for part in all_parts]
+            part_len = len(incomplete_ids) // num_tasks
+            all_parts = [incomplete_ids[i:i + part_len] for i in range(0, len(incomplete_ids), part_len)]
+            task_args = [(prediction_set, part, ledger_path, args.judge_cache, args.judge_batch_size) for part in all_parts]
 
-            # Use a pool of workers to process the files in parallel.
+            # Use a pool of workers to process the predictions in parallel.
             with Pool() as pool:
                 pool.starmap(annotate, task_args)
 
-        except Exception as e: 
+        except Exception as e:
             print(f"Error: {e}")
 
-    # Combine all the processed files into one
-    combined_contents = {}
+    # Combine all the processed results into one with a single scan of the ledger
     json_path = args.output_json
-
-    # Iterate through json files
-    for file_name in os.listdir(output_dir):
-        if file_name.endswith(".json"):
-            file_path = os.path.join(output_dir, file_name)
-            with open(file_path, "r") as json_file:
-                content = json.load(json_file)
-                combined_contents[file_name[:-5]] = content
+    combined_contents = dict(ledger.iter_results())
+    ledger.close()
 
     # Write combined content to a json file
     with open(json_path, "w") as json_file:
@@ -27,6 +27,7 @@ def parse_args():
     parser.add_argument("--model-trained-with-base-videochatgpt", help='Model youre evaluating was trained with base videochatgpt code (changes how start/end tokens are loaded).', action='store_true')
     parser.add_argument("--max_new_tokens", type=int, default=1024, required=False, help='Maximum number of new tokens to generate.')
     parser.add_argument("--debug", action='store_true', help='Debug mode.')
+    parser.add_argument("--mcq_parser", type=str, default='tiered', choices=['tiered', 'llm'], help='tiered: regex, string and fuzzy matching before falling back to the LLM. llm: always ask the LLM.')
     return parser.parse_args()
 
 def save_to_json(output_dir, output_name, data):
@@ -66,6 +67,8 @@ def run_inference(process_id, args):
 
     conv_mode = args.conv_mode
 
+    mcq_parser = mcq_parsing_llm.MCQParser(local=args.mcq_parser == 'tiered')
+
     correct_count = 0
     total_count = 0
 
@@ -111,9 +114,9 @@ def run_inference(process_id, args):
                     print('========================================')
                 qa_data[i]['prediction'] = prediction
 
-                prompt = mcq_parsing_llm.build_prompt(question, choices_str, prediction)
-                letter_answer, llm_out = mcq_parsing_llm.parse_with_llama(prompt)
+                letter_answer, parse_tier, llm_out = mcq_parser.parse(question, choices_str, prediction)
                 qa_data[i]['parsed_answer_from_llm'] = letter_answer
+                qa_data[i]['parse_tier'] = parse_tier
 
                 if letter_answer == sample['answer']:
                     correct_count += 1
@@ -128,6 +131,7 @@ def run_inference(process_id, args):
             iterator.set_description(f"(process {process_id}) Accuracy: {correct_count / total_count * 100:.2f}%")
 
     print(f"Final Accuracy (process {process_id}): {correct_count / total_count * 100:.2f}")
+    print(f"Answers parsed per tier (process {process_id}): {dict(mcq_parser.tier_counts)}")
     #### End of run_inference code ####
 
     return (process_id, correct_count, total_count, qa_data)
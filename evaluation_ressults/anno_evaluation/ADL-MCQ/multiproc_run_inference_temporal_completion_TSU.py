@@ -23,6 +23,7 @@ def parse_args():
     parser.add_argument("--use-string-modality-prefix", help='Use string modality prefix for the model.', action='store_true')
     parser.add_argument("--model-trained-with-base-videochatgpt", help='Model youre evaluating was trained with base videochatgpt code (changes how start/end tokens are loaded).', action='store_true')
     parser.add_argument("--debug", action='store_true', help='Debug mode.')
+    parser.add_argument("--mcq_parser", type=str, default='tiered', choices=['tiered', 'llm'], help='tiered: regex, string and fuzzy matching before falling back to the LLM. llm: always ask the LLM.')
     return parser.parse_args()
 
 def save_to_json(output_dir, output_name, data):
@@ -53,6 +54,8 @@ def run_inference(process_id, args):
 
     conv_mode = args.conv_mode
 
+    mcq_parser = mcq_parsing_llm.MCQParser(local=args.mcq_parser == 'tiered')
+
     correct_count = 0
     total_count = 0
 
@@ -95,11 +98,11 @@ def run_inference(process_id, args):
                 result_dict['prediction'] = prediction
 
                 # Parse prediction using MCQ parsing
-                prompt = mcq_parsing_llm.build_prompt(question, choices_str, prediction)
-                letter_answer, llm_out = mcq_parsing_llm.parse_with_llama(prompt)
+                letter_answer, parse_tier, llm_out = mcq_parser.parse(question, choices_str, prediction)
                 
                 result_dict['parsed_answer'] = letter_answer
                 result_dict['llm_output'] = llm_out
+                result_dict['parse_tier'] = parse_tier
    
                 if letter_answer == ground_truth:
                     correct_count += 1
@@ -131,6 +134,7 @@ def run_inference(process_id, args):
             iterator.set_description(f"(process {process_id}) Accuracy: {correct_count / total_count * 100:.2f}%")
 
     print(f"Final Accuracy (process {process_id}): {correct_count / total_count * 100:.2f}%")
+    print(f"Answers parsed per tier (process {process_id}): {dict(mcq_parser.tier_counts)}")
     return (process_id, correct_count, total_count, processed_data)
 
 if __name__ == "__main__":
@@ -1,4 +1,4 @@
-import argparse, datetime, random, glob, json, time, sys, os
+import argparse, collections, datetime, random, glob, json, time, sys, os
 from tqdm import tqdm
 import numpy as np
 
@@ -24,6 +24,10 @@ def parse_args():
     parser.add_argument("--debug", action='store_true', help='Debug mode.')
     parser.add_argument("--seed", type=int, default=127, help='Random seed.')
     parser.add_argument("--openai_api_key", type=str, required=True, help='OpenAI API key for GPT-3.5 Turbo.')
+    parser.add_argument("--judge_host", type=str, default=None, help='Host of the Ollama server used as judge. Defaults to the local server.')
+    parser.add_argument("--judge_concurrency", type=int, default=8, help='Maximum number of judge requests in flight per process.')
+    parser.add_argument("--judge_batch_size", type=int, default=1, help='Number of pairs of the same metric scored by one judge request. 1 keeps one request per pair.')
+    parser.add_argument("--judge_cache", type=str, default=None, help='Path to the judge response cache shared by all metrics. Defaults to ~/.cache/llavidal/judge_cache.sqlite, pass an empty string to disable it.')
     return parser.parse_args()
 
 def main():
@@ -72,16 +76,21 @@ def main():
         iterator = enumerate(gt_data)
 
     # metrics
-    correctness_sum = 0
-    detail_orientation_sum = 0
-    contextual_sum = 0
-    temporal_sum = 0
-    consistency_sum = 0
+    score_sums = collections.Counter()
     total_count = 0
 
     # hardcoded description question
     desc_question = "Please describe the primary actions and interactions in the video, focusing on movements and the use of objects by any person or persons present."
 
+    # the judge runs on a background event loop, so the GPU moves on to the next sample while a sample is being scored
+    judge = videochatgpt_scoring.BackgroundJudge(
+        videochatgpt_scoring.AsyncJudgeClient(host=args.judge_host, max_concurrency=args.judge_concurrency, batch_size=args.judge_batch_size,
+                                              cache=JudgeCache(DEFAULT_JUDGE_CACHE_PATH if args.judge_cache is None else args.judge_cache)))
+    pending_scores = collections.deque()
+
+    # each rank writes its own shard as it goes, only the score sums go through the process group
+    shard_writer = ShardWriter(args.output_dir, args.output_name, global_rank)
+
     for i, sample in iterator:
         total_count += 1
 
@@ -119,29 +128,6 @@ def main():
         # gt_data[i]['general_mega_caption'] = mega_caption
         gt_data[i]['general_pred_full_vid_summary'] = full_vid_pred_summary
 
-        correctness = videochatgpt_scoring.get_correctness_score(desc_question, gt_full_video_desc, full_vid_pred_summary)
-        detail_orientation = videochatgpt_scoring.get_detail_orientation_score(desc_question, gt_full_video_desc, full_vid_pred_summary)
-        contextual = videochatgpt_scoring.get_context_score(desc_question, gt_full_video_desc, full_vid_pred_summary)
-        temporal = videochatgpt_scoring.get_temporal_score(desc_question, gt_full_video_desc, full_vid_pred_summary)
-
-        gt_data[i]['score_correctness'] = correctness
-        gt_data[i]['score_detail_orientation'] = detail_orientation
-        gt_data[i]['score_contextual'] = contextual
-        gt_data[i]['score_temporal'] = temporal
-
-        if args.debug and local_rank == 0:
-            print(f"\n{'='*16} Question (General) {'='*16}")
-            print(desc_question)
-            print(f"\n{'='*16} Answer from LLM {'='*16}")
-            print(full_vid_pred_summary)
-            print(f"\n{'='*16} Scores & true ans {'='*16}")
-            print(f'Correctness: {correctness}, Detail: {detail_orientation}, Contextual: {contextual}, Temporal: {temporal}\n')
-
-        correctness_sum += correctness
-        detail_orientation_sum += detail_orientation
-        contextual_sum += contextual
-        temporal_sum += temporal
-
         '''
         # > Consistency
         '''
@@ -188,38 +174,48 @@ def main():
         # gt_data[i]['cons_2_mega_caption'] = mega_caption_cons_2
         gt_data[i]['cons_2_pred_full_vid_summary'] = summarized_cons_2
 
-        consistency = videochatgpt_scoring.get_consistency_score(question_cons_1, question_cons_2, answer_cons, summarized_cons_1, summarized_cons_2)
+        # dispatch all five judges for this sample at once
+        scores_future = judge.submit_sample(desc_question, gt_full_video_desc, full_vid_pred_summary,
+                                            question_cons_1, question_cons_2, answer_cons, summarized_cons_1, summarized_cons_2)
+        pending_scores.append((i, scores_future))
 
-        gt_data[i]['score_consistency'] = consistency
-        consistency_sum += consistency
+        if args.debug and local_rank == 0:
+            judge.flush()
+            scores = scores_future.result()
+            print(f"\n{'='*16} Question (General) {'='*16}")
+            print(desc_question)
+            print(f"\n{'='*16} Answer from LLM {'='*16}")
+            print(full_vid_pred_summary)
+            print(f"\n{'='*16} Scores & true ans {'='*16}")
+            print(f"Correctness: {scores['correctness']}, Detail: {scores['detail_orientation']}, Contextual: {scores['contextual']}, Temporal: {scores['temporal']}, Consistency: {scores['consistency']}\n")
 
         if not args.debug or local_rank == 0:
-            iterator.set_description(f"{args.output_name} (process {local_rank}) {correctness_sum / total_count:.2f}/{detail_orientation_sum / total_count:.2f}/{contextual_sum / total_count:.2f}/{temporal_sum / total_count:.2f}/{consistency_sum / total_count:.2f}")
+            iterator.set_description(f"{args.output_name} (process {local_rank}) judged {shard_writer.num_records}/{total_count}")
+
+        write_scored(pending_scores, gt_data, shard_writer, score_sums)
+
+    # collect the remaining scores, most of them are already done by the time generation finishes
+    judge.flush()
+    write_scored(pending_scores, gt_data, shard_writer, score_sums, wait=True)
+    shard_writer.close()
+
+    judge.close()
+    print(f"Final scores (process {local_rank}): {score_sums['correctness'] / total_count:.2f}/{score_sums['detail_orientation'] / total_count:.2f}/{score_sums['contextual'] / total_count:.2f}/{score_sums['temporal'] / total_count:.2f}/{score_sums['consistency'] / total_count:.2f}")
     #### End of run_inference code ####
 
     del model
     torch.cuda.empty_cache()
 
-    results = [correctness_sum, detail_orientation_sum, contextual_sum, temporal_sum, consistency_sum, total_count, gt_data]
-
-    gathered_results = [None for _ in range(dist.get_world_size())]
-    dist.gather_object(
-        obj=results,
-        object_gather_list=gathered_results if global_rank == 0 else None,
-        dst=0,
-    )
+    # all_reduce also acts as a barrier, so every shard is complete once it returns
+    correctness_sum, detail_orientation_sum, contextual_sum, temporal_sum, consistency_sum, global_total_count = reduce_counters(
+        [score_sums['correctness'], score_sums['detail_orientation'], score_sums['contextual'], score_sums['temporal'], score_sums['consistency'], total_count])
 
     if global_rank == 0:
-        global_total_count = sum([result[5] for result in gathered_results])
-        correctness_final = (sum([result[0] for result in gathered_results]) / global_total_count) * 20
-        detail_orientation_final = (sum([result[1] for result in gathered_results]) / global_total_count) * 20
-        contextual_final = (sum([result[2] for result in gathered_results]) / global_total_count) * 20
-        temporal_final = (sum([result[3] for result in gathered_results]) / global_total_count) * 20
-        consistency_final = (sum([result[4] for result in gathered_results]) / global_total_count) * 20
-
-        gt_data = []
-        for result in gathered_results:
-            gt_data.extend(result[6])
+        correctness_final = (correctness_sum / global_total_count) * 20
+        detail_orientation_final = (detail_orientation_sum / global_total_count) * 20
+        contextual_final = (contextual_sum / global_total_count) * 20
+        temporal_final = (temporal_sum / global_total_count) * 20
+        consistency_final = (consistency_sum / global_total_count) * 20
 
         print(f'Final correctness (all processes): {correctness_final:.2f}')
         print(f'Final detail orientation (all processes): {detail_orientation_final:.2f}')
@@ -229,7 +225,7 @@ def main():
         print(f'Final average (all processes): {(correctness_final + detail_orientation_final + contextual_final + temporal_final + consistency_final) / 5:.2f}')
 
         save_log_file(args.output_dir, args.output_name, correctness_final, detail_orientation_final, contextual_final, temporal_final, consistency_final, args)
-        save_to_json(args.output_dir, f"{args.output_name}.json", gt_data)
+        save_to_json(args.output_dir, args.output_name, world_size)
 
     dist.barrier()
     dist.destroy_process_group()
@@ -281,6 +277,21 @@ def merge_clip_desc(client, mega_caption):
         print(f"An error occurred: {e}. Skipping this item.")
         return {"error": "An unknown error occurred."}   
 
+def write_scored(pending_scores, gt_data, shard_writer, score_sums, wait=False):
+    """
+    Writes the records at the front of pending_scores whose judge scores are in to the shard, in submission order,
+    and drops them from gt_data. With wait=True it blocks until every pending record is written.
+    """
+    while pending_scores and (wait or pending_scores[0][1].done()):
+        i, scores_future = pending_scores.popleft()
+        scores = scores_future.result()
+        for metric, score in scores.items():
+            gt_data[i][f'score_{metric}'] = score
+        score_sums.update(scores)
+
+        shard_writer.write(gt_data[i])
+        gt_data[i] = None
+
 def split_data(gt_data, num_processes, process_id):
     read_start = process_id * len(gt_data) // num_processes
     if process_id == num_processes - 1:
@@ -291,10 +302,10 @@ def split_data(gt_data, num_processes, process_id):
 
     return gt_data
 
-def save_to_json(output_dir, output_name, data):
-    output_path = os.path.join(output_dir, output_name)
-    with open(output_path, 'w') as file:
-        json.dump(data, file, indent=4)
+def save_to_json(output_dir, output_name, num_shards):
+    # stream the per-rank shards into the final JSON instead of building the full list in memory
+    output_path = os.path.join(output_dir, f"{output_name}.json")
+    merge_shards(get_shard_dir(output_dir, output_name), output_path, num_shards=num_shards, remove_shards=True)
 
 def save_log_file(output_dir, output_name, corr_final, do_final, context_final, temp_final, cons_final, args):
     log_path = os.path.join(output_dir, f"{output_name}.log")
@@ -323,5 +334,7 @@ if __name__ == "__main__":
 
     from llavidal.eval.model_utils import initialize_model, load_video
     from llavidal.inference import llavidal_infer as model_infer
+    from llavidal.eval.result_shards import ShardWriter, reduce_counters, merge_shards, get_shard_dir
+    from llavidal.eval.judge_cache import JudgeCache, DEFAULT_JUDGE_CACHE_PATH
 
     main()
\ No newline at end of file
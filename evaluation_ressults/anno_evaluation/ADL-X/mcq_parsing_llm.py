@@ -1,6 +1,10 @@
 import ollama
 import openai
 import re
+import json
+import argparse
+import difflib
+from collections import Counter
 
 
 def build_prompt(question, options, prediction):
@@ -99,4 +103,293 @@ def parse_with_chatgpt(prompt, model='gpt-3.5-turbo', api_key=None):
 
     answer_letter = extract_characters_regex(response)
 
-    return answer_letter, response
\ No newline at end of file
+    return answer_letter, response
+
+
+'''
+# > Tiered parsing: regex -> string/fuzzy -> embedding -> LLM
+'''
+TIER_REGEX = 'regex'
+TIER_STRING = 'string'
+TIER_FUZZY = 'fuzzy'
+TIER_EMBEDDING = 'embedding'
+TIER_LLM = 'llm'
+
+STOPWORDS = {
+    'a', 'an', 'the', 'is', 'are', 'was', 'were', 'be', 'being', 'to', 'of', 'in', 'on', 'at', 'from', 'with', 'and', 'or',
+    'it', 'its', 'this', 'that', 'their', 'his', 'her', 'they', 'he', 'she', 'person', 'video', 'seen', 'appears', 'seems',
+}
+
+# words that turn a mention of a choice into its rejection, "t" is what normalize_text leaves of "n't"
+NEGATIONS = {'not', 'no', 'never', 'neither', 'nor', 'without', 'unlike', 'instead', 'rather', 'cannot', 'except', 't'}
+
+def parse_choices(choices):
+    """
+    Returns the choices as an ordered {letter: text} dict. Accepts a dict or a choices string like "(A) walk (B) sit down".
+    """
+    if isinstance(choices, dict):
+        return {str(k).strip('() '): str(v) for k, v in choices.items()}
+    return {letter: text.strip() for letter, text in re.findall(r'\(([A-Z])\)\s*(.*?)(?=\s*\([A-Z]\)|$)', choices, flags=re.S)}
+
+def normalize_text(s):
+    s = s.lower()
+    s = re.sub(r'[^a-z0-9\s]', ' ', s)
+    return ' '.join(s.split())
+
+def _stem(token):
+    for suffix in ('ing', 'ed', 'es', 's'):
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[:-len(suffix)]
+    return token
+
+def _content_tokens(s):
+    return [_stem(t) for t in normalize_text(s).split() if t not in STOPWORDS]
+
+def _is_negated(preceding_text, window=3):
+    return any(t in NEGATIONS for t in normalize_text(preceding_text).split()[-window:])
+
+def has_negation(s):
+    return any(t in NEGATIONS for t in normalize_text(s).split())
+
+def match_letter_regex(prediction, letters):
+    """
+    Letter given explicitly by the prediction, e.g. "B", "(B)", "B) walk", "The answer is (B)", "Answer: B". Returns None if
+    there is none or if it is ambiguous. Sentences starting with the article "A" are not taken as a letter.
+    """
+    s = prediction.strip()
+    letters_pattern = ''.join(letters)
+
+    match = re.match(rf'^\(?([{letters_pattern}])\)?[\.\):]?$', s)
+    if match is None:
+        match = re.match(rf'^\(([{letters_pattern}])\)|^([{letters_pattern}])[\.\):]\s', s)
+    if match is None:
+        # only the keywords are case insensitive, a lowercase letter is a word such as the article "a". A bare letter must
+        # end the sentence, "The answer is A person ..." is not an answer letter
+        match = re.search(rf'(?i:(?:answer|option|choice)(?:\s+is:?|:)|(?:option|choice)(?=\s*\())\s*'
+                          rf'(?:\(([{letters_pattern}])\)|([{letters_pattern}])(?=\s*$|[\.,;:!\)]))', s)
+    if match is not None:
+        return next(g for g in match.groups() if g)
+
+    # a "(X)" reference that ends the prediction, e.g. "The person drinks from a cup (C).", unless it is rejected ("unlike (A)")
+    match = re.search(rf'\(([{letters_pattern}])\)[\s\.!]*$', s)
+    if match is not None and not _is_negated(s[:match.start()]):
+        return match.group(1)
+    return None
+
+def match_letter_string(prediction, choices):
+    """
+    Choice whose text is the prediction, or the only choice whose text appears in the prediction (choices contained in a
+    longer matching choice are ignored). Returns None if no choice or several unrelated choices match, or if a matching
+    choice is negated ("not drinking water").
+    """
+    normalized_prediction = f' {normalize_text(prediction)} '
+    normalized_choices = {letter: normalize_text(text) for letter, text in choices.items()}
+
+    for letter, text in normalized_choices.items():
+        if text and normalized_prediction.strip() == text:
+            return letter
+
+    found = {letter: text for letter, text in normalized_choices.items() if text and f' {text} ' in normalized_prediction}
+    if any(_is_negated(normalized_prediction[:normalized_prediction.index(f' {text} ')]) for text in found.values()):
+        return None
+    found = {letter: text for letter, text in found.items()
+             if not any(text != other and f' {text} ' in f' {other} ' for other in found.values())}
+    if len(found) == 1:
+        return next(iter(found))
+    return None
+
+def match_letter_fuzzy(prediction, choices):
+    """
+    Scores every choice by the fraction of its content words found in the prediction (fuzzy per word, so that
+    "drinks" matches "drinking"). Returns (best letter, best score, second best score).
+    """
+    prediction_tokens = set(_content_tokens(prediction))
+    scores = {}
+    for letter, text in choices.items():
+        choice_tokens = _content_tokens(text)
+        if not choice_tokens:
+            scores[letter] = 0.0
+            continue
+        hits = 0
+        for token in choice_tokens:
+            if token in prediction_tokens or difflib.get_close_matches(token, prediction_tokens, n=1, cutoff=0.85):
+                hits += 1
+        scores[letter] = hits / len(choice_tokens)
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    best_letter, best_score = ranked[0]
+    second_score = ranked[1][1] if len(ranked) > 1 else 0.0
+    return best_letter, best_score, second_score
+
+class SentenceEmbedder(object):
+    """
+    Embeds texts with sentence-transformers. The model is loaded on first use and embeddings are cached,
+    since the same choices are shared by many questions.
+    """
+    def __init__(self, model_name='all-MiniLM-L6-v2', device=None):
+        self.model_name = model_name
+        self.device = device
+        self.model = None
+        self.cache = {}
+
+    def __call__(self, texts):
+        import numpy as np
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.model_name, device=self.device)
+        missing = [t for t in dict.fromkeys(texts) if t not in self.cache]
+        if missing:
+            for text, embedding in zip(missing, self.model.encode(missing, normalize_embeddings=True)):
+                self.cache[text] = embedding
+        return np.stack([self.cache[t] for t in texts])
+
+def match_letter_embedding(prediction, choices, embedder):
+    """
+    Cosine similarity between the prediction and every choice. Returns (best letter, best similarity, second best similarity).
+    """
+    letters = list(choices)
+    embeddings = embedder([prediction] + [choices[letter] for letter in letters])
+    similarities = embeddings[1:] @ embeddings[0]
+    order = similarities.argsort()[::-1]
+    second = float(similarities[order[1]]) if len(order) > 1 else 0.0
+    return letters[order[0]], float(similarities[order[0]]), second
+
+class MCQParser(object):
+    """
+    Extracts the letter of the chosen answer from a free-form prediction, trying the cheap tiers first:
+    1. regex: the prediction names a letter,
+    2. string: the prediction is or contains exactly one choice text,
+    3. fuzzy: most content words of one choice are in the prediction (above fuzzy_threshold and fuzzy_margin ahead of the others),
+    4. embedding: optional, sentence similarity above embedding_threshold and embedding_margin ahead of the others,
+    5. llm: the few-shot prompt of build_prompt, the only tier that can answer 'Z' (none of the choices).
+    parse() reports which tier decided, tier_counts keeps the totals. With local=False every prediction goes to the LLM,
+    as before the tiers were added.
+    """
+    def __init__(self, fuzzy_threshold=0.75, fuzzy_margin=0.25, embedder=None, embedding_threshold=0.6, embedding_margin=0.1,
+                 llm='llama', api_key=None, local=True):
+        self.fuzzy_threshold = fuzzy_threshold
+        self.fuzzy_margin = fuzzy_margin
+        self.embedder = embedder
+        self.embedding_threshold = embedding_threshold
+        self.embedding_margin = embedding_margin
+        self.llm = llm
+        self.api_key = api_key
+        self.local = local
+        self.tier_counts = Counter()
+
+    def parse_local(self, prediction, choices):
+        """
+        Returns (letter, tier) from the local tiers, or (None, None) if none of them is confident enough.
+        """
+        if type(prediction) is not str or not prediction.strip() or not choices:
+            return None, None
+
+        letter = match_letter_regex(prediction, list(choices))
+        if letter is not None:
+            return letter, TIER_REGEX
+
+        letter = match_letter_string(prediction, choices)
+        if letter is not None:
+            return letter, TIER_STRING
+
+        # word overlap and sentence similarity do not see that a choice is rejected, negations are left to the LLM
+        if has_negation(prediction):
+            return None, None
+
+        letter, best, second = match_letter_fuzzy(prediction, choices)
+        if best >= self.fuzzy_threshold and best - second >= self.fuzzy_margin:
+            return letter, TIER_FUZZY
+
+        if self.embedder is not None:
+            letter, best, second = match_letter_embedding(prediction, choices, self.embedder)
+            if best >= self.embedding_threshold and best - second >= self.embedding_margin:
+                return letter, TIER_EMBEDDING
+
+        return None, None
+
+    def parse(self, question, choices, prediction):
+        """
+        Parameters:
+        question (str): The question.
+        choices (dict or str): {letter: text} or the choices string shown to the model, e.g. "(A) walk (B) sit down".
+        prediction (str): Free-form answer of the model.
+
+        Returns:
+        tuple: (letter, tier, llm output or None if a local tier decided).
+        """
+        choices_dict = parse_choices(choices)
+        letter, tier = self.parse_local(prediction, choices_dict) if self.local else (None, None)
+        llm_out = None
+        if letter is None:
+            choices_str = choices if isinstance(choices, str) else " ".join(f'({k}) {v}' for k, v in choices_dict.items())
+            prompt = build_prompt(question, choices_str, prediction)
+            if self.llm == 'chatgpt':
+                letter, llm_out = parse_with_chatgpt(prompt, api_key=self.api_key)
+            else:
+                letter, llm_out = parse_with_llama(prompt)
+            tier = TIER_LLM
+        self.tier_counts[tier] += 1
+        return letter, tier, llm_out
+
+
+'''
+# > Agreement of the local tiers with the LLM
+'''
+LETTER_KEYS = ('parsed_answer_from_llm', 'parsed_answer')
+CHOICES_KEYS = ('question_to_llm', 'options_with_letter', 'answer_choices', 'options')
+
+def agreement_report(records, parser, query_llm=False):
+    """
+    Compares the local tiers with the LLM on the records of a result file, e.g. of a run with --mcq_parser llm.
+    The LLM letter is the parsed answer of the records parsed by the LLM. The other records are only compared if
+    query_llm is set, by asking the LLM again.
+
+    Returns:
+    dict: Per tier of parse_local (None for the records it leaves to the LLM), the number of records, how many of
+        them were compared and how often the local letter equals the LLM letter, plus the records that disagree.
+    """
+    report = {}
+    disagreements = []
+    for record in records:
+        prediction = record.get('prediction')
+        choices = next((record[key] for key in CHOICES_KEYS if key in record), None)
+        if type(prediction) is not str or choices is None:
+            continue
+        choices_dict = parse_choices(choices)
+        letter, tier = parser.parse_local(prediction, choices_dict)
+        stats = report.setdefault(tier or TIER_LLM, {'records': 0, 'compared': 0, 'agree': 0})
+        stats['records'] += 1
+        if tier is None:
+            continue
+
+        llm_letter = None
+        if record.get('parse_tier', TIER_LLM) == TIER_LLM:
+            llm_letter = next((record[key] for key in LETTER_KEYS if key in record), None)
+        elif query_llm:
+            llm_parser = MCQParser(llm=parser.llm, api_key=parser.api_key, local=False)
+            llm_letter = llm_parser.parse(record.get('question', ''), choices, prediction)[0]
+        if llm_letter is None:
+            continue
+        stats['compared'] += 1
+        if letter == llm_letter:
+            stats['agree'] += 1
+        else:
+            disagreements.append({'prediction': prediction, 'choices': choices, 'tier': tier, 'local': letter, 'llm': llm_letter})
+    for stats in report.values():
+        stats['agreement'] = stats['agree'] / stats['compared'] if stats['compared'] else None
+    return {'tiers': report, 'disagreements': disagreements}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Agreement of the local MCQ parsing tiers with the LLM on a result file.')
+    parser.add_argument('result_file', help='Result JSON of an evaluation run, a list of records.')
+    parser.add_argument('--query_llm', action='store_true', help='Ask the LLM for the records a local tier parsed in the run.')
+    parser.add_argument('--llm', default='llama', choices=['llama', 'chatgpt'])
+    parser.add_argument('--api_key', default=None)
+    args = parser.parse_args()
+
+    with open(args.result_file) as f:
+        records = json.load(f)
+    report = agreement_report(records, MCQParser(llm=args.llm, api_key=args.api_key), query_llm=args.query_llm)
+    for disagreement in report['disagreements']:
+        print(f"{disagreement['tier']}: local {disagreement['local']}, llm {disagreement['llm']}: {disagreement['prediction']!r}")
+    print(json.dumps(report['tiers'], indent=4))
@@ -1,86 +1,168 @@
-import ollama, ast
+import ollama, ast, json
+import asyncio, random, threading
 
-def get_correctness_score(question, answer, lvlm_pred, retries=10):
-    score = 0
-    for try_idx in range(retries):
-        try:
-            completion = ollama.chat(
-                model = 'llama3.1',
-                messages=[
-                    {
-                        "role": "system",
-                        "content": 
-                            "You are an intelligent chatbot designed for evaluating the factual accuracy of generative outputs for video-based question-answer pairs. "
-                            "Your task is to compare the predicted answer with the correct answer and determine if they are factually consistent. Here's how you can accomplish the task:"
-                            "------"
-                            "##INSTRUCTIONS: "
-                            "- Focus on the factual consistency between the predicted answer and the correct answer. The predicted answer should not contain any misinterpretations or misinformation.\n"
-                            "- The predicted answer must be factually accurate and align with the video content.\n"
-                            "- Consider synonyms or paraphrases as valid matches.\n"
-                            "- Evaluate the factual accuracy of the prediction compared to the answer."
-                    },
-                    {
-                        "role": "user",
-                        "content":
-                            "Please evaluate the following video-based question-answer pair:\n\n"
-                            f"Question: {question}\n"
-                            f"Correct Answer: {answer}\n"
-                            f"Predicted Answer: {lvlm_pred}\n\n"
-                            "Provide your evaluation only as a factual accuracy score where the factual accuracy score is an integer value between 0 and 5, with 5 indicating the highest level of factual consistency. "
-                            "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the factual accuracy score in INTEGER, not STRING."
-                            "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
-                            "For example, your response should look like this: {'score': 4.8}."
-                    }
-                ]
-            )
-            response_message = completion["message"]["content"]
+JUDGE_MODEL = 'llama3.1'
 
-            response_dict = ast.literal_eval(response_message)
-            score = response_dict['score']
-            break
+'''
+# > Judge prompts
+'''
+def build_correctness_messages(question, answer, lvlm_pred):
+    return [
+        {
+            "role": "system",
+            "content":
+                "You are an intelligent chatbot designed for evaluating the factual accuracy of generative outputs for video-based question-answer pairs. "
+                "Your task is to compare the predicted answer with the correct answer and determine if they are factually consistent. Here's how you can accomplish the task:"
+                "------"
+                "##INSTRUCTIONS: "
+                "- Focus on the factual consistency between the predicted answer and the correct answer. The predicted answer should not contain any misinterpretations or misinformation.\n"
+                "- The predicted answer must be factually accurate and align with the video content.\n"
+                "- Consider synonyms or paraphrases as valid matches.\n"
+                "- Evaluate the factual accuracy of the prediction compared to the answer."
+        },
+        {
+            "role": "user",
+            "content":
+                "Please evaluate the following video-based question-answer pair:\n\n"
+                f"Question: {question}\n"
+                f"Correct Answer: {answer}\n"
+                f"Predicted Answer: {lvlm_pred}\n\n"
+                "Provide your evaluation only as a factual accuracy score where the factual accuracy score is an integer value between 0 and 5, with 5 indicating the highest level of factual consistency. "
+                "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the factual accuracy score in INTEGER, not STRING."
+                "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
+                "For example, your response should look like this: {'score': 4.8}."
+        }
+    ]
 
-        except Exception as e:
-            continue
+def build_detail_orientation_messages(question, answer, lvlm_pred):
+    return [
+        {
+            "role": "system",
+            "content":
+                "You are an intelligent chatbot designed for evaluating the detail orientation of generative outputs for video-based question-answer pairs. "
+                "Your task is to compare the predicted answer with the correct answer and determine its level of detail, considering both completeness and specificity. Here's how you can accomplish the task:"
+                "------"
+                "##INSTRUCTIONS: "
+                "- Check if the predicted answer covers all major points from the video. The response should not leave out any key aspects.\n"
+                "- Evaluate whether the predicted answer includes specific details rather than just generic points. It should provide comprehensive information that is tied to specific elements of the video.\n"
+                "- Consider synonyms or paraphrases as valid matches.\n"
+                "- Provide a single evaluation score that reflects the level of detail orientation of the prediction, considering both completeness and specificity."
+        },
+        {
+            "role": "user",
+            "content":
+                "Please evaluate the following video-based question-answer pair:\n\n"
+                f"Question: {question}\n"
+                f"Correct Answer: {answer}\n"
+                f"Predicted Answer: {lvlm_pred}\n\n"
+                "Provide your evaluation only as a detail orientation score where the detail orientation score is an integer value between 0 and 5, with 5 indicating the highest level of detail orientation. "
+                "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the detail orientation score in INTEGER, not STRING."
+                "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
+                "For example, your response should look like this: {''score': 4.8}."
+        }
+    ]
 
-    return score
+def build_context_messages(question, answer, lvlm_pred):
+    return [
+        {
+            "role": "system",
+            "content":
+                "You are an intelligent chatbot designed for evaluating the contextual understanding of generative outputs for video-based question-answer pairs. "
+                "Your task is to compare the predicted answer with the correct answer and determine if the generated response aligns with the overall context of the video content. Here's how you can accomplish the task:"
+                "------"
+                "##INSTRUCTIONS: "
+                "- Evaluate whether the predicted answer aligns with the overall context of the video content. It should not provide information that is out of context or misaligned.\n"
+                "- The predicted answer must capture the main themes and sentiments of the video.\n"
+                "- Consider synonyms or paraphrases as valid matches.\n"
+                "- Provide your evaluation of the contextual understanding of the prediction compared to the answer."
+        },
+        {
+            "role": "user",
+            "content":
+                "Please evaluate the following video-based question-answer pair:\n\n"
+                f"Question: {question}\n"
+                f"Correct Answer: {answer}\n"
+                f"Predicted Answer: {lvlm_pred}\n\n"
+                "Provide your evaluation only as a contextual understanding score where the contextual understanding score is an integer value between 0 and 5, with 5 indicating the highest level of contextual understanding. "
+                "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is contextual understanding score in INTEGER, not STRING."
+                "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
+                "For example, your response should look like this: {'score': 4.8}."
+        }
+    ]
 
-def get_detail_orientation_score(question, answer, lvlm_pred, retries=10):
+def build_temporal_messages(question, answer, lvlm_pred):
+    return [
+        {
+            "role": "system",
+            "content":
+                "You are an intelligent chatbot designed for evaluating the temporal understanding of generative outputs for video-based question-answer pairs. "
+                "Your task is to compare the predicted answer with the correct answer and determine if they correctly reflect the temporal sequence of events in the video content. Here's how you can accomplish the task:"
+                "------"
+                "##INSTRUCTIONS: "
+                "- Focus on the temporal consistency between the predicted answer and the correct answer. The predicted answer should correctly reflect the sequence of events or details as they are presented in the video content.\n"
+                "- Consider synonyms or paraphrases as valid matches, but only if the temporal order is maintained.\n"
+                "- Evaluate the temporal accuracy of the prediction compared to the answer."
+        },
+        {
+            "role": "user",
+            "content":
+                "Please evaluate the following video-based question-answer pair:\n\n"
+                f"Question: {question}\n"
+                f"Correct Answer: {answer}\n"
+                f"Predicted Answer: {lvlm_pred}\n\n"
+                "Provide your evaluation only as a temporal accuracy score where the temporal accuracy score is an integer value between 0 and 5, with 5 indicating the highest level of temporal consistency. "
+                "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the temporal accuracy score in INTEGER, not STRING."
+                "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
+                "For example, your response should look like this: {''score': 4.8}."
+        }
+    ]
+
+def build_consistency_messages(question1, question2, answer, lvlm_pred1, lvlm_pred2):
+    return [
+        {
+            "role": "system",
+            "content":
+                "You are an intelligent chatbot designed for evaluating the consistency of generative outputs for similar video-based question-answer pairs. "
+                "You will be given two very similar questions, a common answer common to both the questions and predicted answers for the two questions ."
+                "Your task is to compare the predicted answers for two very similar question, with a common correct answer and determine if they are consistent. Here's how you can accomplish the task:"
+                "------"
+                "##INSTRUCTIONS: "
+                "- Focus on the consistency between the two predicted answers and the correct answer. Both predicted answers should correspond to the correct answer and to each other, and should not contain any contradictions or significant differences in the conveyed information.\n"
+                "- Both predicted answers must be consistent with each other and the correct answer, in terms of the information they provide about the video content.\n"
+                "- Consider synonyms or paraphrases as valid matches, but only if they maintain the consistency in the conveyed information.\n"
+                "- Evaluate the consistency of the two predicted answers compared to the correct answer."
+        },
+        {
+            "role": "user",
+            "content":
+                "Please evaluate the following video-based question-answer pair:\n\n"
+                f"Question 1: {question1}\n"
+                f"Question 2: {question2}\n"
+                f"Correct Answer: {answer}\n"
+                f"Predicted Answer to Question 1: {lvlm_pred1}\n"
+                f"Predicted Answer to Question 2: {lvlm_pred2}\n\n"
+                "Provide your evaluation only as a consistency score where the consistency score is an integer value between 0 and 5, with 5 indicating the highest level of consistency. "
+                "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the consistency score in INTEGER, not STRING."
+                "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
+                "For example, your response should look like this: {''score': 4.8}."
+        }
+    ]
+
+def parse_score(response_message):
+    response_dict = ast.literal_eval(response_message)
+    return response_dict['score']
+
+'''
+# > Synchronous judge (one request at a time)
+'''
+def _score_with_retries(messages, retries=10):
     score = 0
     for try_idx in range(retries):
         try:
-            completion = ollama.chat(
-                model="llama3.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content":
-                            "You are an intelligent chatbot designed for evaluating the detail orientation of generative outputs for video-based question-answer pairs. "
-                            "Your task is to compare the predicted answer with the correct answer and determine its level of detail, considering both completeness and specificity. Here's how you can accomplish the task:"
-                            "------"
-                            "##INSTRUCTIONS: "
-                            "- Check if the predicted answer covers all major points from the video. The response should not leave out any key aspects.\n"
-                            "- Evaluate whether the predicted answer includes specific details rather than just generic points. It should provide comprehensive information that is tied to specific elements of the video.\n"
-                            "- Consider synonyms or paraphrases as valid matches.\n"
-                            "- Provide a single evaluation score that reflects the level of detail orientation of the prediction, considering both completeness and specificity."
-                    },
-                    {
-                        "role": "user",
-                        "content":
-                            "Please evaluate the following video-based question-answer pair:\n\n"
-                            f"Question: {question}\n"
-                            f"Correct Answer: {answer}\n"
-                            f"Predicted Answer: {lvlm_pred}\n\n"
-                            "Provide your evaluation only as a detail orientation score where the detail orientation score is an integer value between 0 and 5, with 5 indicating the highest level of detail orientation. "
-                            "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the detail orientation score in INTEGER, not STRING."
-                            "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
-                            "For example, your response should look like this: {''score': 4.8}."
-                    }
-                ]
-            )
+            completion = ollama.chat(model=JUDGE_MODEL, messages=messages)
             response_message = completion["message"]["content"]
 
-            response_dict = ast.literal_eval(response_message)
-            score = response_dict['score']
+            score = parse_score(response_message)
             break
 
         except Exception as e:
@@ -88,136 +170,267 @@ def get_detail_orientation_score(question, answer, lvlm_pred, retries=10):
 
     return score
 
+def get_correctness_score(question, answer, lvlm_pred, retries=10):
+    return _score_with_retries(build_correctness_messages(question, answer, lvlm_pred), retries)
+
+def get_detail_orientation_score(question, answer, lvlm_pred, retries=10):
+    return _score_with_retries(build_detail_orientation_messages(question, answer, lvlm_pred), retries)
+
 def get_context_score(question, answer, lvlm_pred, retries=10):
-    score = 0
-    for try_idx in range(retries):
-        try:
-            completion = ollama.chat(
-                model="llama3.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content":
-                            "You are an intelligent chatbot designed for evaluating the contextual understanding of generative outputs for video-based question-answer pairs. "
-                            "Your task is to compare the predicted answer with the correct answer and determine if the generated response aligns with the overall context of the video content. Here's how you can accomplish the task:"
-                            "------"
-                            "##INSTRUCTIONS: "
-                            "- Evaluate whether the predicted answer aligns with the overall context of the video content. It should not provide information that is out of context or misaligned.\n"
-                            "- The predicted answer must capture the main themes and sentiments of the video.\n"
-                            "- Consider synonyms or paraphrases as valid matches.\n"
-                            "- Provide your evaluation of the contextual understanding of the prediction compared to the answer."
-                    },
-                    {
-                        "role": "user",
-                        "content":
-                            "Please evaluate the following video-based question-answer pair:\n\n"
-                            f"Question: {question}\n"
-                            f"Correct Answer: {answer}\n"
-                            f"Predicted Answer: {lvlm_pred}\n\n"
-                            "Provide your evaluation only as a contextual understanding score where the contextual understanding score is an integer value between 0 and 5, with 5 indicating the highest level of contextual understanding. "
-                            "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is contextual understanding score in INTEGER, not STRING."
-                            "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
-                            "For example, your response should look like this: {'score': 4.8}."
-                    }
-                ]
-            )
-            response_message = completion["message"]["content"]
+    return _score_with_retries(build_context_messages(question, answer, lvlm_pred), retries)
 
-            response_dict = ast.literal_eval(response_message)
-            score = response_dict['score']
-            break
+def get_temporal_score(question, answer, lvlm_pred, retries=10):
+    return _score_with_retries(build_temporal_messages(question, answer, lvlm_pred), retries)
 
-        except Exception as e:
-            continue
+def get_consistency_score(question1, question2, answer, lvlm_pred1, lvlm_pred2, retries=10):
+    return _score_with_retries(build_consistency_messages(question1, question2, answer, lvlm_pred1, lvlm_pred2), retries)
 
-    return score
+'''
+# > Asynchronous judge (bounded number of requests in flight)
+'''
+class AsyncJudgeClient(object):
+    """
+    Sends judge requests to an Ollama server with at most max_concurrency requests in flight.
 
-def get_temporal_score(question, answer, lvlm_pred, retries=10):
-    score = 0
-    for try_idx in range(retries):
-        try:
-            completion = ollama.chat(
-                model="llama3.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content":
-                            "You are an intelligent chatbot designed for evaluating the temporal understanding of generative outputs for video-based question-answer pairs. "
-                            "Your task is to compare the predicted answer with the correct answer and determine if they correctly reflect the temporal sequence of events in the video content. Here's how you can accomplish the task:"
-                            "------"
-                            "##INSTRUCTIONS: "
-                            "- Focus on the temporal consistency between the predicted answer and the correct answer. The predicted answer should correctly reflect the sequence of events or details as they are presented in the video content.\n"
-                            "- Consider synonyms or paraphrases as valid matches, but only if the temporal order is maintained.\n"
-                            "- Evaluate the temporal accuracy of the prediction compared to the answer."
-                    },
-                    {
-                        "role": "user",
-                        "content":
-                            "Please evaluate the following video-based question-answer pair:\n\n"
-                            f"Question: {question}\n"
-                            f"Correct Answer: {answer}\n"
-                            f"Predicted Answer: {lvlm_pred}\n\n"
-                            "Provide your evaluation only as a temporal accuracy score where the temporal accuracy score is an integer value between 0 and 5, with 5 indicating the highest level of temporal consistency. "
-                            "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the temporal accuracy score in INTEGER, not STRING."
-                            "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
-                            "For example, your response should look like this: {''score': 4.8}."
-                    }
-                ]
-            )
-            response_message = completion["message"]["content"]
+    Malformed responses are retried right away, transport errors (server busy, connection refused, ...)
+    are retried with exponential backoff and jitter. Like the synchronous functions above, a score of 0
+    is returned once all retries are used up.
 
-            response_dict = ast.literal_eval(response_message)
-            score = response_dict['score']
-            break
+    host can point to any server that speaks the Ollama chat API, e.g. a local stub server for testing.
+    cache is an optional llavidal.eval.judge_cache.JudgeCache, consulted before a request is sent.
 
-        except Exception as e:
-            continue
+    With batch_size > 1, requests of the same metric are packed into one judge request of up to batch_size
+    pairs (see llavidal.eval.batched_judge). A partial batch is sent after batch_timeout seconds, on flush() or
+    right away while drain() waits for the last requests.
+    Pairs the batched judge fails to score are retried in the next batch request, then one at a time.
+    """
+    def __init__(self, host=None, model=JUDGE_MODEL, max_concurrency=8, retries=10, backoff_base=0.5, backoff_max=30.0, cache=None,
+                 batch_size=1, batch_timeout=10.0, batch_retries=2):
+        self.client = ollama.AsyncClient(host=host)
+        self.model = model
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.batch_retries = batch_retries
+        self._semaphore = None
+        self._batches = {}
+        self._batch_timers = {}
+        self._batch_tasks = set()  # strong references, the event loop only keeps weak ones
+        self._num_draining = 0
 
-    return score
+    @property
+    def semaphore(self):
+        # created lazily so that it belongs to the event loop the client is used from
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
 
-def get_consistency_score(question1, question2, answer, lvlm_pred1, lvlm_pred2, retries=10):
-    score = 0
-    for try_idx in range(retries):
+    async def score(self, messages, metric=None):
+        # the single-pair responses are looked up also when batching, so changing batch_size reuses them
+        if self.cache is not None and metric is not None:
+            response_message = self.cache.get(metric, self.model, messages)
+            if response_message is not None:
+                return parse_score(response_message)
+
+        if self.batch_size > 1 and metric is not None:
+            return await self._score_batched(messages, metric)
+        return await self._score_single(messages, metric)
+
+    async def _backoff(self, num_transport_errors):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** num_transport_errors)
+        await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+    async def _score_single(self, messages, metric=None):
+        num_transport_errors = 0
+        for try_idx in range(self.retries):
+            try:
+                # only hold a slot while the request is in flight, not while backing off
+                async with self.semaphore:
+                    completion = await self.client.chat(model=self.model, messages=messages)
+            except Exception as e:
+                await self._backoff(num_transport_errors)
+                num_transport_errors += 1
+                continue
+
+            try:
+                response_message = completion["message"]["content"]
+                score = parse_score(response_message)
+            except Exception as e:
+                continue
+
+            if self.cache is not None and metric is not None:
+                self.cache.put(metric, self.model, messages, response_message)
+            return score
+
+        return 0
+
+    async def _score_batched(self, messages, metric):
+        if self.cache is not None:
+            response_message = self.cache.get(f'{metric}/batched', self.model, messages)
+            if response_message is not None:
+                return json.loads(response_message)['score']
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._batches.setdefault(metric, [])
+        batch.append((messages, future))
+        if len(batch) >= self.batch_size:
+            self._flush_metric(metric)
+        elif len(batch) == 1:
+            # while draining, partial batches only wait for the requests dispatched in the same loop iteration
+            timeout = 0 if self._num_draining else self.batch_timeout
+            self._batch_timers[metric] = loop.call_later(timeout, self._flush_metric, metric)
+        return await future
+
+    def _flush_metric(self, metric):
+        timer = self._batch_timers.pop(metric, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._batches.pop(metric, [])
+        if batch:
+            task = asyncio.ensure_future(self._send_batch(metric, batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(lambda task: self._batch_done(task, batch))
+
+    def _batch_done(self, task, batch):
+        self._batch_tasks.discard(task)
+        # the callers wait on the futures of the batch, none of them may be left unresolved, also if the task
+        # failed or was cancelled (possibly before it started)
+        for _, future in batch:
+            if future.done():
+                continue
+            if task.cancelled():
+                future.cancel()
+            else:
+                future.set_exception(task.exception() or RuntimeError("The batch ended without a score"))
+
+    def flush(self):
+        """
+        Send all partial batches now. Must be called from the event loop of the client.
+        """
+        for metric in list(self._batches):
+            self._flush_metric(metric)
+
+    async def drain(self, awaitables):
+        """
+        Wait for awaitables (e.g. the scoring of the last samples) without holding their requests back for full
+        batches: partial batches are sent right away until all of them are done, then batching resumes.
+        """
+        self._num_draining += 1
+        self.flush()
         try:
-            completion = ollama.chat(
-                model="llama3.1",
-                messages=[
-                    {
-                        "role": "system",
-                        "content":
-                            "You are an intelligent chatbot designed for evaluating the consistency of generative outputs for similar video-based question-answer pairs. "
-                            "You will be given two very similar questions, a common answer common to both the questions and predicted answers for the two questions ."
-                            "Your task is to compare the predicted answers for two very similar question, with a common correct answer and determine if they are consistent. Here's how you can accomplish the task:"
-                            "------"
-                            "##INSTRUCTIONS: "
-                            "- Focus on the consistency between the two predicted answers and the correct answer. Both predicted answers should correspond to the correct answer and to each other, and should not contain any contradictions or significant differences in the conveyed information.\n"
-                            "- Both predicted answers must be consistent with each other and the correct answer, in terms of the information they provide about the video content.\n"
-                            "- Consider synonyms or paraphrases as valid matches, but only if they maintain the consistency in the conveyed information.\n"
-                            "- Evaluate the consistency of the two predicted answers compared to the correct answer."
-                    },
-                    {
-                        "role": "user",
-                        "content":
-                            "Please evaluate the following video-based question-answer pair:\n\n"
-                            f"Question 1: {question1}\n"
-                            f"Question 2: {question2}\n"
-                            f"Correct Answer: {answer}\n"
-                            f"Predicted Answer to Question 1: {lvlm_pred1}\n"
-                            f"Predicted Answer to Question 2: {lvlm_pred2}\n\n"
-                            "Provide your evaluation only as a consistency score where the consistency score is an integer value between 0 and 5, with 5 indicating the highest level of consistency. "
-                            "Please generate the response in the form of a Python dictionary string with keys 'score', where its value is the consistency score in INTEGER, not STRING."
-                            "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the Python dictionary string. "
-                            "For example, your response should look like this: {''score': 4.8}."
-                    }
-                ]
-            )
-            response_message = completion["message"]["content"]
+            await asyncio.gather(*awaitables, return_exceptions=True)
+        finally:
+            self._num_draining -= 1
 
-            response_dict = ast.literal_eval(response_message)
-            score = response_dict['score']
-            break
+    async def _send_batch(self, metric, batch):
+        from llavidal.eval.batched_judge import build_batch_messages, parse_batch_response
 
-        except Exception as e:
-            continue
+        pending = batch
+        num_transport_errors = 0
+        for try_idx in range(self.batch_retries + 1):
+            try:
+                async with self.semaphore:
+                    completion = await self.client.chat(model=self.model, messages=build_batch_messages([messages for messages, _ in pending]))
+                response_message = completion["message"]["content"]
+            except Exception as e:
+                await self._backoff(num_transport_errors)
+                num_transport_errors += 1
+                continue
+
+            # only the pairs without a valid score are sent again
+            batch_scores = parse_batch_response(response_message, len(pending))
+            failed = []
+            for index, (messages, future) in enumerate(pending):
+                if index not in batch_scores:
+                    failed.append((messages, future))
+                    continue
+                if self.cache is not None:
+                    self.cache.put(f'{metric}/batched', self.model, messages, json.dumps({'score': batch_scores[index]}))
+                if not future.done():
+                    future.set_result(batch_scores[index])
+            pending = failed
+            if not pending:
+                return
+
+        scores = await asyncio.gather(*[self._score_single(messages, metric) for messages, _ in pending])
+        for (messages, future), score in zip(pending, scores):
+            if not future.done():
+                future.set_result(score)
+
+    async def score_many(self, messages_per_metric):
+        """
+        Score several metrics concurrently. messages_per_metric maps a metric name to its judge messages,
+        the returned dict maps the same names to their scores.
+        """
+        metrics = list(messages_per_metric.keys())
+        scores = await asyncio.gather(*[self.score(messages_per_metric[metric], metric) for metric in metrics])
+        return dict(zip(metrics, scores))
+
+    async def score_sample(self, question, answer, lvlm_pred, question_cons_1=None, question_cons_2=None, answer_cons=None, lvlm_pred_cons_1=None, lvlm_pred_cons_2=None):
+        """
+        Dispatch the correctness, detail orientation, context and temporal judges for a sample at once,
+        plus the consistency judge if the consistency predictions are given.
+        """
+        messages_per_metric = {}
+        if lvlm_pred is not None:
+            messages_per_metric['correctness'] = build_correctness_messages(question, answer, lvlm_pred)
+            messages_per_metric['detail_orientation'] = build_detail_orientation_messages(question, answer, lvlm_pred)
+            messages_per_metric['contextual'] = build_context_messages(question, answer, lvlm_pred)
+            messages_per_metric['temporal'] = build_temporal_messages(question, answer, lvlm_pred)
+        if lvlm_pred_cons_1 is not None and lvlm_pred_cons_2 is not None:
+            messages_per_metric['consistency'] = build_consistency_messages(question_cons_1, question_cons_2, answer_cons, lvlm_pred_cons_1, lvlm_pred_cons_2)
+
+        return await self.score_many(messages_per_metric)
+
+
+class BackgroundJudge(object):
+    """
+    Runs an AsyncJudgeClient on an event loop in a daemon thread so that judging happens off the GPU critical path.
+
+    submit_sample() takes the same arguments as AsyncJudgeClient.score_sample() and returns a
+    concurrent.futures.Future holding the dict of scores, so the caller can keep generating and collect
+    the scores at the end.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.pending = []  # futures of the submitted samples that are not done yet
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def submit_sample(self, *args, **kwargs):
+        self.pending = [future for future in self.pending if not future.done()]
+        future = self.submit(self.client.score_sample(*args, **kwargs))
+        self.pending.append(future)
+        return future
+
+    def flush(self):
+        """
+        Send the partial batches of a batching client right away instead of waiting for batch_timeout, until the
+        samples submitted so far are scored. Later samples are batched again.
+        """
+        futures = list(self.pending)
+
+        async def drain():
+            await self.client.drain([asyncio.wrap_future(future) for future in futures])
+
+        return self.submit(drain())
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
 
-    return score
\ No newline at end of file
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
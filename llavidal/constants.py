@@ -1,8 +1,15 @@
 CONTROLLER_HEART_BEAT_EXPIRATION = 30
 WORKER_HEART_BEAT_INTERVAL = 15
 
+# error codes of the model worker stream (llavidal/serve/model_worker.py)
+WORKER_ERROR_GENERATION = 1
+WORKER_ERROR_UNKNOWN_VIDEO = 2
+
 LOGDIR = "."
 
+# label of the positions without loss: prompt, modality tokens and padding
+IGNORE_INDEX = -100
+
 
 # Defining model
 DEFAULT_VIDEO_TOKEN = "<video>"
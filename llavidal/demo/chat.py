@@ -1,7 +1,12 @@
+import json
 import time
+from collections import OrderedDict
+from threading import Lock, Thread
+import requests
 import torch
 import gradio as gr
-from llavidal.utils import (build_logger)
+from transformers import TextIteratorStreamer
+from llavidal.utils import (build_logger, server_error_msg, truncate_at_stop_str)
 from llavidal.video_conversation import conv_templates, SeparatorStyle
 from llavidal.video_conversation import load_video
 from llavidal.model.utils import KeywordsStoppingCriteria
@@ -31,8 +36,56 @@ def post_process_code(code):
     return code
 
 
+class PromptCache:
+    """
+    KV cache of the conversation of a session. The next turn only prefills the tokens after the longest
+    prefix it shares with the cached tokens, i.e. the new user message.
+    """
+    def __init__(self):
+        self.input_ids = None
+        self.past_key_values = None
+
+    def __len__(self):
+        return 0 if self.input_ids is None else self.input_ids.shape[1]
+
+    def clear(self):
+        self.input_ids = None
+        self.past_key_values = None
+
+    def update(self, input_ids, past_key_values):
+        self.past_key_values = past_key_values
+        self.input_ids = input_ids[:, :self._cache_length(past_key_values)]
+
+    @staticmethod
+    def _cache_length(past_key_values):
+        if hasattr(past_key_values, "get_seq_length"):
+            return past_key_values.get_seq_length()
+        return past_key_values[0][0].shape[2]
+
+    def prefix_length(self, input_ids):
+        """
+        Number of leading tokens of input_ids whose keys and values are cached.
+        """
+        if self.input_ids is None:
+            return 0
+        n = min(len(self), input_ids.shape[1])
+        mismatch = (self.input_ids[0, :n] != input_ids[0, :n]).nonzero()
+        return n if len(mismatch) == 0 else mismatch[0].item()
+
+    def crop(self, length):
+        if length == 0:
+            self.clear()
+        elif length < len(self):
+            if hasattr(self.past_key_values, "crop"):
+                self.past_key_values.crop(length)
+            else:
+                self.past_key_values = tuple(tuple(t[:, :, :length] for t in layer) for layer in self.past_key_values)
+            self.input_ids = self.input_ids[:, :length]
+
+
 class Chat:
-    def __init__(self, model_name, conv_mode, tokenizer, image_processor, vision_tower, model, replace_token):
+    def __init__(self, model_name, conv_mode, tokenizer, image_processor, vision_tower, model, replace_token,
+                 max_cached_sessions=4):
         self.model_name = model_name
         self.conv_mode = conv_mode
         self.tokenizer = tokenizer
@@ -40,17 +93,79 @@ class Chat:
         self.vision_tower = vision_tower
         self.model = model
         self.replace_token = replace_token
+        # KV caches take about 0.5 MB per token on the GPU, only the most recently used sessions keep theirs
+        self.max_cached_sessions = max_cached_sessions
+        self.prompt_caches = OrderedDict()
+        self.prompt_caches_lock = Lock()
 
     def upload_video(self, video, img_list):
+        """
+        Encodes the video once per session. img_list holds the spatio-temporal features and the PromptCache
+        of the conversation, so follow-up questions neither run the vision tower again nor prefill the whole
+        conversation.
+        """
         if isinstance(video, str):  # is a path
             frames = load_video(video)
             image_tensor = self.image_processor.preprocess(frames, return_tensors='pt')['pixel_values']
-            img_list.append(image_tensor)
+            img_list.append(self.encode_video(image_tensor))
+            img_list.append(PromptCache())
         else:
             raise NotImplementedError
         msg = "Received."
         return msg
 
+    def encode_video(self, image_tensor):
+        # Generate video spatio-temporal features
+        image_tensor = image_tensor.half().cuda()
+        with torch.no_grad():
+            image_forward_outs = self.vision_tower(image_tensor, output_hidden_states=True)
+            select_hidden_state_layer = -2  # Same as used in LLaVA
+            select_hidden_state = image_forward_outs.hidden_states[select_hidden_state_layer]
+            frame_features = select_hidden_state[:, 1:]
+        return self.get_spatio_temporal_features_torch(frame_features)
+
+    def use_prompt_cache(self, prompt_cache):
+        if self.max_cached_sessions <= 0:
+            prompt_cache.clear()
+            return
+        with self.prompt_caches_lock:
+            self.prompt_caches[id(prompt_cache)] = prompt_cache
+            self.prompt_caches.move_to_end(id(prompt_cache))
+            while len(self.prompt_caches) > self.max_cached_sessions:
+                _, evicted = self.prompt_caches.popitem(last=False)
+                evicted.clear()
+
+    def keep_prompt_cache(self, prompt_cache, input_ids, past_key_values):
+        """
+        Stores the KV cache of a finished turn, so the next turn only prefills the new question. A cache that was
+        evicted while its turn was generating is dropped instead, also the prefill of the turn, otherwise it would
+        be repopulated behind the back of max_cached_sessions.
+        """
+        with self.prompt_caches_lock:
+            if self.prompt_caches.get(id(prompt_cache)) is prompt_cache:
+                prompt_cache.update(input_ids, past_key_values)
+            else:
+                prompt_cache.clear()
+
+    def prefill(self, input_ids, video_spatio_temporal_features, prompt_cache):
+        """
+        Extends the KV cache of the session to all tokens of input_ids but the last one, which generate feeds.
+        The cached prefix is reused, the rest of the prompt (usually the new user message) is run through the model.
+        """
+        prefix_length = min(prompt_cache.prefix_length(input_ids), input_ids.shape[1] - 1)
+        vid_patch_token = self.model.get_model().vision_config.vid_patch_token
+        if prefix_length > 0 and (input_ids[0, prefix_length:] == vid_patch_token).any():
+            prefix_length = 0  # the video features can only be inserted by a prefill from the start
+        prompt_cache.crop(prefix_length)
+
+        outputs = self.model.get_model()(
+            input_ids=input_ids[:, prefix_length:-1],
+            past_key_values=prompt_cache.past_key_values,
+            use_cache=True,
+            video_spatio_temporal_features=video_spatio_temporal_features.unsqueeze(0) if prefix_length == 0 else None,
+            return_dict=True)
+        prompt_cache.update(input_ids[:, :-1], outputs.past_key_values)
+
     def get_spatio_temporal_features_torch(self, features):
         t, s, c = features.shape
         temporal_tokens = torch.mean(features, dim=1)
@@ -63,12 +178,7 @@ class Chat:
 
         return concat_tokens
 
-    def answer(self, state, img_list, temperature, max_new_tokens, first_run):
-        if state.skip_next:
-            # This generates call is skipped due to invalid inputs
-            yield (state, state.to_gradio_chatbot(), img_list, first_run) + (no_change_btn,) * 5
-            return
-
+    def start_turn(self, state, first_run):
         if first_run:
             conv_mode = self.conv_mode
             new_state = conv_templates[conv_mode].copy()
@@ -76,6 +186,15 @@ class Chat:
             new_state.append_message(new_state.roles[1], None)
             state = new_state
             first_run = False
+        return state, first_run
+
+    def answer(self, state, img_list, temperature, max_new_tokens, first_run):
+        if state.skip_next:
+            # This generates call is skipped due to invalid inputs
+            yield (state, state.to_gradio_chatbot(), img_list, first_run) + (no_change_btn,) * 5
+            return
+
+        state, first_run = self.start_turn(state, first_run)
 
         # Construct prompt
         prompt = state.get_prompt()
@@ -102,39 +221,138 @@ class Chat:
         state.messages[-1][-1] = ""
         yield (state, state.to_gradio_chatbot(), img_list, first_run) + (disable_btn,) * 5
 
-        image_tensor = img_list[0]
-        # Generate video spatio-temporal features
-        image_tensor = image_tensor.half().cuda()
-        with torch.no_grad():
-            image_forward_outs = self.vision_tower(image_tensor, output_hidden_states=True)
-            select_hidden_state_layer = -2  # Same as used in LLaVA
-            select_hidden_state = image_forward_outs.hidden_states[select_hidden_state_layer]
-            frame_features = select_hidden_state[:, 1:]
-        video_spatio_temporal_features = self.get_spatio_temporal_features_torch(frame_features)
-
-        with torch.inference_mode():
-            output_ids = self.model.generate(
-                input_ids,
-                video_spatio_temporal_features=video_spatio_temporal_features.unsqueeze(0),
-                do_sample=True,
-                temperature=float(temperature),
-                max_new_tokens=min(int(max_new_tokens), 1536),
-                stopping_criteria=[stopping_criteria])
-
-        input_token_len = input_ids.shape[1]
-        n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
-        if n_diff_input_output > 0:
-            print(f'[Warning] {n_diff_input_output} output_ids are not the same as the input_ids')
-        outputs = self.tokenizer.batch_decode(output_ids[:, input_token_len:], skip_special_tokens=True)[0]
-        outputs = outputs.strip()
-        if outputs.endswith(stop_str):
-            outputs = outputs[:-len(stop_str)]
-        outputs = outputs.strip()
-        output = post_process_code(outputs)
-        for character in output:
-            state.messages[-1][-1] += character
-            time.sleep(0.01)
-            yield (state, state.to_gradio_chatbot(), img_list, first_run) + (enable_btn,) * 5
-        # state.messages[-1][-1] = state.messages[-1][-1][:-1]
+        video_spatio_temporal_features, prompt_cache = img_list
+        self.use_prompt_cache(prompt_cache)
+
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=60)
+        generate_kwargs = dict(
+            input_ids=input_ids,
+            do_sample=True,
+            temperature=float(temperature),
+            max_new_tokens=min(int(max_new_tokens), 1536),
+            stopping_criteria=[stopping_criteria],
+            streamer=streamer,
+            return_dict_in_generate=True)
+
+        def generate():
+            # inference_mode is thread local, so it has to be entered in the generation thread
+            try:
+                with torch.inference_mode():
+                    self.prefill(input_ids, video_spatio_temporal_features, prompt_cache)
+                    outputs = self.model.generate(past_key_values=prompt_cache.past_key_values, **generate_kwargs)
+                self.keep_prompt_cache(prompt_cache, outputs.sequences, outputs.past_key_values)
+            except Exception:
+                logger.exception("generation failed")
+                prompt_cache.clear()
+                streamer.end()  # unblock the consumer
+
+        # Generation runs in a background thread, every decoded piece of text is shown as soon as it arrives
+        start_time = time.time()
+        thread = Thread(target=generate, daemon=True)
+        thread.start()
+
+        generated = ""
+        output = ""
+        first_token_time = None
+        for new_text in streamer:
+            if first_token_time is None:
+                first_token_time = time.time() - start_time
+            generated += new_text
+            visible, stopped = truncate_at_stop_str(generated, stop_str)
+            visible = post_process_code(visible.lstrip())
+            if visible != output:
+                output = visible
+                state.messages[-1][-1] = output
+                yield (state, state.to_gradio_chatbot(), img_list, first_run) + (disable_btn,) * 5
+            if stopped:
+                break
+        thread.join()
+
+        # a trailing partial match of the stop string was only held back while the answer could still complete it
+        visible, stopped = truncate_at_stop_str(generated, stop_str)
+        output = post_process_code((visible if stopped else generated).strip())
+        state.messages[-1][-1] = output
+        logger.info(f"time to first token {first_token_time}, total {time.time() - start_time:.2f}s")
+        logger.info(f"{output}")
+        yield (state, state.to_gradio_chatbot(), img_list, first_run) + (enable_btn,) * 5
+
+
+class RemoteChat(Chat):
+    """
+    Chat backed by a model worker (llavidal/serve/model_worker.py) instead of a model in this process.
+    The worker batches the requests of all users, so the demo can serve many sessions from one GPU.
+    img_list holds the id of the uploaded video on the worker and its local path, the video is uploaded
+    again if the worker evicted it from its cache.
+    """
+    def __init__(self, worker_url, conv_mode, timeout=600):
+        self.worker_url = worker_url.rstrip("/")
+        self.conv_mode = conv_mode
+        self.timeout = timeout
+
+    def upload_video(self, video, img_list):
+        if isinstance(video, str):  # is a path
+            img_list.append(self._upload(video))
+            img_list.append(video)
+        else:
+            raise NotImplementedError
+        msg = "Received."
+        return msg
+
+    def _upload(self, video_path):
+        with open(video_path, "rb") as f:
+            response = requests.post(self.worker_url + "/worker_upload_video", data=f, headers=headers, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()["video_id"]
+
+    def _generate_stream(self, pload):
+        response = requests.post(self.worker_url + "/worker_generate_stream", json=pload, headers=headers,
+                                 stream=True, timeout=self.timeout)
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                yield json.loads(chunk.decode())
+
+    def answer(self, state, img_list, temperature, max_new_tokens, first_run):
+        if state.skip_next:
+            # This generates call is skipped due to invalid inputs
+            yield (state, state.to_gradio_chatbot(), img_list, first_run) + (no_change_btn,) * 5
+            return
+
+        state, first_run = self.start_turn(state, first_run)
+        stop_str = state.sep if state.sep_style != SeparatorStyle.TWO else state.sep2
+        pload = {
+            "prompt": state.get_prompt(),
+            "video_id": img_list[0],
+            "temperature": float(temperature),
+            "max_new_tokens": min(int(max_new_tokens), 1536),
+            "stop": stop_str,
+        }
+
+        state.messages[-1][-1] = ""
+        yield (state, state.to_gradio_chatbot(), img_list, first_run) + (disable_btn,) * 5
+
+        start_time = time.time()
+        output = ""
+        try:
+            for attempt in range(2):
+                retry = False
+                for data in self._generate_stream(pload):
+                    if data["error_code"] == WORKER_ERROR_UNKNOWN_VIDEO and attempt == 0:
+                        img_list[0] = pload["video_id"] = self._upload(img_list[1])
+                        retry = True
+                        break
+                    if data["error_code"] != 0:
+                        output = data["text"] + f" (error_code: {data['error_code']})"
+                        break
+                    output = post_process_code(data["text"])
+                    state.messages[-1][-1] = output
+                    yield (state, state.to_gradio_chatbot(), img_list, first_run) + (disable_btn,) * 5
+                if not retry:
+                    break
+        except requests.exceptions.RequestException as e:
+            logger.error(f"worker request failed: {e}")
+            output = server_error_msg
+
+        state.messages[-1][-1] = output
+        logger.info(f"total {time.time() - start_time:.2f}s")
         logger.info(f"{output}")
         yield (state, state.to_gradio_chatbot(), img_list, first_run) + (enable_btn,) * 5
@@ -11,7 +11,7 @@ from llavidal.video_conversation import (default_conversation)
 from llavidal.utils import (build_logger, violates_moderation, moderation_msg)
 from llavidal.demo.gradio_patch import Chatbot as grChatbot
 from llavidal.utils import disable_torch_init
-from llavidal.demo.chat import Chat
+from llavidal.demo.chat import Chat, RemoteChat
 from llavidal.demo.template import tos_markdown, css, title_markdown, disclaimer, Seafoam
 from llavidal.eval.model_utils import initialize_model
 from llavidal.constants import *
@@ -248,10 +248,15 @@ def parse_args():
     parser.add_argument("--share", action="store_true")
     parser.add_argument("--moderate", action="store_true")
     parser.add_argument("--embed", action="store_true")
-    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--model-name", type=str, required=False)
+    parser.add_argument("--worker-url", type=str, default=None,
+                        help="Model worker (llavidal/serve/model_worker.py) serving the requests of all users in batches. "
+                             "Without it the model is loaded in this process")
     parser.add_argument("--vision_tower_name", type=str, default="openai/clip-vit-large-patch14")
     #parser.add_argument("--vision_tower_name", type=str, default="openai/clip-vit-base-patch32")
     parser.add_argument("--conv-mode", type=str, default="llavidal_v1")
+    parser.add_argument("--max-cached-sessions", type=int, default=4,
+                        help="Number of sessions that keep the KV cache of their conversation on the GPU")
     parser.add_argument("--projection_path", type=str, required=False, default="/home/rchakra6/llavidal/object_as_token.bin")
 
     args = parser.parse_args()
@@ -263,17 +268,23 @@ if __name__ == "__main__":
     args = parse_args()
     logger.info(f"args: {args}")
     logger.info(args)
-    disable_torch_init()
-
-    model, vision_tower, tokenizer, image_processor, video_token_len = \
-        initialize_model(args.model_name, args.projection_path)
-    #breakpoint()
-    # Create replace token, this will replace the <video> in the prompt.
-    replace_token = DEFAULT_VIDEO_PATCH_TOKEN * video_token_len
-    replace_token = DEFAULT_VID_START_TOKEN + replace_token + DEFAULT_VID_END_TOKEN
-
-    # Create chat for the demo
-    chat = Chat(args.model_name, args.conv_mode, tokenizer, image_processor, vision_tower, model, replace_token)
+    if args.worker_url is not None:
+        chat = RemoteChat(args.worker_url, args.conv_mode)
+    else:
+        if args.model_name is None:
+            raise ValueError("--model-name is required without --worker-url")
+        disable_torch_init()
+
+        os.environ.setdefault("LOCAL_RANK", "0")  # initialize_model picks the GPU from the launcher environment
+        model, vision_tower, tokenizer, image_processor, video_token_len, _ = \
+            initialize_model(args.model_name, args.projection_path)
+        # Create replace token, this will replace the <video> in the prompt.
+        replace_token = DEFAULT_VIDEO_PATCH_TOKEN * video_token_len
+        replace_token = DEFAULT_VID_START_TOKEN + replace_token + DEFAULT_VID_END_TOKEN
+
+        # Create chat for the demo
+        chat = Chat(args.model_name, args.conv_mode, tokenizer, image_processor, vision_tower, model, replace_token,
+                    max_cached_sessions=args.max_cached_sessions)
     print('Initialization Finished')
 
     demo = build_demo(args.embed)
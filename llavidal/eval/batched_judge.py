@@ -0,0 +1,194 @@
+"""
+Batched LLM judging: several question-answer pairs are scored by a single judge request.
+
+The batched prompt is built from the single-pair judge messages used everywhere else, so the
+system prompt and the scoring criterion of a metric stay the same. Only the response format
+changes: the judge answers with a JSON array [{"id": ..., "score": ...}, ...]. Every element is
+validated on its own, items with a missing or invalid score are retried in a smaller batch and
+items that still fail are returned to the caller, which can score them one at a time.
+"""
+import ast
+import json
+
+# header, fields and instruction of the user message of the single-pair judge prompts
+SINGLE_HEADER_SEPARATOR = '\n\n'
+SINGLE_INSTRUCTION_MARKER = '\n\nProvide your evaluation'
+SINGLE_FORMAT_MARKER = 'Please generate the response'
+
+BATCH_RESPONSE_FORMAT = (
+    "Please generate the response in the form of a JSON array with one object per pair, with keys 'id', the pair id as given, "
+    "and 'score', the score of that pair in INTEGER, not STRING. "
+    "DO NOT PROVIDE ANY OTHER OUTPUT TEXT OR EXPLANATION. Only provide the JSON array. "
+    'For example, your response should look like this: [{"id": "1", "score": 4}, {"id": "2", "score": 2}].'
+)
+
+MIN_SCORE = 0
+MAX_SCORE = 5
+
+
+def split_single_messages(messages):
+    """
+    Splits single-pair judge messages into (system prompt, pair fields, scoring criterion).
+    """
+    system_prompt = messages[0]['content']
+    user_content = messages[1]['content']
+    fields_start = user_content.index(SINGLE_HEADER_SEPARATOR) + len(SINGLE_HEADER_SEPARATOR)
+    fields_end = user_content.rindex(SINGLE_INSTRUCTION_MARKER)
+    fields = user_content[fields_start:fields_end]
+    instruction = user_content[fields_end + len(SINGLE_HEADER_SEPARATOR):]
+    criterion = instruction.split(SINGLE_FORMAT_MARKER)[0].strip()
+    return system_prompt, fields, criterion
+
+
+def build_batch_messages(single_messages):
+    """
+    Judge messages scoring several pairs at once.
+
+    Parameters:
+    single_messages (list): Single-pair judge messages of the same metric, one per pair.
+
+    Returns:
+    list: Messages whose response is a JSON array of {"id", "score"}, ids are "1".."K" in the order of single_messages.
+    """
+    system_prompt, _, criterion = split_single_messages(single_messages[0])
+    pairs = []
+    for i, messages in enumerate(single_messages):
+        _, fields, _ = split_single_messages(messages)
+        pairs.append(f"Pair id: {i + 1}\n{fields}")
+
+    user_content = (
+        f"Please evaluate the following {len(single_messages)} video-based question-answer pairs, each pair is evaluated on its own:\n\n"
+        + "\n\n".join(pairs) + "\n\n"
+        + f"For every pair: {criterion} "
+        + BATCH_RESPONSE_FORMAT
+    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_content},
+    ]
+
+
+def parse_batch_response(response, num_items):
+    """
+    Validates a batched judge response.
+
+    Every element must be an object with an 'id' between 1 and num_items and a numeric 'score'
+    between 0 and 5. Invalid elements and duplicated ids are dropped, the rest of the array is kept.
+
+    Returns:
+    dict: index (0-based) -> score of the valid elements.
+    """
+    # tolerate code fences and text around the array
+    start = response.find('[')
+    end = response.rfind(']')
+    if start == -1 or end <= start:
+        return {}
+    try:
+        elements = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        # judges sometimes answer with Python literals (single quotes), apostrophes inside strings must survive
+        try:
+            elements = ast.literal_eval(response[start:end + 1])
+        except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+            return {}
+    if not isinstance(elements, list):
+        return {}
+
+    scores = {}
+    duplicated = set()
+    for element in elements:
+        if not isinstance(element, dict) or 'id' not in element or 'score' not in element:
+            continue
+        try:
+            index = int(str(element['id']).strip()) - 1
+            score = float(element['score'])
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= index < num_items or not MIN_SCORE <= score <= MAX_SCORE:
+            continue
+        if index in scores:
+            duplicated.add(index)
+        scores[index] = int(score) if score.is_integer() else score
+
+    for index in duplicated:
+        del scores[index]
+    return scores
+
+
+def _single_pair_score(response):
+    """
+    Score of a cached single-pair judge response ("{'score': 4}"), None if it does not hold a valid one.
+    """
+    try:
+        score = float(ast.literal_eval(response)['score'])
+    except Exception:
+        return None
+    if not MIN_SCORE <= score <= MAX_SCORE:
+        return None
+    return int(score) if score.is_integer() else score
+
+
+def judge_in_batches(items, chat, batch_size=8, retries=3, cache=None, metric=None, model=None, verbose=False):
+    """
+    Scores items with batched judge requests.
+
+    Parameters:
+    items (list): (key, single-pair judge messages) of the same metric.
+    chat (callable): Sends judge messages and returns the response text, e.g. a wrapper of ollama.chat.
+    batch_size (int): Number of pairs per request.
+    retries (int): Number of extra requests for the items whose score was missing or invalid, only those are sent again.
+    cache (JudgeCache, optional): Looked up before the requests, the responses of the single-pair judge first, so switching
+        batch_size does not judge the cached pairs again. Filled with the batched scores after the requests.
+    metric (str, optional): Metric name of the cache entries.
+    model (str, optional): Judge model name of the cache entries.
+    verbose (bool): Print the judge responses.
+
+    Returns:
+    tuple: (scores, responses, failed): key -> score, key -> raw response of the request that scored the key,
+        and the keys that could not be scored.
+    """
+    scores = {}
+    responses = {}
+    pending = []
+    for key, messages in items:
+        if cache is not None:
+            cached = cache.get(metric, model, messages)
+            score = _single_pair_score(cached) if cached is not None else None
+            if score is not None:
+                scores[key] = score
+                responses[key] = cached
+                continue
+            cached = cache.get(f'{metric}/batched', model, messages)
+            if cached is not None:
+                scores[key] = json.loads(cached)['score']
+                responses[key] = cached
+                continue
+        pending.append((key, messages))
+
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        failed = []
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            try:
+                response = chat(build_batch_messages([messages for _, messages in batch]))
+            except Exception as e:
+                print(f"Error in batched judge request ({len(batch)} items): {e}")
+                failed.extend(batch)
+                continue
+            if verbose:
+                print(response)
+
+            batch_scores = parse_batch_response(response, len(batch))
+            for index, (key, messages) in enumerate(batch):
+                if index not in batch_scores:
+                    failed.append((key, messages))
+                    continue
+                scores[key] = batch_scores[index]
+                responses[key] = response
+                if cache is not None:
+                    cache.put(f'{metric}/batched', model, messages, json.dumps({'score': batch_scores[index]}))
+        pending = failed
+
+    return scores, responses, [key for key, _ in pending]
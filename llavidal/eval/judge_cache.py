@@ -0,0 +1,99 @@
+"""
+Persistent, content-addressed cache of LLM judge responses.
+
+A response is keyed by the hash of (metric, judge model, full judge messages). The messages contain the
+prompt template as well as the question, answer and prediction, so a cache entry is only reused when
+all of them are unchanged. Editing a prompt, switching the judge model or changing a prediction
+therefore naturally misses the cache, while re-evaluating an unchanged prediction costs a single
+SQLite lookup.
+
+The cache is a single SQLite file that can be shared by all metrics and by several processes.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_JUDGE_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'llavidal', 'judge_cache.sqlite')
+
+
+def make_judge_key(metric, model, messages):
+    """
+    Content hash identifying a judge request.
+
+    Parameters:
+    metric (str): Name of the metric, e.g. 'correctness'.
+    model (str): Name of the judge model, e.g. 'llama3.1'.
+    messages (list): The chat messages sent to the judge (prompt template filled with the inputs).
+
+    Returns:
+    str: Hex digest of the request.
+    """
+    payload = json.dumps({'metric': metric, 'model': model, 'messages': messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class JudgeCache(object):
+    """
+    SQLite backed judge-response cache.
+
+    Only responses that were successfully parsed should be put in the cache, so that a malformed
+    response is asked again on the next run. Passing path=None gives a disabled cache whose get()
+    always misses, which keeps the call sites free of special cases.
+    """
+    def __init__(self, path=DEFAULT_JUDGE_CACHE_PATH):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    @property
+    def conn(self):
+        # connections must not be shared across fork(), so every process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS judge_cache ('
+                'key TEXT PRIMARY KEY, metric TEXT, model TEXT, response TEXT, created_at REAL)'
+            )
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, metric, model, messages):
+        """
+        Returns the cached raw judge response, or None on a cache miss.
+        """
+        if not self.enabled:
+            return None
+        row = self.conn.execute(
+            'SELECT response FROM judge_cache WHERE key = ?', (make_judge_key(metric, model, messages),)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, metric, model, messages, response):
+        if not self.enabled:
+            return
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO judge_cache (key, metric, model, response, created_at) VALUES (?, ?, ?, ?, ?)',
+                (make_judge_key(metric, model, messages), metric, model, response, time.time())
+            )
+
+    def __len__(self):
+        if not self.enabled:
+            return 0
+        return self.conn.execute('SELECT COUNT(*) FROM judge_cache').fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
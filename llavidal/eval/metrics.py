@@ -0,0 +1,369 @@
+"""
+Columnar metric aggregation for evaluation outputs.
+
+Any result file written by the evaluation scripts is loaded into a ResultTable, one NumPy array
+per field, and every metric is computed on those arrays:
+- lists of records in JSON or JSONL (eval_adlxmcq, eval_charades_desc, eval_tsu_desc, merged shards),
+- dicts of id -> [response_dict, qa_set] (evaluate_benchmark_*),
+- dicts of id -> record (evaluate_action_recognition_*).
+
+Parsed tables are cached in memory and on disk (keyed by path, size and mtime), so recomputing the
+metrics of an unchanged result file only loads a .npz file instead of parsing the JSON again.
+
+Usage (summary of one or several checkpoints):
+python -m llavidal.eval.metrics <results_1.json> <results_2.jsonl> ... --threshold 2 --num_resamples 1000
+"""
+import argparse
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DEFAULT_METRICS_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'llavidal', 'metrics')
+
+# judge scores are between 0 and 5, the papers report them multiplied by 20
+JUDGE_SCORE_SCALE = 20
+
+
+class ResultTable(object):
+    """
+    Columnar view of a result file: ids plus one array per scalar field.
+
+    Numeric fields are float64 arrays with NaN for missing values, all other fields are unicode
+    arrays with '' for missing values. Nested values (lists, dicts) are not kept.
+    """
+    def __init__(self, ids, columns):
+        self.ids = ids
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def keys(self):
+        return self.columns.keys()
+
+    def score_columns(self):
+        """
+        Names of the judge score columns ('score' or 'score_<metric>').
+        """
+        return [name for name in self.columns if (name == 'score' or name.startswith('score_')) and self.columns[name].dtype.kind == 'f']
+
+
+def _flatten_record(record):
+    if isinstance(record, (list, tuple)):
+        # evaluate_benchmark_* results are [response_dict, qa_set]
+        flat = {}
+        for part in record:
+            if isinstance(part, dict):
+                flat.update(part)
+        return flat
+    if isinstance(record, dict):
+        return record
+    return {'value': record}
+
+
+def _iter_records(path):
+    if path.endswith('.jsonl'):
+        with open(path) as file:
+            for i, line in enumerate(file):
+                line = line.strip()
+                if line:
+                    yield str(i), _flatten_record(json.loads(line))
+        return
+
+    with open(path) as file:
+        content = json.load(file)
+    if isinstance(content, dict):
+        for key, record in content.items():
+            yield str(key), _flatten_record(record)
+    else:
+        for i, record in enumerate(content):
+            yield str(i), _flatten_record(record)
+
+
+def _to_column(values):
+    scalars = [v for v in values if v is not None]
+    if all(isinstance(v, (int, float)) for v in scalars):
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    return np.array(['' if v is None else str(v) for v in values])
+
+
+def parse_results(path):
+    """
+    Parse a result file into a ResultTable without using the cache.
+    """
+    ids = []
+    records = []
+    for key, record in _iter_records(path):
+        ids.append(key)
+        records.append(record)
+
+    names = []
+    seen = set()
+    for record in records:
+        for name, value in record.items():
+            if name not in seen and not isinstance(value, (dict, list, tuple)):
+                seen.add(name)
+                names.append(name)
+
+    columns = {}
+    for name in names:
+        values = [record.get(name) for record in records]
+        # a field that is nested in some records is only kept where it is scalar
+        values = [None if isinstance(v, (dict, list, tuple)) else v for v in values]
+        columns[name] = _to_column(values)
+
+    return ResultTable(np.array(ids), columns)
+
+
+def _get_cache_path(path, cache_dir):
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return os.path.join(cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.npz')
+
+
+_memory_cache = {}
+
+
+def load_results(path, cache_dir=DEFAULT_METRICS_CACHE_DIR):
+    """
+    Load a result file into a ResultTable, using the in-memory and on-disk caches.
+
+    Parameters:
+    path (str): Result file (.json or .jsonl).
+    cache_dir (str, optional): Directory of the parsed-array cache. None disables the on-disk cache.
+
+    Returns:
+    ResultTable: The parsed results.
+    """
+    cache_path = _get_cache_path(path, cache_dir or DEFAULT_METRICS_CACHE_DIR)
+    if cache_path in _memory_cache:
+        return _memory_cache[cache_path]
+
+    if cache_dir and os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as arrays:
+            columns = {name[len('col_'):]: arrays[name] for name in arrays.files if name.startswith('col_')}
+            table = ResultTable(arrays['ids'], columns)
+    else:
+        table = parse_results(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = cache_path + '.tmp.npz'
+            np.savez(tmp_path, ids=table.ids, **{f'col_{name}': column for name, column in table.columns.items()})
+            os.replace(tmp_path, cache_path)
+
+    _memory_cache[cache_path] = table
+    return table
+
+
+'''
+# > Metrics
+'''
+def accuracy(predictions, targets, mask=None):
+    """
+    Fraction of predictions equal to the targets.
+
+    Parameters:
+    predictions (np.ndarray): Predicted labels.
+    targets (np.ndarray): True labels.
+    mask (np.ndarray, optional): Boolean mask of the samples to count. Defaults to all samples.
+    """
+    correct = np.asarray(predictions) == np.asarray(targets)
+    if mask is not None:
+        correct = correct[mask]
+    return float(correct.mean()) if correct.size else float('nan')
+
+
+def grouped_mean(values, groups):
+    """
+    Mean of values per group, e.g. the accuracy per benchmark or per class.
+
+    Returns:
+    dict: group -> mean.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    labels, inverse = np.unique(np.asarray(groups), return_inverse=True)
+    sums = np.bincount(inverse, weights=values, minlength=len(labels))
+    counts = np.bincount(inverse, minlength=len(labels))
+    return {label: float(s / c) for label, s, c in zip(labels.tolist(), sums, counts)}
+
+
+def confusion_matrix(predictions, targets, labels=None):
+    """
+    Confusion matrix with the true labels as rows and the predicted labels as columns.
+
+    Parameters:
+    predictions (np.ndarray): Predicted labels.
+    targets (np.ndarray): True labels.
+    labels (list, optional): Label order. Defaults to the sorted union of both arrays. Samples with
+        a label outside of labels (e.g. an unparsable prediction) are not counted.
+
+    Returns:
+    tuple: (matrix (np.ndarray of int64, len(labels) x len(labels)), labels (np.ndarray)).
+    """
+    predictions = np.asarray(predictions)
+    targets = np.asarray(targets)
+    if labels is None:
+        labels = np.union1d(np.unique(predictions), np.unique(targets))
+    labels = np.asarray(labels)
+    num_labels = len(labels)
+
+    order = np.argsort(labels)
+    sorted_labels = labels[order]
+
+    def index_of(values):
+        positions = np.clip(np.searchsorted(sorted_labels, values), 0, num_labels - 1)
+        found = sorted_labels[positions] == values
+        return np.where(found, order[positions], -1)
+
+    target_index = index_of(targets)
+    prediction_index = index_of(predictions)
+    valid = (target_index >= 0) & (prediction_index >= 0)
+    flat_index = target_index[valid] * num_labels + prediction_index[valid]
+    matrix = np.bincount(flat_index, minlength=num_labels * num_labels).reshape(num_labels, num_labels)
+    return matrix, labels
+
+
+def threshold_metric(scores, threshold=2):
+    """
+    Fraction of scores equal or greater than threshold, NaN scores are ignored.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    scores = scores[~np.isnan(scores)]
+    return float((scores >= threshold).mean()) if scores.size else float('nan')
+
+
+def bootstrap_ci(values, statistic=np.mean, num_resamples=1000, confidence=0.95, seed=0, max_chunk_elements=2 ** 24):
+    """
+    Percentile bootstrap confidence interval, computed on all resamples at once.
+
+    Parameters:
+    values (np.ndarray): Per-sample values, e.g. 0/1 correctness or judge scores. NaNs are dropped.
+    statistic (callable): Reduction called as statistic(resamples, axis=1).
+    num_resamples (int): Number of bootstrap resamples.
+    confidence (float): Confidence level of the interval.
+    seed (int): Seed of the resampling, the interval is reproducible for a given seed.
+    max_chunk_elements (int): Upper bound on the size of the resample matrix held in memory.
+
+    Returns:
+    tuple: (lower, upper).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    num_values = len(values)
+    if num_values == 0:
+        return float('nan'), float('nan')
+
+    rng = np.random.default_rng(seed)
+    unique_values, counts = np.unique(values, return_counts=True)
+    if statistic is np.mean and len(unique_values) < num_values:
+        # correctness (0/1) and judge scores (0-5) take few distinct values, drawing how often each
+        # value is resampled gives the same bootstrap distribution of the mean at a fraction of the cost
+        draws = rng.multinomial(num_values, counts / num_values, size=num_resamples)
+        estimates = draws @ unique_values / num_values
+    else:
+        chunk_size = max(1, max_chunk_elements // num_values)
+        estimates = []
+        for start in range(0, num_resamples, chunk_size):
+            num_chunk = min(chunk_size, num_resamples - start)
+            indices = rng.integers(0, num_values, size=(num_chunk, num_values))
+            estimates.append(statistic(values[indices], axis=1))
+        estimates = np.concatenate(estimates)
+
+    alpha = (1 - confidence) / 2
+    lower, upper = np.quantile(estimates, [alpha, 1 - alpha])
+    return float(lower), float(upper)
+
+
+def summarize_scores(scores, threshold=2, num_resamples=1000, confidence=0.95):
+    """
+    Summary of judge scores: mean, score to report (mean * 20), threshold metric and bootstrap CI of the mean.
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    valid = scores[~np.isnan(scores)]
+    mean = float(valid.mean()) if valid.size else float('nan')
+    lower, upper = bootstrap_ci(valid, num_resamples=num_resamples, confidence=confidence)
+    return {
+        'count': int(valid.size),
+        'mean': mean,
+        'score_to_report': mean * JUDGE_SCORE_SCALE,
+        'ci': (lower, upper),
+        'threshold_metric': threshold_metric(valid, threshold),
+    }
+
+
+def summarize_mcq(table, prediction_column='parsed_answer_from_llm', target_column='ground_truth_letter', group_column=None,
+                  num_resamples=1000, confidence=0.95):
+    """
+    Summary of a multiple choice result table: accuracy with bootstrap CI, per-class recall and
+    optionally the accuracy per group (e.g. per benchmark).
+    """
+    predictions = table[prediction_column]
+    targets = table[target_column]
+    correct = (predictions == targets).astype(np.float64)
+    matrix, labels = confusion_matrix(predictions, targets, labels=np.unique(targets))
+
+    summary = {
+        'count': len(correct),
+        'accuracy': float(correct.mean()) if len(correct) else float('nan'),
+        'ci': bootstrap_ci(correct, num_resamples=num_resamples, confidence=confidence),
+        'confusion_matrix': matrix,
+        'labels': labels,
+        # per-class accuracy, unparsable predictions count as wrong here unlike in the confusion matrix
+        'per_class_recall': grouped_mean(correct, targets),
+    }
+    if group_column is not None and group_column in table:
+        summary['per_group_accuracy'] = grouped_mean(correct, table[group_column])
+    return summary
+
+
+def summarize(path, threshold=2, num_resamples=1000, confidence=0.95, group_column=None, cache_dir=DEFAULT_METRICS_CACHE_DIR):
+    """
+    All metrics that apply to a result file: MCQ accuracy if it has parsed answers and ground truth
+    letters, and a judge score summary for every score column.
+    """
+    table = load_results(path, cache_dir=cache_dir)
+    summary = {'path': path, 'count': len(table)}
+    if 'parsed_answer_from_llm' in table and 'ground_truth_letter' in table:
+        summary['mcq'] = summarize_mcq(table, group_column=group_column, num_resamples=num_resamples, confidence=confidence)
+    for name in table.score_columns():
+        summary[name] = summarize_scores(table[name], threshold=threshold, num_resamples=num_resamples, confidence=confidence)
+    return summary
+
+
+def _print_summary(summary, confidence):
+    print(f"{summary['path']} ({summary['count']} samples)")
+    if 'mcq' in summary:
+        mcq = summary['mcq']
+        print(f"    accuracy: {mcq['accuracy'] * 100:.2f}% ({confidence * 100:.0f}% CI {mcq['ci'][0] * 100:.2f}-{mcq['ci'][1] * 100:.2f})")
+        print("    per-class recall: " + ", ".join(f"{label}: {recall * 100:.2f}%" for label, recall in mcq['per_class_recall'].items()))
+        for group, group_accuracy in mcq.get('per_group_accuracy', {}).items():
+            print(f"    {group}: {group_accuracy * 100:.2f}%")
+    for name, scores in summary.items():
+        if isinstance(scores, dict) and 'score_to_report' in scores:
+            print(f"    {name}: mean {scores['mean']:.4f}, score to report {scores['score_to_report']:.2f} "
+                  f"({confidence * 100:.0f}% CI {scores['ci'][0] * JUDGE_SCORE_SCALE:.2f}-{scores['ci'][1] * JUDGE_SCORE_SCALE:.2f}), "
+                  f"threshold metric {scores['threshold_metric']:.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute accuracy, judge scores and bootstrap confidence intervals of result files.")
+    parser.add_argument("paths", nargs='+', help="Result files (.json or .jsonl).")
+    parser.add_argument("--threshold", type=float, default=2, help="Judge scores equal or greater than threshold are considered correct.")
+    parser.add_argument("--num_resamples", type=int, default=1000, help="Number of bootstrap resamples.")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals.")
+    parser.add_argument("--group_column", type=str, default=None, help="Field to report the MCQ accuracy per group of.")
+    parser.add_argument("--cache_dir", type=str, default=DEFAULT_METRICS_CACHE_DIR, help="Cache of parsed result arrays, pass an empty string to disable it.")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        summary = summarize(path, threshold=args.threshold, num_resamples=args.num_resamples, confidence=args.confidence,
+                            group_column=args.group_column, cache_dir=args.cache_dir)
+        _print_summary(summary, args.confidence)
@@ -1,5 +1,6 @@
 
 from llavidal.model import LLAVIDALLlamaForCausalLM
+from llavidal.model.multimodal_projector import load_projector_weights
 from llavidal.utils import disable_torch_init
 from llavidal.constants import *
 import os
@@ -109,7 +110,7 @@ def initialize_model(model_name, projection_path=None, use_token_modality_prefix
                                                          use_cache=True)
     
     hidden_size_video_encoder = 1024
-    model.model.mm_projector = torch.nn.Linear(hidden_size_video_encoder, model.config.hidden_size).to(model.dtype)
+    model.get_model().mm_projectors.video = torch.nn.Linear(hidden_size_video_encoder, model.config.hidden_size).to(model.dtype)
 
     # Load image processor
     image_processor = CLIPImageProcessor.from_pretrained(model.config.mm_vision_tower, torch_dtype=torch.float16)
@@ -163,14 +164,20 @@ def initialize_model(model_name, projection_path=None, use_token_modality_prefix
     # Load the weights from projection_path after resizing the token_embeddings
     if projection_path:
         print(f"Loading weights from {projection_path}")
-        projector_weights = torch.load(projection_path, map_location='cpu')
+        projector_weights = load_projector_weights(projection_path)
         print(f'All keys of weights to load projector_weights: {projector_weights.keys()}')
 
         # lm_head weights are not expected in the projection weights
         if any('lm_head' in key for key in projector_weights.keys()):
             raise ValueError("lm_head weights are not expected in the projection weights. If you want to load lm_head comment out this line")
         
-        if 'model.embed_tokens.weight' in projector_weights:
+        embed_tokens_weight = projector_weights.get('model.embed_tokens.weight')
+        if embed_tokens_weight is not None and mm_use_vid_start_end and embed_tokens_weight.shape[0] <= len(modality_prefix_tokens):
+            # adapter checkpoints (projector_checkpoint.py) only keep the rows of the new start/end tokens
+            print(f'Loading the embeddings of the {embed_tokens_weight.shape[0]} start/end tokens')
+            embed_tokens = model.get_model().embed_tokens.weight
+            embed_tokens.data[-embed_tokens_weight.shape[0]:] = projector_weights.pop('model.embed_tokens.weight').to(embed_tokens.dtype)
+        elif 'model.embed_tokens.weight' in projector_weights:
             print(f'Vocab size & embedding size of loaded model (i.e., model.embed_tokens.weight of projector_weights): {projector_weights["model.embed_tokens.weight"].shape}')
 
             vocab_size_of_proj = projector_weights['model.embed_tokens.weight'].shape[0]
@@ -0,0 +1,156 @@
+"""
+Sharded result aggregation for distributed evaluation.
+
+Every rank appends its per-sample results to its own JSONL shard and only the scalar
+counters (e.g. correct/total, score sums) go through the process group. Once all ranks
+are done, rank 0 streams the shards into the final JSON/JSONL file without ever holding
+the full result list in memory.
+
+Usage (merging the shards of a finished or interrupted run by hand):
+python -m llavidal.eval.result_shards --shard_dir <output_dir>/<output_name>_shards --output <output_dir>/<output_name>.json
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+
+
+def get_shard_dir(output_dir, output_name):
+    """
+    Directory holding the per-rank shards of a run.
+    """
+    return os.path.join(output_dir, f"{output_name}_shards")
+
+
+def get_shard_path(shard_dir, rank):
+    return os.path.join(shard_dir, f"rank{rank:05d}.jsonl")
+
+
+class ShardWriter(object):
+    """
+    Appends result records of one rank to a JSONL shard. Records are flushed as they are
+    written so that the shard is usable even if the run dies midway.
+    """
+    def __init__(self, output_dir, output_name, rank):
+        self.shard_dir = get_shard_dir(output_dir, output_name)
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.path = get_shard_path(self.shard_dir, rank)
+        self.file = open(self.path, 'w')
+        self.num_records = 0
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.num_records += 1
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def reduce_counters(counters):
+    """
+    Sum a list of scalar counters over all ranks of the default process group.
+
+    Parameters:
+    counters (list): Numbers (int or float) local to this rank.
+
+    Returns:
+    list: The summed counters, identical on every rank.
+    """
+    import torch
+    import torch.distributed as dist
+
+    # float64 keeps the integer counts exact and works with both the gloo and nccl backends
+    device = 'cuda' if dist.get_backend() == 'nccl' else 'cpu'
+    tensor = torch.tensor(counters, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+
+    return [int(v) if v.is_integer() else v for v in tensor.tolist()]
+
+
+def iter_shard_records(shard_dir, num_shards=None):
+    """
+    Yield the records of all shards in rank order.
+
+    Parameters:
+    shard_dir (str): Directory containing the rank*.jsonl shards.
+    num_shards (int, optional): Only read the shards of ranks [0, num_shards). Stale shards left
+        behind by an earlier run with a larger world size are ignored this way. Defaults to all shards.
+    """
+    if num_shards is None:
+        shard_paths = sorted(glob.glob(os.path.join(shard_dir, 'rank*.jsonl')))
+    else:
+        shard_paths = [get_shard_path(shard_dir, rank) for rank in range(num_shards)]
+
+    for shard_path in shard_paths:
+        with open(shard_path) as file:
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def merge_shards(shard_dir, output_path, num_shards=None, output_format=None, remove_shards=False):
+    """
+    Stream the shards into a single output file, one record at a time.
+
+    Parameters:
+    shard_dir (str): Directory containing the rank*.jsonl shards.
+    output_path (str): Path of the merged file.
+    num_shards (int, optional): Number of ranks to merge. Defaults to all shards in shard_dir.
+    output_format (str, optional): 'json' (a list, formatted like json.dump(..., indent=4)) or 'jsonl'.
+        Defaults to the extension of output_path.
+    remove_shards (bool): Delete shard_dir after a successful merge.
+
+    Returns:
+    int: Number of merged records.
+    """
+    if output_format is None:
+        output_format = 'jsonl' if output_path.endswith('.jsonl') else 'json'
+    assert output_format in ('json', 'jsonl'), f"Unknown output format '{output_format}'"
+
+    num_records = 0
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        if output_format == 'jsonl':
+            for record in iter_shard_records(shard_dir, num_shards):
+                file.write(json.dumps(record) + '\n')
+                num_records += 1
+        else:
+            file.write('[')
+            for record in iter_shard_records(shard_dir, num_shards):
+                # indenting every line of the element by 4 spaces gives the same layout as dumping the whole list
+                element = json.dumps(record, indent=4).replace('\n', '\n    ')
+                file.write((',\n    ' if num_records > 0 else '\n    ') + element)
+                num_records += 1
+            file.write('\n]' if num_records > 0 else ']')
+    os.replace(tmp_path, output_path)
+
+    if remove_shards:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+    return num_records
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge per-rank result shards into a single JSON/JSONL file.")
+    parser.add_argument("--shard_dir", type=str, required=True, help="Directory containing the rank*.jsonl shards.")
+    parser.add_argument("--output", type=str, required=True, help="Path of the merged file (.json or .jsonl).")
+    parser.add_argument("--num_shards", type=int, default=None, help="Number of ranks to merge. Defaults to all shards.")
+    parser.add_argument("--remove_shards", action='store_true', help="Delete the shard directory after merging.")
+    args = parser.parse_args()
+
+    num_records = merge_shards(args.shard_dir, args.output, num_shards=args.num_shards, remove_shards=args.remove_shards)
+    print(f"Merged {num_records} records into {args.output}")
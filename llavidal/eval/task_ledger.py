@@ -0,0 +1,131 @@
+"""
+SQLite task ledger for the judge-based benchmark evaluators.
+
+Every prediction is a row (id, status, score, raw judge response, result). Workers record their
+results in batches, the driver asks the ledger for the pending ids with a single indexed query
+and the final combination is one scan over the table, instead of listing the output directory,
+testing list membership and opening one small JSON file per sample.
+
+The ledger lives next to the other outputs of a run, so an interrupted run resumes where it
+stopped when it is started again with the same output_dir.
+"""
+import json
+import os
+import sqlite3
+import time
+
+TASK_LEDGER_NAME = 'task_ledger.sqlite'
+
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def get_ledger_path(output_dir):
+    return os.path.join(output_dir, TASK_LEDGER_NAME)
+
+
+class TaskLedger(object):
+    """
+    Tracks the status of every evaluation task of a run.
+
+    Results passed to record() are buffered and committed every batch_size records, call
+    flush() (or close()) when a worker is done. Failed tasks stay pending, so they are retried
+    by the next pass of the driver loop.
+    """
+    def __init__(self, path, batch_size=64):
+        self.path = path
+        self.batch_size = batch_size
+        self._buffer = []
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # connections must not be shared across fork(), so every pool worker opens its own
+        if self._conn is None or self._pid != os.getpid():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS tasks ('
+                'id TEXT PRIMARY KEY, status TEXT NOT NULL, score REAL, response TEXT, result TEXT, '
+                'error TEXT, updated_at REAL)'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)')
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def add_tasks(self, task_ids):
+        """
+        Register tasks, ids that are already in the ledger keep their status.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO tasks (id, status, updated_at) VALUES (?, ?, ?)',
+                [(task_id, STATUS_PENDING, time.time()) for task_id in task_ids]
+            )
+
+    def pending_ids(self):
+        """
+        Ids of all tasks that are not done yet, in the order they were added.
+        """
+        rows = self.conn.execute(
+            'SELECT id FROM tasks WHERE status != ? ORDER BY rowid', (STATUS_DONE,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self, status=None):
+        if status is None:
+            return self.conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+        return self.conn.execute('SELECT COUNT(*) FROM tasks WHERE status = ?', (status,)).fetchone()[0]
+
+    def record(self, task_id, result, response=None, score=None):
+        """
+        Mark a task as done.
+
+        Parameters:
+        task_id (str): Id of the task.
+        result: JSON serializable result of the task, returned as is by iter_results().
+        response (str, optional): Raw judge response.
+        score (optional): Numeric score, stored in its own column for cheap aggregation.
+        """
+        try:
+            score = float(score)
+        except (TypeError, ValueError):
+            score = None
+        self._buffer.append((STATUS_DONE, score, response, json.dumps(result), None, time.time(), task_id))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def record_failure(self, task_id, error):
+        self._buffer.append((STATUS_FAILED, None, None, None, str(error), time.time(), task_id))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE tasks SET status = ?, score = ?, response = ?, result = ?, error = ?, updated_at = ? WHERE id = ?',
+                self._buffer
+            )
+        self._buffer = []
+
+    def iter_results(self):
+        """
+        Yield (id, result) of all finished tasks in the order they were added.
+        """
+        cursor = self.conn.execute('SELECT id, result FROM tasks WHERE status = ? ORDER BY rowid', (STATUS_DONE,))
+        for task_id, result in cursor:
+            yield task_id, json.loads(result)
+
+    def close(self):
+        self.flush()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,57 @@
+"""
+Usage:
+python3 -m llavidal.model.apply_delta --base-model-path ~/model_weights/llama-7b --delta-path ~/model_weights/llavidal-7b-delta --target-model-path ~/model_weights/llavidal-7b
+
+Counterpart of make_delta.py, the checkpoints are streamed tensor by tensor as well.
+"""
+import argparse
+
+import torch
+
+from llavidal.model.make_delta import DTYPES, CheckpointReader, push_to_hub, write_sharded_checkpoint
+
+
+def apply_delta(base_model_path, delta_path, target_model_path, hub_repo_id=None, dtype=torch.float16,
+                max_shard_size=5 * 2 ** 30):
+    """
+    Writes base + delta. The sums are computed in float32 and rounded once to dtype. Tensors and rows of the
+    delta that are not in the base model (projectors, new tokens) are taken as they are.
+    """
+    base = CheckpointReader(base_model_path)
+    delta = CheckpointReader(delta_path)
+
+    specs = {}
+    for name in delta.keys():
+        shape, delta_dtype = delta.shape_and_dtype(name)
+        if name in base:
+            base_shape = base.shape_and_dtype(name)[0]
+            assert len(base_shape) == len(shape) and all(b <= d for b, d in zip(base_shape, shape)), \
+                f'{name} dimension mismatch: {shape} vs {base_shape}'
+        specs[name] = (shape, dtype if delta_dtype.is_floating_point else delta_dtype)
+
+    def compute_target(name):
+        tensor = delta.get_tensor(name)
+        if name in base and tensor.is_floating_point():
+            base_tensor = base.get_tensor(name)
+            tensor = tensor.float()
+            tensor[tuple(slice(0, s) for s in base_tensor.shape)] += base_tensor.float()
+        return tensor.to(specs[name][1])
+
+    write_sharded_checkpoint(target_model_path, specs, compute_target, max_shard_size=max_shard_size, desc="Applying delta")
+    delta.copy_non_weight_files(target_model_path)
+    if hub_repo_id:
+        push_to_hub(target_model_path, hub_repo_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-model-path", type=str, required=True)
+    parser.add_argument("--delta-path", type=str, required=True)
+    parser.add_argument("--target-model-path", type=str, required=True)
+    parser.add_argument("--hub-repo-id", type=str, default=None)
+    parser.add_argument("--dtype", type=str, default="float16", choices=list(DTYPES))
+    parser.add_argument("--max-shard-size-gb", type=float, default=5)
+    args = parser.parse_args()
+
+    apply_delta(args.base_model_path, args.delta_path, args.target_model_path, args.hub_repo_id,
+                dtype=DTYPES[args.dtype], max_shard_size=int(args.max_shard_size_gb * 2 ** 30))
@@ -1,12 +1,17 @@
+from functools import partial
 from typing import List, Optional, Tuple, Union
 import torch
 import pickle
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
 from transformers import AutoConfig, AutoModelForCausalLM, LlamaConfig, LlamaModel, LlamaForCausalLM
 from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutputWithPast
 
 from ..constants import * # contains the default tokens for the modality prefixes
+from .multimodal_projector import (MultiModalProjector, legacy_keys_load_state_dict_pre_hook, legacy_keys_state_dict_hook,
+                                   load_projector_weights, rename_projector_keys)
 
 # DEFAULT_VIDEO_TOKEN = "<video>"
 # DEFAULT_VIDEO_PATCH_TOKEN = "<vid_patch>"
@@ -58,17 +63,86 @@ class LLAVIDALLlamaModel(LlamaModel):
             self.vision_config = VisionConfig()
 
         # initialize the projectors
+        in_features = {}
         if hasattr(config, "use_mm_proj") and modality_args is not None:
             if modality_args['video']:
-                self.mm_projector = nn.Linear(config.mm_hidden_size, config.hidden_size)
+                in_features['video'] = config.mm_hidden_size
 
             if modality_args['object']:
-                self.mm_projector_forobject = nn.Linear(self.vision_config.hidden_size_object, self.config.hidden_size)
+                in_features['object'] = self.vision_config.hidden_size_object
 
             if modality_args['pose']:
-                self.mm_projector_forpose = nn.Linear(self.vision_config.hidden_size_pose, self.config.hidden_size)
+                in_features['pose'] = self.vision_config.hidden_size_pose
         else: # at inference
-            self.mm_projector = nn.Linear(config.mm_hidden_size, config.hidden_size)
+            in_features['video'] = config.mm_hidden_size
+        self.mm_projectors = MultiModalProjector(config.hidden_size, in_features,
+                                                 projector_type=getattr(config, "mm_projector_type", "linear"))
+
+        # state dicts keep the projector keys of mm_projector.bin, e.g. model.mm_projector.weight
+        self._register_state_dict_hook(legacy_keys_state_dict_hook)
+        self._register_load_state_dict_pre_hook(legacy_keys_load_state_dict_pre_hook)
+
+        # trainable rows of the new modality tokens when only the adapters train, see train_new_token_embeddings
+        self.register_parameter("new_token_embeddings", None)
+
+        # activation memory of training, see set_activation_memory
+        self.checkpoint_layers = None  # indices of the decoder layers recomputed in the backward pass, None for all
+        self.offload_activations = False
+
+    # the projectors under their names in mm_projector.bin, AttributeError for the modalities not in use
+    @property
+    def mm_projector(self):
+        return self.mm_projectors.video
+
+    @property
+    def mm_projector_forobject(self):
+        return self.mm_projectors.object
+
+    @property
+    def mm_projector_forpose(self):
+        return self.mm_projectors.pose
+
+    def train_new_token_embeddings(self, first_token_id):
+        """
+        Trains only the rows of the input embeddings from first_token_id on, i.e. the new modality tokens. The rows
+        are a separate float32 parameter, so embed_tokens stays frozen and has neither gradients nor optimizer state.
+        """
+        self.embed_tokens.requires_grad_(False)
+        self.new_token_embeddings = nn.Parameter(self.embed_tokens.weight.data[first_token_id:].detach().clone().float())
+
+    def set_activation_memory(self, checkpoint_layers="all", offload_activations=False):
+        """
+        Configures the activation memory of training. The layer policy applies once gradient checkpointing is
+        enabled (gradient_checkpointing_enable, e.g. by the Trainer with --gradient_checkpointing).
+
+        Parameters:
+        checkpoint_layers (str): Decoder layers recomputed in the backward pass: "all", "every_<k>" for every k-th
+            layer or a fraction of the layers, e.g. "0.5" for the first half. Layers that are not checkpointed keep
+            their activations, trading memory for the recomputation.
+        offload_activations (bool): Keep the activations saved for the backward pass in CPU memory instead of
+            on the GPU.
+        """
+        num_layers = len(self.layers)
+        if checkpoint_layers is None or checkpoint_layers == "all":
+            self.checkpoint_layers = None
+        elif checkpoint_layers.startswith("every_"):
+            step = int(checkpoint_layers[len("every_"):])
+            if step < 1:
+                raise ValueError(f"Invalid checkpoint_layers {checkpoint_layers}, the step must be positive")
+            self.checkpoint_layers = set(range(0, num_layers, step))
+        else:
+            fraction = float(checkpoint_layers)
+            if not 0 <= fraction <= 1:
+                raise ValueError(f"Invalid checkpoint_layers {checkpoint_layers}, the fraction must be in [0, 1]")
+            self.checkpoint_layers = set(range(round(num_layers * fraction)))
+        self.offload_activations = offload_activations
+
+    def _checkpoint_selected_layers(self, checkpoint_func, layer_call, *args, **kwargs):
+        # called by LlamaModel.forward with decoder_layer.__call__ for every layer when gradient checkpointing is on
+        layer = getattr(layer_call, "__self__", None)
+        if self.checkpoint_layers is None or layer is None or layer.self_attn.layer_idx in self.checkpoint_layers:
+            return checkpoint_func(layer_call, *args, **kwargs)
+        return layer_call(*args, **kwargs)
 
     def initialize_vision_modules(self, modalities_to_use, pretrain_mm_mlp_adapter=None, tune_mm_mlp_adapter=False):
         vision_config = self.vision_config
@@ -78,20 +152,14 @@ class LLAVIDALLlamaModel(LlamaModel):
 
         # Load the pretrained weights for the multimodal projector
         if pretrain_mm_mlp_adapter is not None:
-            mm_projector_weights = torch.load(pretrain_mm_mlp_adapter, map_location='cpu')
-
-            # intialize the multimodal projectors and load weights if passed
-            if modalities_to_use['video']:
-                if pretrain_mm_mlp_adapter is not None:
-                    self.mm_projector.load_state_dict({k.split('.')[-1]: v for k, v in mm_projector_weights.items() if ('pose' not in k and 'object' not in k)})
+            mm_projector_weights = rename_projector_keys(load_projector_weights(pretrain_mm_mlp_adapter), legacy=False)
 
-            if modalities_to_use['object']:
-                if pretrain_mm_mlp_adapter is not None:
-                    self.mm_projector_forobject.load_state_dict({k.split('.')[-1]: v for k, v in mm_projector_weights.items() if 'object' in k})
-
-            if modalities_to_use['pose']:
-                if pretrain_mm_mlp_adapter is not None:
-                    self.mm_projector_forpose.load_state_dict({k.split('.')[-1]: v for k, v in mm_projector_weights.items() if 'pose' in k})
+            # intialize the multimodal projectors of the modalities in use
+            for modality, use_modality in modalities_to_use.items():
+                if use_modality:
+                    prefix = f'model.mm_projectors.{modality}.'
+                    getattr(self.mm_projectors, modality).load_state_dict(
+                        {k[len(prefix):]: v for k, v in mm_projector_weights.items() if k.startswith(prefix)})
 
         return dict(
             video_token_len=num_patches,
@@ -111,6 +179,7 @@ class LLAVIDALLlamaModel(LlamaModel):
             pose_features: Optional[torch.FloatTensor] = None,
             object_features:Optional[torch.FloatTensor] = None,
             return_dict: Optional[bool] = None,
+            position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         # print('embed_tokens.weight.requires_grad = ', self.model.embed_tokens.weight.requires_grad)
         orig_embeds_params = getattr(self, 'orig_embeds_params', None)
@@ -121,16 +190,26 @@ class LLAVIDALLlamaModel(LlamaModel):
 
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
-
-        if (input_ids.shape[1] != 1 or self.training):
+            if self.new_token_embeddings is not None:
+                first_new_token = self.embed_tokens.num_embeddings - self.new_token_embeddings.shape[0]
+                is_new_token = input_ids >= first_new_token
+                new_token_embeds = self.new_token_embeddings[input_ids[is_new_token] - first_new_token]
+                inputs_embeds = inputs_embeds.masked_scatter(is_new_token.unsqueeze(-1), new_token_embeds.to(inputs_embeds.dtype))
+
+        # text only inputs, e.g. a follow-up question prefilled on top of a KV cache that already holds the video
+        has_modality_features = video_spatio_temporal_features is not None or object_features is not None or pose_features is not None
+
+        if (input_ids.shape[1] != 1 or self.training) and has_modality_features:
+            projected = self.mm_projectors(dict(video=video_spatio_temporal_features, object=object_features, pose=pose_features))
+            # the projectors can be float32 on top of a reduced precision LLM
             if video_spatio_temporal_features is not None:
-                video_features = self.mm_projector(video_spatio_temporal_features)
+                video_features = projected['video'].to(inputs_embeds.dtype)
 
             if object_features is not None:
-                object_features_projected = self.mm_projector_forobject(object_features)
+                object_features_projected = projected['object'].to(inputs_embeds.dtype)
 
             if pose_features is not None:
-                pose_features_projected = self.mm_projector_forpose(pose_features)
+                pose_features_projected = projected['pose'].to(inputs_embeds.dtype)
         
             new_input_embeds = []
             cur_video_idx = 0
@@ -280,17 +359,23 @@ class LLAVIDALLlamaModel(LlamaModel):
                 new_input_embeds.append(cur_new_input_embeds)
 
             inputs_embeds = torch.stack(new_input_embeds, dim=0)
-        
-        return super(LLAVIDALLlamaModel, self).forward(
-            input_ids=None, attention_mask=attention_mask, past_key_values=past_key_values,
+
+        decoder_forward = partial(
+            super(LLAVIDALLlamaModel, self).forward,
+            input_ids=None, attention_mask=attention_mask, position_ids=position_ids, past_key_values=past_key_values,
             inputs_embeds=inputs_embeds, use_cache=use_cache,
             output_attentions=output_attentions, output_hidden_states=output_hidden_states,
             return_dict=return_dict
         )
+        if self.offload_activations and self.training and torch.is_grad_enabled():
+            with torch.autograd.graph.save_on_cpu(pin_memory=torch.cuda.is_available()):
+                return decoder_forward()
+        return decoder_forward()
 
 
 class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
     config_class = LLAVIDALConfig
+    loss_chunk_size = 1024  # tokens per lm_head projection of the training loss
 
     def __init__(self, config, model_args=None):
         # super(LlamaForCausalLM, self).__init__(config)
@@ -305,6 +390,24 @@ class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
     def get_model(self):
         return self.model
 
+    def gradient_checkpointing_enable(self, gradient_checkpointing_kwargs=None):
+        """
+        Gradient checkpointing of the decoder layers selected by set_activation_memory. The modality features are
+        spliced into the input embeddings before the first layer, so the splice and the projectors run once.
+
+        Checkpointing is non-reentrant unless gradient_checkpointing_kwargs say otherwise: the text embeddings do
+        not require grad when the embeddings are frozen or detached (orig_embeds_params), which reentrant
+        checkpointing needs to backpropagate through a layer.
+        """
+        if gradient_checkpointing_kwargs is None:
+            gradient_checkpointing_kwargs = {"use_reentrant": False}
+        super().gradient_checkpointing_enable(gradient_checkpointing_kwargs=gradient_checkpointing_kwargs)
+        if gradient_checkpointing_kwargs.get("use_reentrant", True):
+            self.enable_input_require_grads()
+
+        model = self.get_model()
+        model._gradient_checkpointing_func = partial(model._checkpoint_selected_layers, model._gradient_checkpointing_func)
+
     def forward(
             self,
             input_ids: torch.LongTensor = None,
@@ -342,10 +445,16 @@ class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
         )
 
         hidden_states = outputs[0]
-        logits = self.lm_head(hidden_states)
 
         loss = None
-        if labels is not None:
+        if labels is not None and self.training:
+            # the trainer only needs the loss, the logits are not materialized
+            logits = None
+            loss = self.chunked_lm_loss(hidden_states, labels)
+        else:
+            logits = self.lm_head(hidden_states)
+
+        if labels is not None and not self.training:
             # Shift so that tokens < n predict n
             shift_logits = logits[..., :-1, :].contiguous()
             shift_labels = labels[..., 1:].contiguous()
@@ -379,6 +488,30 @@ class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
             attentions=outputs.attentions,
         )
 
+    def chunked_lm_loss(self, hidden_states, labels):
+        """
+        Mean next token cross-entropy of the positions with a label, equal to the loss of the full logits.
+
+        Only the hidden states of the labelled positions (the answers) are projected onto the vocabulary, the
+        modality tokens and the prompt never are. The projection runs in chunks of loss_chunk_size tokens that
+        are recomputed in the backward pass, so at most one chunk of vocabulary logits is held in memory.
+        """
+        shift_labels = labels[..., 1:].to(hidden_states.device)
+        mask = shift_labels != IGNORE_INDEX
+        hidden_states = hidden_states[..., :-1, :][mask]
+        targets = shift_labels[mask]
+
+        loss = hidden_states.new_zeros((), dtype=torch.float32)
+        for start in range(0, targets.shape[0], self.loss_chunk_size):
+            end = start + self.loss_chunk_size
+            loss = loss + checkpoint(self._lm_loss_sum, hidden_states[start:end], targets[start:end], use_reentrant=False)
+        # nan without labels, as CrossEntropyLoss
+        return loss / targets.shape[0]
+
+    def _lm_loss_sum(self, hidden_states, targets):
+        logits = self.lm_head(hidden_states).float()
+        return F.cross_entropy(logits, targets, reduction="sum")
+
     def prepare_inputs_for_generation(
             self, input_ids, past_key_values=None, attention_mask=None, inputs_embeds=None, **kwargs
     ):
@@ -440,16 +573,12 @@ class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
 
             # if finetuning the adapters
             if tune_mm_mlp_adapter:
-                self.get_model().orig_embeds_params = [
-                    self.get_input_embeddings().weight.data.clone().to(device=device)]
-                for p in self.get_input_embeddings().parameters(): # train self.embed_tokens
-                    p.requires_grad = True
                 for p in self.get_output_embeddings().parameters(): # dont train self.lm_head
                     p.requires_grad = False
 
             # if initializing the adapters with pretrained weights
             if pretrain_mm_mlp_adapter:
-                mm_projector_weights = torch.load(pretrain_mm_mlp_adapter, map_location='cpu')
+                mm_projector_weights = load_projector_weights(pretrain_mm_mlp_adapter)
                 embed_tokens_weight = mm_projector_weights['model.embed_tokens.weight']
                 # input_embeddings = embed_tokens_weight # this is fine if the model we are loading from did not update any of the non-new token embeddings
                 assert num_new_tokens == 6, f"Unexpected number of new tokens: {num_new_tokens}. All models using token modality prefixes should have 6 new tokens, i.e., start and end for video, object, and pose."
@@ -461,6 +590,11 @@ class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
                     raise ValueError(
                         f"Unexpected embed_tokens_weight shape. Pretrained: {embed_tokens_weight.shape}. "
                         f"Current: {input_embeddings.shape}. Numer of new tokens: {num_new_tokens}.")
+
+            # only the start and end token embeddings train with the adapters, from the (possibly pretrained) rows
+            if tune_mm_mlp_adapter:
+                first_token_id = min(vision_config.vid_start_token, vision_config.object_start_token, vision_config.pose_start_token)
+                self.get_model().train_new_token_embeddings(first_token_id)
         else:
             # if finetuning the adapters
             if tune_mm_mlp_adapter:
@@ -468,11 +602,13 @@ class LLAVIDALLlamaForCausalLM(LlamaForCausalLM):
                     input_embeddings = self.get_input_embeddings().weight.data # self.embed_tokens.weight
                     output_embeddings = self.get_output_embeddings().weight.data # self.lm_head.weight
 
-                    mm_projector_weights = torch.load(pretrain_mm_mlp_adapter, map_location='cpu')
-                    embed_tokens_weight = mm_projector_weights['model.embed_tokens.weight']
+                    mm_projector_weights = load_projector_weights(pretrain_mm_mlp_adapter)
+                    # adapter checkpoints without start/end tokens have no trained embeddings
+                    embed_tokens_weight = mm_projector_weights.get('model.embed_tokens.weight')
 
-                    assert input_embeddings.shape == embed_tokens_weight.shape, f"Error loading weights from path passed in tune_mm_mlp_adapter. Unexpected embed_tokens_weight shape. From tune_mm_mlp_adapter: {embed_tokens_weight.shape}. Current: {input_embeddings.shape}."
-                    input_embeddings = embed_tokens_weight
+                    if embed_tokens_weight is not None:
+                        assert input_embeddings.shape == embed_tokens_weight.shape, f"Error loading weights from path passed in tune_mm_mlp_adapter. Unexpected embed_tokens_weight shape. From tune_mm_mlp_adapter: {embed_tokens_weight.shape}. Current: {input_embeddings.shape}."
+                        input_embeddings = embed_tokens_weight
 
                 for p in self.get_input_embeddings().parameters(): # dont train self.embed_tokens
                     p.requires_grad = False
@@ -1,42 +1,226 @@
 """
 Usage:
-python
+python3 -m llavidal.model.make_delta --base-model-path ~/model_weights/llama-7b --target-model-path ~/model_weights/llavidal-7b --delta-path ~/model_weights/llavidal-7b-delta
+
+The checkpoints are streamed tensor by tensor from their (safetensors or .bin) shards with mmap, so only about
+one tensor is in memory at a time. See apply_delta.py for the counterpart.
 """
 import argparse
+import json
+import math
+import os
+import shutil
+import struct
 
 import torch
+from safetensors import safe_open
 from tqdm import tqdm
-from transformers import AutoTokenizer, AutoModelForCausalLM
 
+from llavidal.model.multimodal_projector import LEGACY_PROJECTOR_NAMES
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8, "U8": torch.uint8, "BOOL": torch.bool,
+}
+DTYPES = {"float16": torch.float16, "bfloat16": torch.bfloat16, "float32": torch.float32}
+# rows of new tokens are appended to these when the vocabulary is resized
+RESIZED_KEYS = ("model.embed_tokens.weight", "lm_head.weight")
+WEIGHT_FILE_SUFFIXES = (".safetensors", ".bin", ".index.json", ".pt", ".pth")
+
+
+def is_projector_key(name):
+    # multimodal projectors are not part of the base LLM
+    return name.startswith("model.mm_projectors.") or any(name.startswith(f"model.{n}.") for n in LEGACY_PROJECTOR_NAMES.values())
+
+
+def resolve_checkpoint_path(path):
+    """
+    Local folder of a checkpoint folder or hub repo id.
+    """
+    if os.path.isdir(path):
+        return path
+    from huggingface_hub import snapshot_download
+    return snapshot_download(path, allow_patterns=["*.json", "*.safetensors", "*.bin", "*.model", "*.txt"])
+
+
+class CheckpointReader(object):
+    """
+    Tensors of a Hugging Face checkpoint folder, safetensors or .bin, sharded or not, loaded one at a time.
+    The shards are memory mapped, reading a tensor does not load the rest of its shard.
+    """
+    def __init__(self, path):
+        self.path = resolve_checkpoint_path(path)
+        self.handles = {}
+        for index_name, file_name in (("model.safetensors.index.json", "model.safetensors"),
+                                      ("pytorch_model.bin.index.json", "pytorch_model.bin")):
+            index_path = os.path.join(self.path, index_name)
+            if os.path.exists(index_path):
+                with open(index_path) as f:
+                    self.weight_map = json.load(f)["weight_map"]
+                break
+            if os.path.exists(os.path.join(self.path, file_name)):
+                self.weight_map = {name: file_name for name in self._open(file_name).keys()}
+                break
+        else:
+            raise FileNotFoundError(f"No model weights (safetensors or pytorch_model.bin) found in {self.path}")
+
+    def _open(self, file_name):
+        if file_name not in self.handles:
+            file_path = os.path.join(self.path, file_name)
+            if file_name.endswith(".safetensors"):
+                self.handles[file_name] = safe_open(file_path, framework="pt")
+            else:
+                self.handles[file_name] = torch.load(file_path, map_location="cpu", mmap=True, weights_only=True)
+        return self.handles[file_name]
+
+    def keys(self):
+        # shard by shard for locality of the reads
+        return sorted(self.weight_map, key=lambda name: (self.weight_map[name], name))
+
+    def __contains__(self, name):
+        return name in self.weight_map
+
+    def get_tensor(self, name):
+        handle = self._open(self.weight_map[name])
+        if isinstance(handle, dict):
+            return handle[name]
+        return handle.get_tensor(name)
+
+    def shape_and_dtype(self, name):
+        handle = self._open(self.weight_map[name])
+        if isinstance(handle, dict):
+            return tuple(handle[name].shape), handle[name].dtype
+        tensor_slice = handle.get_slice(name)
+        return tuple(tensor_slice.get_shape()), SAFETENSORS_DTYPES[tensor_slice.get_dtype()]
 
-def make_delta(base_model_path, target_model_path, delta_path, hub_repo_id):
-    print("Loading base model")
-    base = AutoModelForCausalLM.from_pretrained(
-        base_model_path, torch_dtype=torch.float16, low_cpu_mem_usage=True)
+    def copy_non_weight_files(self, dst_path):
+        """
+        Copies the config and tokenizer files to dst_path.
+        """
+        os.makedirs(dst_path, exist_ok=True)
+        for file_name in os.listdir(self.path):
+            file_path = os.path.join(self.path, file_name)
+            if os.path.isfile(file_path) and not file_name.endswith(WEIGHT_FILE_SUFFIXES):
+                shutil.copy(file_path, os.path.join(dst_path, file_name))
 
-    print("Loading target model")
-    target = AutoModelForCausalLM.from_pretrained(target_model_path, torch_dtype=torch.float16, low_cpu_mem_usage=True)
 
-    print("Calculating delta")
-    for name, param in tqdm(target.state_dict().items(), desc="Calculating delta"):
-        if name not in base.state_dict():
-            assert name in ['model.mm_projector.weight', 'model.mm_projector.bias'], f'{name} not in base model'
-            continue
-        if param.data.shape == base.state_dict()[name].shape:
-            param.data -= base.state_dict()[name]
+class SafetensorsStreamWriter(object):
+    """
+    Writes a safetensors file tensor by tensor, in the order of specs. The header is written first from the
+    shapes and dtypes of all the tensors, so the tensors do not need to be in memory together.
+
+    Parameters:
+    specs (dict): (shape, dtype) by tensor name.
+    """
+    def __init__(self, path, specs, metadata=None):
+        header = {}
+        offset = 0
+        for name, (shape, dtype) in specs.items():
+            size = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+            header[name] = {"dtype": next(k for k, v in SAFETENSORS_DTYPES.items() if v == dtype),
+                            "shape": list(shape), "data_offsets": [offset, offset + size]}
+            offset += size
+        if metadata:
+            header["__metadata__"] = metadata
+        header_bytes = json.dumps(header, separators=(",", ":")).encode()
+        header_bytes += b" " * (-len(header_bytes) % 8)
+
+        self.specs = specs
+        self.order = iter(specs)
+        self.file = open(path, "wb")
+        self.file.write(struct.pack("<Q", len(header_bytes)))
+        self.file.write(header_bytes)
+
+    def write(self, name, tensor):
+        expected = next(self.order, None)
+        if name != expected:
+            raise ValueError(f"Expected tensor {expected}, got {name}")
+        if (tuple(tensor.shape), tensor.dtype) != self.specs[name]:
+            raise ValueError(f"{name}: expected {self.specs[name]}, got {(tuple(tensor.shape), tensor.dtype)}")
+        self.file.write(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+
+    def close(self):
+        self.file.close()
+        missing = list(self.order)
+        if missing:
+            raise ValueError(f"Tensors {missing[:5]} were not written")
+
+
+def write_sharded_checkpoint(path, specs, compute_tensor, max_shard_size=5 * 2 ** 30, desc="Writing"):
+    """
+    Writes the tensors computed one at a time by compute_tensor(name) as a sharded safetensors checkpoint in
+    the Hugging Face layout (model-00001-of-0000N.safetensors and model.safetensors.index.json).
+    """
+    shards, shard_size = [[]], 0
+    for name, (shape, dtype) in specs.items():
+        size = math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+        if shards[-1] and shard_size + size > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(name)
+        shard_size += size
+
+    os.makedirs(path, exist_ok=True)
+    weight_map = {}
+    progress = tqdm(total=len(specs), desc=desc)
+    for i, names in enumerate(shards):
+        file_name = "model.safetensors" if len(shards) == 1 else f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        writer = SafetensorsStreamWriter(os.path.join(path, file_name), {name: specs[name] for name in names},
+                                         metadata={"format": "pt"})
+        for name in names:
+            writer.write(name, compute_tensor(name))
+            weight_map[name] = file_name
+            progress.update()
+        writer.close()
+    progress.close()
+
+    if len(shards) > 1:
+        total_size = sum(math.prod(shape) * torch.empty((), dtype=dtype).element_size() for shape, dtype in specs.values())
+        with open(os.path.join(path, "model.safetensors.index.json"), "w") as f:
+            json.dump({"metadata": {"total_size": total_size}, "weight_map": weight_map}, f, indent=2)
+
+
+def push_to_hub(path, hub_repo_id):
+    from huggingface_hub import HfApi
+    api = HfApi()
+    api.create_repo(hub_repo_id, exist_ok=True)
+    api.upload_folder(repo_id=hub_repo_id, folder_path=path)
+
+
+def make_delta(base_model_path, target_model_path, delta_path, hub_repo_id=None, delta_dtype=torch.float16,
+               max_shard_size=5 * 2 ** 30):
+    """
+    Writes target - base. The differences are computed in float32 and rounded once to delta_dtype. Rows of
+    tokens added to the vocabulary of the target and the multimodal projectors are not in the base model and are
+    stored as they are.
+    """
+    base = CheckpointReader(base_model_path)
+    target = CheckpointReader(target_model_path)
+
+    specs = {}
+    for name in target.keys():
+        shape, dtype = target.shape_and_dtype(name)
+        if name not in base:
+            assert is_projector_key(name), f'{name} not in base model'
         else:
-            assert name in ['model.embed_tokens.weight', 'lm_head.weight'], f'{name} dimension mismatch: {param.data.shape} vs {base.state_dict()[name].shape}'
-            bparam = base.state_dict()[name]
-            param.data[:bparam.shape[0], :bparam.shape[1]] -= bparam
+            base_shape = base.shape_and_dtype(name)[0]
+            if base_shape != shape:
+                assert name in RESIZED_KEYS and len(base_shape) == len(shape) and all(b <= t for b, t in zip(base_shape, shape)), \
+                    f'{name} dimension mismatch: {shape} vs {base_shape}'
+        specs[name] = (shape, delta_dtype if dtype.is_floating_point else dtype)
+
+    def compute_delta(name):
+        tensor = target.get_tensor(name)
+        if name in base and tensor.is_floating_point():
+            base_tensor = base.get_tensor(name)
+            tensor = tensor.float()
+            tensor[tuple(slice(0, s) for s in base_tensor.shape)] -= base_tensor.float()
+        return tensor.to(specs[name][1])
 
-    print("Saving delta")
+    write_sharded_checkpoint(delta_path, specs, compute_delta, max_shard_size=max_shard_size, desc="Calculating delta")
+    target.copy_non_weight_files(delta_path)
     if hub_repo_id:
-        kwargs = {"push_to_hub": True, "repo_id": hub_repo_id}
-    else:
-        kwargs = {}
-    target.save_pretrained(delta_path, **kwargs)
-    target_tokenizer = AutoTokenizer.from_pretrained(target_model_path)
-    target_tokenizer.save_pretrained(delta_path, **kwargs)
+        push_to_hub(delta_path, hub_repo_id)
 
 
 if __name__ == "__main__":
@@ -45,6 +229,9 @@ if __name__ == "__main__":
     parser.add_argument("--target-model-path", type=str, required=True)
     parser.add_argument("--delta-path", type=str, required=True)
     parser.add_argument("--hub-repo-id", type=str, default=None)
+    parser.add_argument("--delta-dtype", type=str, default="float16", choices=list(DTYPES))
+    parser.add_argument("--max-shard-size-gb", type=float, default=5)
     args = parser.parse_args()
 
-    make_delta(args.base_model_path, args.target_model_path, args.delta_path, args.hub_repo_id)
+    make_delta(args.base_model_path, args.target_model_path, args.delta_path, args.hub_repo_id,
+               delta_dtype=DTYPES[args.delta_dtype], max_shard_size=int(args.max_shard_size_gb * 2 ** 30))
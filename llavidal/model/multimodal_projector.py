@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+from safetensors.torch import load_file
+
+MODALITIES = ("video", "object", "pose")
+
+# names of the modality projectors in mm_projector.bin and the model checkpoints, e.g. model.mm_projector.weight
+LEGACY_PROJECTOR_NAMES = {"video": "mm_projector", "object": "mm_projector_forobject", "pose": "mm_projector_forpose"}
+
+
+def build_projector(projector_type, in_features, out_features):
+    """
+    Parameters:
+    projector_type (str): "linear", or "mlp2x_gelu" for two linear layers with a GELU in between.
+    """
+    if projector_type == "linear":
+        return nn.Linear(in_features, out_features)
+    if projector_type == "mlp2x_gelu":
+        return nn.Sequential(nn.Linear(in_features, out_features), nn.GELU(), nn.Linear(out_features, out_features))
+    raise ValueError(f"Unknown projector type {projector_type}")
+
+
+def rename_projector_keys(state_dict, prefix="model.", legacy=True):
+    """
+    Renames the projector keys of a state dict in place between the MultiModalProjector layout
+    (model.mm_projectors.video.weight) and the legacy layout of mm_projector.bin (model.mm_projector.weight).
+
+    Parameters:
+    legacy (bool): To the legacy layout if set, from it otherwise.
+    """
+    for modality, legacy_name in LEGACY_PROJECTOR_NAMES.items():
+        new_prefix, old_prefix = f"{prefix}mm_projectors.{modality}.", f"{prefix}{legacy_name}."
+        if legacy:
+            new_prefix, old_prefix = old_prefix, new_prefix
+        for key in [k for k in state_dict if k.startswith(old_prefix)]:
+            state_dict[new_prefix + key[len(old_prefix):]] = state_dict.pop(key)
+    return state_dict
+
+
+def load_projector_weights(path):
+    """
+    Projector weights (mm_projector.bin layout) of a .bin or .safetensors file, on the CPU.
+    """
+    if path.endswith(".safetensors"):
+        return load_file(path)
+    return torch.load(path, map_location="cpu")
+
+
+def legacy_keys_state_dict_hook(module, state_dict, prefix, local_metadata):
+    rename_projector_keys(state_dict, prefix, legacy=True)
+
+
+def legacy_keys_load_state_dict_pre_hook(state_dict, prefix, *args):
+    rename_projector_keys(state_dict, prefix, legacy=False)
+
+
+class MultiModalProjector(nn.Module):
+    """
+    Projectors of the modality features onto the LLM embeddings, one per modality in use. Each modality runs
+    through its own projector: the feature sizes differ (e.g. 1024, 512 and 216), so a grouped matmul would have to
+    pad or block-diagonalize the inputs, which costs more memory traffic than the launches it saves.
+
+    Parameters:
+    hidden_size (int): Size of the LLM embeddings.
+    in_features (dict): Feature size of each modality in use, e.g. {"video": 1024, "pose": 216}.
+    projector_type (str): See build_projector.
+    """
+    def __init__(self, hidden_size, in_features, projector_type="linear"):
+        super().__init__()
+        self.projector_type = projector_type
+        for modality, size in in_features.items():
+            if modality not in MODALITIES:
+                raise ValueError(f"Unknown modality {modality}")
+            self.add_module(modality, build_projector(projector_type, size, hidden_size))
+
+    def forward(self, features):
+        """
+        Parameters:
+        features (dict): Features of shape (..., feature size) by modality, None for the modalities without features.
+
+        Returns:
+        dict: Projected features of shape (..., hidden size) of the modalities with features.
+        """
+        projected = {}
+        for modality in MODALITIES:
+            if features.get(modality) is not None:
+                projector = getattr(self, modality)
+                dtype = next(projector.parameters()).dtype
+                projected[modality] = projector(features[modality].to(dtype))
+        return projected
@@ -0,0 +1,3 @@
+from llavidal.serve.api_server import main
+
+main()
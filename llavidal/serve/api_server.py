@@ -0,0 +1,289 @@
+"""
+Long-running inference server with an OpenAI-compatible chat completions API for video chat.
+
+The model is loaded once and shared by all clients through the batching engine (engine.py), so batch jobs
+and tools do not pay the model startup on every run.
+
+    python -m llavidal.serve --model-name <path> --projection_path <llavidal weights> --port 8000
+
+Endpoints
+    POST /v1/videos            raw video bytes, or {"path": ...} for a file under --video-root. Returns {"id": ...}.
+    POST /v1/chat/completions  OpenAI chat completion request, "stream": true streams server-sent events.
+    GET  /v1/models
+    GET  /metrics              queue depth, running requests, latency percentiles.
+    GET  /health
+The model worker endpoints (model_worker.py) are served as well, so the demo can use the server with --worker-url.
+The server listens on localhost only by default, --host 0.0.0.0 serves other hosts as well.
+
+A user message refers to its video with a content part, one video per conversation:
+    {"role": "user", "content": [{"type": "text", "text": "What is the person doing?"},
+                                 {"type": "video_url", "video_url": {"url": <video>}}]}
+<video> is a video id returned by /v1/videos, a data:video/mp4;base64,... url or, if the server was started
+with --video-root, a path (optionally file://) of a video under that folder of the server host. A "video" field next to "messages" is accepted as well, for the first user message.
+See client.py for a client without dependencies.
+"""
+import argparse
+import base64
+import json
+import os
+import time
+import uuid
+
+import uvicorn
+from fastapi import Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from llavidal.constants import *
+from llavidal.eval.model_utils import initialize_model
+from llavidal.serve import model_worker
+from llavidal.serve.engine import GenerationError
+from llavidal.serve.model_worker import ModelWorker, app, logger
+from llavidal.video_conversation import SeparatorStyle, conv_templates
+
+conv_mode = "llavidal_v1"
+served_model_name = "llavidal"
+
+
+class APIError(Exception):
+    def __init__(self, message, status_code=400, error_type="invalid_request_error"):
+        super().__init__(message)
+        self.status_code = status_code
+        self.error_type = error_type
+
+
+def error_response(e):
+    return JSONResponse({"error": {"message": str(e), "type": e.error_type, "code": e.status_code}}, status_code=e.status_code)
+
+
+def parse_content(content):
+    """
+    Text and video reference of the content of a message, a string or a list of content parts.
+    """
+    if isinstance(content, str):
+        return content, None
+    texts, video = [], None
+    for part in content or []:
+        if part.get("type") == "text":
+            texts.append(part["text"])
+        elif part.get("type") == "video_url":
+            video = part["video_url"]["url"] if isinstance(part["video_url"], dict) else part["video_url"]
+        elif part.get("type") == "video":
+            video = part["video"]
+        else:
+            raise APIError(f"Unsupported content part {part.get('type')}")
+    return "\n".join(texts), video
+
+
+def build_prompt(messages, video=None):
+    """
+    Conversation prompt of OpenAI chat messages, the video placeholder goes after the text of the message
+    with the video as in the demo.
+
+    Returns:
+    tuple: (prompt, stop string, video reference or None).
+    """
+    conv = conv_templates[conv_mode].copy()
+    turns = []
+    video_turn = None
+    for message in messages:
+        text, message_video = parse_content(message.get("content"))
+        if message["role"] == "system":
+            conv.system = text
+            continue
+        if message["role"] not in ("user", "assistant"):
+            raise APIError(f"Unsupported role {message['role']}")
+        if message_video is not None:
+            if video_turn is not None or (video is not None and video != message_video):
+                raise APIError("Only one video per conversation is supported")
+            video, video_turn = message_video, len(turns)
+        turns.append([message["role"], text])
+
+    if video is not None:
+        if video_turn is None:
+            video_turn = next((i for i, (role, _) in enumerate(turns) if role == "user"), None)
+        if video_turn is None or turns[video_turn][0] != "user":
+            raise APIError("The video must be part of a user message")
+        turns[video_turn][1] += "\n" + DEFAULT_VIDEO_TOKEN
+    for role, text in turns:
+        conv.append_message(conv.roles[0] if role == "user" else conv.roles[1], text)
+
+    if not conv.messages or conv.messages[-1][0] != conv.roles[0]:
+        raise APIError("The last message must be a user message")
+    conv.append_message(conv.roles[1], None)
+    stop_str = conv.sep if conv.sep_style != SeparatorStyle.TWO else conv.sep2
+    return conv.get_prompt(), stop_str, video
+
+
+def resolve_video(worker, video):
+    """
+    Video id in the engine cache of a video id, path or data url, the video is encoded if needed.
+    """
+    if video.startswith("data:"):
+        try:
+            return worker.upload_video(data=base64.b64decode(video.split(",", 1)[1]))
+        except (IndexError, ValueError) as e:
+            raise APIError(f"Invalid video data url: {e}")
+    if worker.engine.has_video(video):
+        return video
+    if worker.video_root is None:
+        # the same answer for any path, whether a file exists is not revealed
+        raise APIError(f"Unknown video {video}, upload it to /v1/videos or pass a data url", status_code=404)
+    path = video[len("file://"):] if video.startswith("file://") else video
+    try:
+        return worker.upload_video(path=path)
+    except PermissionError as e:
+        raise APIError(str(e), status_code=403)
+
+
+def make_request(worker, body):
+    prompt, stop_str, video = build_prompt(body.get("messages", []), body.get("video"))
+    params = {
+        "prompt": prompt,
+        "temperature": body.get("temperature", 0.2),
+        "top_p": body.get("top_p", 1.0),
+        "max_new_tokens": body.get("max_tokens") or body.get("max_completion_tokens") or 512,
+        "stop": stop_str,
+    }
+    if video is not None:
+        params["video_id"] = resolve_video(worker, video)
+    request = worker.make_request(params)
+    if len(request.input_ids) >= worker.engine.max_context_len:
+        raise APIError(f"The prompt has {len(request.input_ids)} tokens, the context length of the model is {worker.engine.max_context_len}")
+    return request
+
+
+def completion_chunk(completion_id, created, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": served_model_name,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def stream_completion(worker, request, completion_id, created):
+    worker.engine.submit(request)
+    sent = ""
+    try:
+        yield f"data: {json.dumps(completion_chunk(completion_id, created, {'role': 'assistant', 'content': ''}))}\n\n"
+        for text in request.iter_text():
+            if not text.startswith(sent):
+                continue  # the streamed text can only grow, wait until the decoded text agrees with it again
+            delta, sent = text[len(sent):], text
+            yield f"data: {json.dumps(completion_chunk(completion_id, created, {'content': delta}))}\n\n"
+        yield f"data: {json.dumps(completion_chunk(completion_id, created, {}, request.finish_reason))}\n\n"
+    except GenerationError as e:
+        logger.error(f"generation failed: {e}")
+        yield f"data: {json.dumps({'error': {'message': str(e), 'type': 'server_error', 'code': 500}})}\n\n"
+    finally:
+        # also stops the generation when the client disconnected
+        request.cancel()
+    yield "data: [DONE]\n\n"
+
+
+def run_completion(worker, request):
+    worker.engine.submit(request)
+    try:
+        for _ in request.iter_text():
+            pass
+    finally:
+        request.cancel()
+    return request
+
+
+@app.post("/v1/videos")
+async def upload_video(request: Request):
+    if request.headers.get("content-type", "").startswith("application/json"):
+        kwargs = {"path": (await request.json())["path"]}
+    else:
+        kwargs = {"data": await request.body()}
+    try:
+        video_id = await run_in_threadpool(model_worker.worker.upload_video, **kwargs)
+    except PermissionError as e:
+        return error_response(APIError(str(e), status_code=403))
+    except (OSError, ValueError, GenerationError) as e:
+        return error_response(APIError(f"Could not encode the video: {e}"))
+    return {"id": video_id, "object": "video"}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(http_request: Request):
+    worker = model_worker.worker
+    body = await http_request.json()
+    if body.get("n", 1) != 1:
+        return error_response(APIError("Only n=1 is supported"))
+    try:
+        request = await run_in_threadpool(make_request, worker, body)
+    except APIError as e:
+        return error_response(e)
+    except (KeyError, TypeError, OSError, ValueError, GenerationError) as e:
+        return error_response(APIError(f"Invalid request: {e}"))
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    if body.get("stream"):
+        return StreamingResponse(stream_completion(worker, request, completion_id, created), media_type="text/event-stream")
+
+    try:
+        request = await run_in_threadpool(run_completion, worker, request)
+    except GenerationError as e:
+        logger.error(f"generation failed: {e}")
+        return error_response(APIError(str(e), status_code=500, error_type="server_error"))
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": created,
+        "model": served_model_name,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": request.text}, "finish_reason": request.finish_reason}],
+        "usage": {
+            "prompt_tokens": len(request.input_ids),
+            "completion_tokens": len(request.generated_ids),
+            "total_tokens": len(request.input_ids) + len(request.generated_ids),
+        },
+    }
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": served_model_name, "object": "model", "owned_by": "llavidal"}]}
+
+
+@app.get("/metrics")
+async def metrics():
+    return model_worker.worker.get_status()
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+def main():
+    global conv_mode, served_model_name
+    parser = argparse.ArgumentParser(description="LLAVIDAL inference server")
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--projection_path", type=str, required=True)
+    parser.add_argument("--conv-mode", type=str, default="llavidal_v1")
+    parser.add_argument("--served-model-name", type=str, default="llavidal", help="Model name reported in the responses")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of requests decoded together")
+    parser.add_argument("--max-cached-videos", type=int, default=64, help="Number of encoded videos kept for follow-up requests")
+    parser.add_argument("--video-root", type=str, default=None, help="Folder whose videos clients may give by path, only uploads are accepted otherwise")
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+    conv_mode = args.conv_mode
+    served_model_name = args.served_model_name
+
+    os.environ.setdefault("LOCAL_RANK", "0")  # initialize_model picks the GPU from the launcher environment
+    model, vision_tower, tokenizer, image_processor, video_token_len, _ = initialize_model(args.model_name, args.projection_path)
+    model_worker.worker = ModelWorker(model, vision_tower, tokenizer, image_processor, video_token_len,
+                                      max_batch_size=args.max_batch_size, max_cached_videos=args.max_cached_videos,
+                                      video_root=args.video_root)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Client of the LLAVIDAL inference server (api_server.py), standard library only.
+
+    from llavidal.serve.client import LLAVIDALClient
+    client = LLAVIDALClient("http://localhost:8000")
+    video_id = client.upload_video("video.mp4")
+    print(client.ask(video_id, "What is the person doing?"))
+
+    python -m llavidal.serve.client --url http://localhost:8000 --video video.mp4 --question "What is the person doing?" --stream
+"""
+import argparse
+import json
+import sys
+import urllib.error
+import urllib.request
+
+
+class ServerError(Exception):
+    pass
+
+
+class LLAVIDALClient(object):
+    """
+    Parameters:
+    base_url (str): Url of the server, e.g. http://localhost:8000.
+    timeout (float): Seconds to wait for a response, the generation of a long answer can take a while.
+    """
+    def __init__(self, base_url="http://localhost:8000", timeout=600):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, method, path, data=None, content_type="application/json"):
+        if data is not None and content_type == "application/json":
+            data = json.dumps(data).encode()
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        if data is not None:
+            request.add_header("Content-Type", content_type)
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            body = e.read().decode(errors="replace")
+            try:
+                message = json.loads(body)["error"]["message"]
+            except (ValueError, KeyError, TypeError):
+                message = body
+            raise ServerError(f"HTTP {e.code}: {message}") from None
+
+    def _get_json(self, path):
+        with self._request("GET", path) as response:
+            return json.load(response)
+
+    def upload_video(self, path, server_path=False):
+        """
+        Uploads a video and returns its id. With server_path the path is read by the server instead of uploading
+        the file, for videos under the --video-root of the server.
+        """
+        if server_path:
+            with self._request("POST", "/v1/videos", {"path": path}) as response:
+                return json.load(response)["id"]
+        with open(path, "rb") as f:
+            data = f.read()
+        with self._request("POST", "/v1/videos", data, content_type="application/octet-stream") as response:
+            return json.load(response)["id"]
+
+    def chat(self, messages, stream=False, **params):
+        """
+        Chat completion of OpenAI style messages (see api_server.py for attaching a video). params are the
+        sampling parameters of the request, e.g. temperature, top_p and max_tokens.
+
+        Returns:
+        str or iterator: The answer, or an iterator over its pieces if stream is set.
+        """
+        body = dict(params, messages=messages, stream=stream)
+        if stream:
+            return self._iter_stream(body)
+        with self._request("POST", "/v1/chat/completions", body) as response:
+            return json.load(response)["choices"][0]["message"]["content"]
+
+    def _iter_stream(self, body):
+        with self._request("POST", "/v1/chat/completions", body) as response:
+            for line in response:
+                line = line.decode().strip()
+                if not line.startswith("data: "):
+                    continue
+                data = line[len("data: "):]
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if "error" in chunk:
+                    raise ServerError(chunk["error"]["message"])
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+
+    def ask(self, video, question, stream=False, **params):
+        """
+        Single question about a video, given by its id or by a path on the server host.
+        """
+        messages = [{"role": "user", "content": [
+            {"type": "text", "text": question},
+            {"type": "video_url", "video_url": {"url": video}},
+        ]}]
+        return self.chat(messages, stream=stream, **params)
+
+    def metrics(self):
+        return self._get_json("/metrics")
+
+    def health(self):
+        return self._get_json("/health")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ask the LLAVIDAL inference server a question about a video")
+    parser.add_argument("--url", type=str, default="http://localhost:8000")
+    parser.add_argument("--video", type=str, default=None, help="Video file, uploaded to the server")
+    parser.add_argument("--server_video_path", type=str, default=None, help="Video file on the server host, not uploaded")
+    parser.add_argument("--question", type=str, default=None)
+    parser.add_argument("--temperature", type=float, default=0.2)
+    parser.add_argument("--max_tokens", type=int, default=512)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--metrics", action="store_true", help="Print the server metrics and exit")
+    args = parser.parse_args()
+
+    client = LLAVIDALClient(args.url)
+    if args.metrics:
+        print(json.dumps(client.metrics(), indent=4))
+        sys.exit(0)
+    if args.question is None or (args.video is None) == (args.server_video_path is None):
+        parser.error("--question and one of --video or --server_video_path are required")
+
+    video = client.upload_video(args.video) if args.video is not None else args.server_video_path
+    answer = client.ask(video, args.question, stream=args.stream, temperature=args.temperature, max_tokens=args.max_tokens)
+    if args.stream:
+        for piece in answer:
+            print(piece, end="", flush=True)
+        print()
+    else:
+        print(answer)
@@ -0,0 +1,433 @@
+"""
+Continuous batching engine for serving LLAVIDAL to many users from one GPU.
+
+All requests go through a single engine thread that owns the model. Every iteration of its loop
+  1. encodes the videos uploaded since the last iteration with one vision tower call (the frames of
+     several videos are concatenated), the pooled features are kept in an LRU cache so a video that
+     is asked about again is not encoded again,
+  2. admits waiting requests into the running batch: their prompts are prefilled together (left
+     padded) and their KV caches are appended to the KV cache of the batch,
+  3. runs one decode step for the whole running batch and removes the requests that finished.
+A request joins the batch at the next decode step instead of waiting for the requests in flight, and
+a long answer does not hold up the short ones.
+
+Requests get the generated text through GenerationRequest.iter_text, which is what the HTTP worker
+streams to its clients.
+"""
+import hashlib
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+from llavidal.inference import get_spatio_temporal_features_torch
+from llavidal.utils import truncate_at_stop_str
+
+
+class GenerationError(Exception):
+    pass
+
+
+class GenerationRequest(object):
+    """
+    A prompt and its sampling parameters. The prompt must already contain the video patch tokens if
+    video_key is set. temperature 0 decodes greedily.
+    """
+    def __init__(self, input_ids, video_key=None, temperature=0.2, top_p=1.0, max_new_tokens=512, stop_str=None):
+        self.input_ids = list(input_ids)
+        self.video_key = video_key
+        self.temperature = float(temperature)
+        self.top_p = float(top_p)
+        self.max_new_tokens = int(max_new_tokens)
+        self.stop_str = stop_str
+
+        self.generated_ids = []
+        self.text = ""
+        self.finish_reason = None
+        self.error = None
+        self.cancelled = False
+        self.submitted_at = time.time()
+        self.admitted_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self._events = queue.Queue()
+
+    @property
+    def finished(self):
+        return self.finish_reason is not None
+
+    def cancel(self):
+        """
+        Stops the generation, e.g. when the client disconnected. The request leaves the batch at the next step.
+        """
+        self.cancelled = True
+
+    def iter_text(self, timeout=None):
+        """
+        Yields the text generated so far every time it grows. Raises GenerationError if the request failed.
+        """
+        while True:
+            text = self._events.get(timeout=timeout)
+            if text is None:
+                break
+            yield text
+        if self.error is not None:
+            raise GenerationError(self.error)
+
+    def _emit(self, text):
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        if text.endswith("\ufffd"):
+            return  # incomplete multi-byte character, wait for the rest of it
+        if text != self.text:
+            self.text = text
+            self._events.put(text)
+
+    def _finish(self, reason, error=None):
+        if self.finished:
+            return
+        self.finish_reason = reason
+        self.error = error
+        self.finished_at = time.time()
+        self._events.put(None)
+
+
+def get_video_key(data):
+    """
+    Content hash of an uploaded video, the key of its features in the engine cache.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def sample_next_tokens(logits, temperatures, top_ps):
+    """
+    Next token of every row of logits (B, V), greedy for rows with temperature 0, nucleus sampling otherwise.
+    """
+    logits = logits.float()
+    next_tokens = logits.argmax(dim=-1)
+    greedy = temperatures <= 1e-5
+    if greedy.all():
+        return next_tokens
+
+    probs = torch.softmax(logits / temperatures.clamp(min=1e-5).unsqueeze(1), dim=-1)
+    sorted_probs, sorted_indices = probs.sort(dim=-1, descending=True)
+    # keep the smallest set of tokens whose probability reaches top_p
+    outside_top_p = sorted_probs.cumsum(dim=-1) - sorted_probs > top_ps.unsqueeze(1)
+    sorted_probs = sorted_probs.masked_fill(outside_top_p, 0)
+    sampled = sorted_indices.gather(-1, torch.multinomial(sorted_probs, 1)).squeeze(1)
+    return torch.where(greedy, next_tokens, sampled)
+
+
+def _to_legacy_cache(past_key_values):
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
+
+
+def _pad_left(tensor, length, dim):
+    if tensor.shape[dim] == length:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = length - tensor.shape[dim]
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+class BatchedEngine(object):
+    """
+    Runs the generation of concurrent requests in one batch.
+
+    Parameters:
+    model: LLAVIDALLlamaForCausalLM in eval mode.
+    tokenizer: Tokenizer of the model.
+    vision_tower: CLIP vision model, shared by all requests.
+    max_batch_size (int): Maximum number of requests decoded together. Each one holds its own KV cache,
+        about 0.5 MB per token for the 7B model.
+    max_cached_videos (int): Number of encoded videos kept for follow-up requests.
+    max_encode_frames (int): Maximum number of frames per vision tower call.
+    num_latency_samples (int): Number of recent requests the latency percentiles of status() are computed over.
+    """
+    def __init__(self, model, tokenizer, vision_tower, max_batch_size=8, max_cached_videos=64, max_encode_frames=400,
+                 num_latency_samples=1000):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.vision_tower = vision_tower
+        self.device = model.device
+        self.max_batch_size = max_batch_size
+        self.max_cached_videos = max_cached_videos
+        self.max_encode_frames = max_encode_frames
+        self.max_context_len = getattr(model.config, "max_position_embeddings", 2048)
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+        self.video_features = OrderedDict()  # video key -> spatio-temporal features, in LRU order
+        self.waiting = deque()
+        self.pending_videos = []  # (video key, pixel values, event)
+        self.running = []  # requests in the order of the rows of the batch KV cache
+        self.past_key_values = None
+        self.attention_mask = None
+
+        self.num_finished = 0
+        self.num_generated_tokens = 0
+        self.started_at = time.time()
+        # (queue wait, time to first token, total latency, generated tokens) of recently finished requests
+        self.latencies = deque(maxlen=num_latency_samples)
+
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, name="llavidal-engine", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join()
+
+    def has_video(self, video_key):
+        return video_key in self.video_features
+
+    def add_video(self, video_key, pixel_values, timeout=None):
+        """
+        Encodes a video (pixel values of its frames) unless it is cached. Blocks until the features are ready,
+        videos added at the same time are encoded together.
+        """
+        if self.has_video(video_key):
+            return
+        event = threading.Event()
+        with self._wakeup:
+            self.pending_videos.append((video_key, pixel_values, event))
+            self._wakeup.notify()
+        if not event.wait(timeout):
+            raise GenerationError(f"Encoding video {video_key} timed out")
+        if not self.has_video(video_key):
+            raise GenerationError(f"Encoding video {video_key} failed")
+
+    def submit(self, request):
+        with self._wakeup:
+            self.waiting.append(request)
+            self._wakeup.notify()
+        return request
+
+    def status(self):
+        status = {
+            "queue_length": len(self.waiting),
+            "num_running": len(self.running),
+            "num_cached_videos": len(self.video_features),
+            "num_finished": self.num_finished,
+            "num_generated_tokens": self.num_generated_tokens,
+            "uptime": time.time() - self.started_at,
+        }
+        latencies = np.array(self.latencies, dtype=np.float64).reshape(-1, 4)
+        if len(latencies):
+            for i, name in enumerate(("queue_wait", "time_to_first_token", "latency")):
+                for q in (50, 90, 99):
+                    status[f"{name}_p{q}"] = float(np.percentile(latencies[:, i], q))
+            decode_time = latencies[:, 2] - latencies[:, 1]
+            status["per_request_tokens_per_second"] = float(np.sum(latencies[:, 3] - 1) / max(np.sum(decode_time), 1e-6))
+        return status
+
+    def _loop(self):
+        while True:
+            with self._wakeup:
+                while not (self._stopped or self.waiting or self.pending_videos or self.running):
+                    self._wakeup.wait()
+                if self._stopped:
+                    break
+                pending_videos, self.pending_videos = self.pending_videos, []
+                new_requests = []
+                while self.waiting and len(self.running) + len(new_requests) < self.max_batch_size:
+                    new_requests.append(self.waiting.popleft())
+
+            try:
+                with torch.inference_mode():
+                    if pending_videos:
+                        self._encode_videos(pending_videos)
+                    if new_requests:
+                        self._admit(new_requests)
+                    if self.running:
+                        self._decode_step()
+            except Exception as e:
+                # a failed step leaves the batch cache in an unknown state, fail the requests in flight
+                for request in self.running + new_requests:
+                    request._finish("error", f"{type(e).__name__}: {e}")
+                self._reset_batch()
+                for _, _, event in pending_videos:
+                    event.set()
+
+        for request in self.running + list(self.waiting):
+            request._finish("error", "engine stopped")
+
+    def _encode_videos(self, pending_videos):
+        videos = OrderedDict()
+        for video_key, pixel_values, _ in pending_videos:
+            if video_key not in self.video_features:
+                videos[video_key] = pixel_values
+        if videos:
+            frames = torch.cat(list(videos.values()), dim=0).half().to(self.device)
+            frame_features = []
+            for start in range(0, frames.shape[0], self.max_encode_frames):
+                outputs = self.vision_tower(frames[start:start + self.max_encode_frames], output_hidden_states=True)
+                frame_features.append(outputs.hidden_states[-2][:, 1:])  # second to last layer as in LLaVA
+            frame_features = torch.cat(frame_features, dim=0)
+
+            start = 0
+            for video_key, pixel_values in videos.items():
+                num_frames = pixel_values.shape[0]
+                self.video_features[video_key] = get_spatio_temporal_features_torch(frame_features[start:start + num_frames])
+                start += num_frames
+            while len(self.video_features) > self.max_cached_videos:
+                self.video_features.popitem(last=False)
+
+        for _, _, event in pending_videos:
+            event.set()
+
+    def _admit(self, requests):
+        accepted = []
+        for request in requests:
+            if request.cancelled:
+                request._finish("cancelled")
+            elif request.video_key is not None and request.video_key not in self.video_features:
+                request._finish("error", f"Unknown video {request.video_key}, upload it again")
+            elif len(request.input_ids) >= self.max_context_len:
+                request._finish("error", f"Prompt of {len(request.input_ids)} tokens exceeds the context length {self.max_context_len}")
+            else:
+                if request.video_key is not None:
+                    self.video_features.move_to_end(request.video_key)
+                request.admitted_at = time.time()
+                accepted.append(request)
+
+        # the model either splices video features into every row of a batch or into none
+        with_video = [request for request in accepted if request.video_key is not None]
+        without_video = [request for request in accepted if request.video_key is None]
+        for group in (with_video, without_video):
+            if group:
+                self._prefill(group)
+
+    def _prefill(self, requests):
+        max_len = max(len(request.input_ids) for request in requests)
+        input_ids = torch.full((len(requests), max_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.long)
+        for i, request in enumerate(requests):
+            input_ids[i, max_len - len(request.input_ids):] = torch.tensor(request.input_ids)
+            attention_mask[i, max_len - len(request.input_ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+
+        video_features = None
+        if requests[0].video_key is not None:
+            video_features = torch.stack([self.video_features[request.video_key] for request in requests]).to(self.device, self.model.dtype)
+
+        # positions count the real tokens of each row only, so the left padding does not shift them
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)
+
+        outputs = self.model.get_model()(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=True,
+            video_spatio_temporal_features=video_features,
+            return_dict=True)
+        # logits of the last position only, the prompts are left padded
+        logits = self.model.lm_head(outputs.last_hidden_state[:, -1])
+        past_key_values = _to_legacy_cache(outputs.past_key_values)
+
+        self._append_to_batch(requests, past_key_values, attention_mask)
+        self._process_logits(logits, requests)
+        self._remove_finished()
+
+    def _append_to_batch(self, requests, past_key_values, attention_mask):
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+        else:
+            # left pad the shorter of the two caches, the padding is masked out
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            self.past_key_values = tuple(
+                tuple(torch.cat([_pad_left(old, length, 2), _pad_left(new, length, 2)], dim=0) for old, new in zip(old_layer, new_layer))
+                for old_layer, new_layer in zip(self.past_key_values, past_key_values)
+            )
+            self.attention_mask = torch.cat([_pad_left(self.attention_mask, length, 1), _pad_left(attention_mask, length, 1)], dim=0)
+        self.running.extend(requests)
+
+    def _decode_step(self):
+        input_ids = torch.tensor([[request.generated_ids[-1]] for request in self.running], device=self.device)
+        self.attention_mask = torch.cat([self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))], dim=1)
+        # the batch cache is left padded to its longest row, the position of the new token is the number of real
+        # tokens of its row before it, not the length of the cache
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True) - 1
+        outputs = self.model.get_model()(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            return_dict=True)
+        self.past_key_values = _to_legacy_cache(outputs.past_key_values)
+        logits = self.model.lm_head(outputs.last_hidden_state[:, -1])
+        self._process_logits(logits, self.running)
+        self._remove_finished()
+
+    def _process_logits(self, logits, requests):
+        temperatures = torch.tensor([request.temperature for request in requests], device=logits.device)
+        top_ps = torch.tensor([request.top_p for request in requests], device=logits.device)
+        next_tokens = sample_next_tokens(logits, temperatures, top_ps).tolist()
+
+        for request, token in zip(requests, next_tokens):
+            request.generated_ids.append(token)
+            self.num_generated_tokens += 1
+
+            text = self.tokenizer.decode(request.generated_ids, skip_special_tokens=True)
+            visible, stopped = truncate_at_stop_str(text, request.stop_str) if request.stop_str else (text, False)
+
+            if request.cancelled:
+                finish_reason = "cancelled"
+            elif stopped or token == self.tokenizer.eos_token_id:
+                finish_reason = "stop"
+            elif len(request.generated_ids) >= request.max_new_tokens or \
+                    len(request.input_ids) + len(request.generated_ids) >= self.max_context_len:
+                finish_reason = "length"
+            else:
+                finish_reason = None
+
+            # a trailing partial match of the stop string is only held back while more tokens can complete it
+            if finish_reason is not None and not stopped:
+                visible = text
+            request._emit(visible.strip())
+            if finish_reason is not None:
+                request._finish(finish_reason)
+
+    def _remove_finished(self):
+        keep = [i for i, request in enumerate(self.running) if not request.finished]
+        for request in self.running:
+            if request.finished:
+                self.num_finished += 1
+                if request.finish_reason in ("stop", "length"):
+                    self.latencies.append((request.admitted_at - request.submitted_at,
+                                           request.first_token_at - request.submitted_at,
+                                           request.finished_at - request.submitted_at,
+                                           len(request.generated_ids)))
+        if len(keep) == len(self.running):
+            return
+        if not keep:
+            self._reset_batch()
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        self.running = [self.running[i] for i in keep]
+        self.attention_mask = self.attention_mask[index]
+        # drop the columns that were only padding for the requests that are left
+        first_column = (self.attention_mask.sum(dim=0) > 0).nonzero()[0].item()
+        self.attention_mask = self.attention_mask[:, first_column:]
+        self.past_key_values = tuple(
+            tuple(tensor[index][:, :, first_column:] for tensor in layer) for layer in self.past_key_values
+        )
+
+    def _reset_batch(self):
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
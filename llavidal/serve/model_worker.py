@@ -0,0 +1,195 @@
+"""
+Model worker: serves one LLAVIDAL model over HTTP with continuous batching (see engine.py).
+
+    python llavidal/serve/model_worker.py --model-name <path> --projection_path <llavidal weights> --port 21002
+    python llavidal/demo/video_demo.py --worker-url http://localhost:21002
+
+Endpoints
+    POST /worker_upload_video     raw video bytes, or {"path": ...} for a file under --video-root on the worker host.
+                                  Returns {"video_id": ...}, the content hash of the video.
+    POST /worker_generate_stream  {"prompt", "video_id", "temperature", "top_p", "max_new_tokens", "stop"}.
+                                  Streams {"text": <answer so far>, "error_code": 0} chunks separated by b"\0".
+    POST /worker_get_status       queue length, running requests and cached videos.
+
+The prompt is the conversation prompt with the <video> placeholder, the worker replaces it by the video tokens.
+"""
+import argparse
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from threading import Lock
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from llavidal.constants import *
+from llavidal.eval.model_utils import initialize_model, load_video
+from llavidal.serve.engine import BatchedEngine, GenerationError, GenerationRequest, get_video_key
+from llavidal.utils import build_logger, server_error_msg
+
+logger = build_logger("model_worker", "model_worker.log")
+
+
+class ModelWorker(object):
+    """
+    Parameters:
+    video_root (str): Folder of this host whose videos clients may give by path, None to only accept uploaded
+        video bytes.
+    """
+    def __init__(self, model, vision_tower, tokenizer, image_processor, video_token_len,
+                 max_batch_size=8, max_cached_videos=64, video_root=None):
+        self.tokenizer = tokenizer
+        self.image_processor = image_processor
+        self.video_root = os.path.realpath(video_root) if video_root is not None else None
+        # (path, size, mtime) -> video key, files on this host are not hashed again. Bounded like the video cache of the
+        # engine, in LRU order, uploads run in the threadpool
+        self.path_keys = OrderedDict()
+        self.path_keys_lock = Lock()
+        self.max_cached_videos = max_cached_videos
+        self.engine = BatchedEngine(model, tokenizer, vision_tower, max_batch_size=max_batch_size,
+                                    max_cached_videos=max_cached_videos).start()
+
+        # Create replace token, this will replace the <video> in the prompt.
+        if model.get_model().vision_config.use_vid_start_end:
+            self.replace_token = DEFAULT_VID_START_TOKEN + DEFAULT_VIDEO_PATCH_TOKEN * video_token_len + DEFAULT_VID_END_TOKEN
+        else:
+            self.replace_token = DEFAULT_VIDEO_PATCH_TOKEN * video_token_len
+
+    def upload_video(self, data=None, path=None):
+        """
+        Encodes a video given by its bytes or by a path under video_root, returns its id. Videos that are
+        cached are not decoded again.
+        """
+        if path is not None:
+            path = self.resolve_video_path(path)
+            stat = os.stat(path)
+            file_id = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+            with self.path_keys_lock:
+                video_key = self.path_keys.get(file_id)
+                if video_key is not None:
+                    self.path_keys.move_to_end(file_id)
+            if self.engine.has_video(video_key):
+                return video_key
+            with open(path, "rb") as f:
+                data = f.read()
+        video_key = get_video_key(data)
+        if path is not None:
+            with self.path_keys_lock:
+                self.path_keys[file_id] = video_key
+                self.path_keys.move_to_end(file_id)
+                while len(self.path_keys) > self.max_cached_videos:
+                    self.path_keys.popitem(last=False)
+        if self.engine.has_video(video_key):
+            return video_key
+
+        if path is None:
+            with tempfile.NamedTemporaryFile(suffix=".mp4") as f:
+                f.write(data)
+                f.flush()
+                frames = load_video(f.name)
+        else:
+            frames = load_video(path)
+        if frames is None:
+            raise ValueError("Could not decode the video")
+        pixel_values = self.image_processor.preprocess(frames, return_tensors='pt')['pixel_values']
+        self.engine.add_video(video_key, pixel_values)
+        return video_key
+
+    def resolve_video_path(self, path):
+        """
+        Real path of a video given by path, PermissionError if it is not under video_root. Checked before the
+        file is accessed, so the error does not tell whether the file exists.
+        """
+        if self.video_root is None:
+            raise PermissionError("Videos can not be given by path, upload the video bytes or start the server with --video-root")
+        real_path = os.path.realpath(os.path.join(self.video_root, path))
+        if os.path.commonpath([real_path, self.video_root]) != self.video_root:
+            raise PermissionError(f"Videos can only be given by path under the video root {self.video_root}")
+        return real_path
+
+    def make_request(self, params):
+        prompt = params["prompt"]
+        video_key = None
+        if DEFAULT_VIDEO_TOKEN in prompt:
+            video_key = params.get("video_id")
+            prompt = prompt.replace(DEFAULT_VIDEO_TOKEN, self.replace_token, 1)
+        input_ids = self.tokenizer(prompt).input_ids
+        return GenerationRequest(
+            input_ids, video_key=video_key,
+            temperature=float(params.get("temperature", 0.2)),
+            top_p=float(params.get("top_p", 1.0)),
+            max_new_tokens=min(int(params.get("max_new_tokens", 512)), 1536),
+            stop_str=params.get("stop"))
+
+    def generate_stream(self, params):
+        request = self.make_request(params)
+        if request.video_key is not None and not self.engine.has_video(request.video_key):
+            yield json.dumps({"text": "Unknown video, upload it again", "error_code": WORKER_ERROR_UNKNOWN_VIDEO}).encode() + b"\0"
+            return
+
+        self.engine.submit(request)
+        try:
+            for text in request.iter_text():
+                yield json.dumps({"text": text, "error_code": 0}).encode() + b"\0"
+        except GenerationError as e:
+            logger.error(f"generation failed: {e}")
+            yield json.dumps({"text": server_error_msg, "error_code": WORKER_ERROR_GENERATION}).encode() + b"\0"
+        finally:
+            # also stops the generation when the client disconnected
+            request.cancel()
+
+    def get_status(self):
+        return self.engine.status()
+
+
+app = FastAPI()
+worker = None
+
+
+@app.post("/worker_upload_video")
+async def upload_video(request: Request):
+    if request.headers.get("content-type", "").startswith("application/json"):
+        params = await request.json()
+        kwargs = {"path": params["path"]}
+    else:
+        kwargs = {"data": await request.body()}
+    try:
+        video_id = await run_in_threadpool(worker.upload_video, **kwargs)
+    except (OSError, ValueError, GenerationError) as e:
+        logger.error(f"upload failed: {e}")
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return {"video_id": video_id}
+
+
+@app.post("/worker_generate_stream")
+async def generate_stream(request: Request):
+    params = await request.json()
+    return StreamingResponse(worker.generate_stream(params))
+
+
+@app.post("/worker_get_status")
+async def get_status(request: Request):
+    return worker.get_status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="localhost")
+    parser.add_argument("--port", type=int, default=21002)
+    parser.add_argument("--model-name", type=str, required=True)
+    parser.add_argument("--projection_path", type=str, required=True)
+    parser.add_argument("--max-batch-size", type=int, default=8, help="Maximum number of requests decoded together")
+    parser.add_argument("--max-cached-videos", type=int, default=64, help="Number of encoded videos kept for follow-up questions")
+    parser.add_argument("--video-root", type=str, default=None, help="Folder whose videos clients may give by path, only uploads are accepted otherwise")
+    args = parser.parse_args()
+    logger.info(f"args: {args}")
+
+    os.environ.setdefault("LOCAL_RANK", "0")  # initialize_model picks the GPU from the launcher environment
+    model, vision_tower, tokenizer, image_processor, video_token_len, _ = initialize_model(args.model_name, args.projection_path)
+    worker = ModelWorker(model, vision_tower, tokenizer, image_processor, video_token_len,
+                         max_batch_size=args.max_batch_size, max_cached_videos=args.max_cached_videos,
+                         video_root=args.video_root)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="info")
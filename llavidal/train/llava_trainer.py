@@ -4,6 +4,9 @@ import torch.nn as nn
 from transformers import Trainer
 from typing import Optional
 
+from llavidal.model.multimodal_projector import rename_projector_keys
+from llavidal.train.projector_checkpoint import ProjectorCheckpointWriter, save_projector_weights
+
 
 def unwrap_model(model: nn.Module) -> nn.Module:
     """
@@ -21,30 +24,69 @@ def unwrap_model(model: nn.Module) -> nn.Module:
 
 class LlavidalTrainer(Trainer):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.projector_writer = None  # writes the adapter checkpoints, created with the first one
+        self.checkpoint_metrics = None
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        # the metrics of the evaluation before the checkpoint, if any, for the retention of the adapter checkpoints
+        self.checkpoint_metrics = metrics
+        super()._save_checkpoint(model, trial, metrics=metrics)
+
+    def _checkpoint_metric(self):
+        """
+        Value of metric_for_best_model for the checkpoint being saved: from the evaluation metrics, otherwise
+        from the latest training logs (e.g. "loss").
+        """
+        name = self.args.metric_for_best_model
+        if name is None:
+            return None
+        metrics = self.checkpoint_metrics or {}
+        for key in (name, f"eval_{name}"):
+            if key in metrics:
+                return metrics[key]
+        for log in reversed(self.state.log_history):
+            if name in log:
+                return log[name]
+        return None
+
+    def _adapter_weights(self, state_dict=None):
+        """
+        Projector weights and the rows of the new token embeddings, copied to the CPU. The frozen rest of the
+        embeddings is not saved, initialize_vision_tokenizer and initialize_model load the rows alone.
+        """
+        if state_dict is None:
+            state_dict = dict(unwrap_model(self.model).named_parameters())
+
+        weight_to_save = {k: v for k, v in state_dict.items() if 'mm_projector' in k}
+        # the new token rows train outside of embed_tokens (train_new_token_embeddings)
+        if 'model.new_token_embeddings' in state_dict:
+            weight_to_save['model.embed_tokens.weight'] = state_dict['model.new_token_embeddings']
+        # parameter names have the MultiModalProjector keys
+        rename_projector_keys(weight_to_save, legacy=True)
+        return {k: v.detach().to('cpu', copy=True).contiguous() for k, v in weight_to_save.items()}
+
     def _save(self, output_dir: Optional[str] = None, state_dict=None):
         if getattr(self.args, 'tune_mm_mlp_adapter', False):
-            # Save the model
-            _state_dict = state_dict
-            if _state_dict is None:
-                # Only save the model itself if we are using distributed training
-                model_to_save = unwrap_model(self.model)
-                _state_dict = model_to_save.state_dict()
-
-            weight_to_save = {}
-            keys_to_match = ['mm_projector', 'embed_tokens', 'embed_in'] # as long as mm_projector is in the key, it will be saved
-            for k, v in _state_dict.items():
-                if any(key_match in k for key_match in keys_to_match):
-                    weight_to_save[k] = v
+            weight_to_save = self._adapter_weights(state_dict)
 
             current_folder = output_dir.split('/')[-1]
             parent_folder = os.path.dirname(output_dir)
-           #breakpoint()
             if current_folder.startswith('checkpoint-'):
-                mm_projector_folder = os.path.join(parent_folder, "mm_projector")
-                os.makedirs(mm_projector_folder, exist_ok=True)
-                torch.save(weight_to_save, os.path.join(mm_projector_folder, f'{current_folder}.bin'))
+                # the trainer saves the optimizer state in the checkpoint folder
+                os.makedirs(output_dir, exist_ok=True)
+                # written in the background, the same number of checkpoints is kept as of the trainer checkpoints
+                if self.projector_writer is None:
+                    self.projector_writer = ProjectorCheckpointWriter(
+                        os.path.join(parent_folder, "mm_projector"), keep_last=self.args.save_total_limit,
+                        greater_is_better=bool(self.args.greater_is_better))
+                self.projector_writer.save(weight_to_save, int(current_folder[len('checkpoint-'):]),
+                                           metric=self._checkpoint_metric())
             else:
+                if self.projector_writer is not None:
+                    self.projector_writer.wait()
                 os.makedirs(output_dir, exist_ok=True)
-                torch.save(weight_to_save, os.path.join(output_dir, f'mm_projector.bin'), )
+                save_projector_weights(weight_to_save, os.path.join(output_dir, 'mm_projector.safetensors'))
 
         # super(LLAVIDALTrainer, self)._save(output_dir, state_dict)
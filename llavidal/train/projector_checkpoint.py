@@ -0,0 +1,92 @@
+"""
+Checkpoints of the adapter training (--tune_mm_mlp_adapter): only the projectors and the rows of the new token
+embeddings, as safetensors files written in the background.
+"""
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-(\d+)\.safetensors$")
+
+
+def save_projector_weights(tensors, path, metadata=None):
+    """
+    Writes CPU tensors to a safetensors file, atomically so that an interrupted write never leaves a truncated
+    checkpoint behind.
+    """
+    tmp_path = path + ".tmp"
+    save_file(tensors, tmp_path, metadata=metadata)
+    os.replace(tmp_path, path)
+
+
+class ProjectorCheckpointWriter(object):
+    """
+    Writes the checkpoint-<step>.safetensors files of a folder on a background thread and deletes the ones
+    that are not retained.
+
+    Parameters:
+    folder (str): Folder of the checkpoints, checkpoints already in it count for the retention.
+    keep_last (int): Number of most recent checkpoints kept, None to keep all.
+    greater_is_better (bool): Whether a greater metric is better, the checkpoint with the best metric is kept
+        in addition to the most recent ones.
+    """
+    def __init__(self, folder, keep_last=None, greater_is_better=False):
+        self.folder = folder
+        self.keep_last = keep_last
+        self.greater_is_better = greater_is_better
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="projector_checkpoint")
+        self.pending = None
+        os.makedirs(folder, exist_ok=True)
+
+        self.checkpoints = {}  # step -> metric or None
+        for file_name in os.listdir(folder):
+            match = CHECKPOINT_PATTERN.match(file_name)
+            if match:
+                with safe_open(os.path.join(folder, file_name), framework="pt") as f:
+                    metric = (f.metadata() or {}).get("metric")
+                self.checkpoints[int(match.group(1))] = float(metric) if metric is not None else None
+
+    def save(self, tensors, step, metric=None):
+        """
+        Queues the write of a checkpoint. The tensors must be CPU copies that the caller does not modify anymore.
+        Raises the error of the previous write, if it failed.
+        """
+        self.wait()
+        metadata = {"step": str(step)}
+        if metric is not None:
+            metadata["metric"] = str(metric)
+        self.pending = self.executor.submit(self._write, tensors, step, metric, metadata)
+
+    def wait(self):
+        """
+        Blocks until the queued checkpoint is written.
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def _path(self, step):
+        return os.path.join(self.folder, f"checkpoint-{step}.safetensors")
+
+    def _write(self, tensors, step, metric, metadata):
+        save_projector_weights(tensors, self._path(step), metadata=metadata)
+        self.checkpoints[step] = metric
+        for step in self._steps_to_delete():
+            logging.info(f"Deleting projector checkpoint {self._path(step)} due to the retention policy")
+            os.remove(self._path(step))
+            del self.checkpoints[step]
+
+    def _steps_to_delete(self):
+        if self.keep_last is None or self.keep_last <= 0:
+            return []
+        steps = sorted(self.checkpoints)
+        retained = set(steps[-self.keep_last:])
+        with_metric = [step for step in steps if self.checkpoints[step] is not None]
+        if with_metric:
+            best = (max if self.greater_is_better else min)(with_metric, key=lambda step: self.checkpoints[step])
+            retained.add(best)
+        return [step for step in steps if step not in retained]
@@ -32,7 +32,6 @@ def maybe_zero_3(param, ignore_status=False, name=None):
         param = param.detach().cpu().clone()
     return param
 
-IGNORE_INDEX = -100
 DEFAULT_PAD_TOKEN = "[PAD]"
 DEFAULT_EOS_TOKEN = "</s>"
 DEFAULT_BOS_TOKEN = "</s>"
@@ -46,6 +45,11 @@ class ModelArguments:
     freeze_backbone: bool = field(default=False)
     tune_mm_mlp_adapter: bool = field(default=False)
     pretrain_mm_mlp_adapter: Optional[str] = field(default=None)
+    mm_projector_type: str = field(default="linear", metadata={"help": "'linear' or 'mlp2x_gelu'"})
+    frozen_llm_dtype: Optional[str] = field(
+        default=None,
+        metadata={"help": "With --tune_mm_mlp_adapter, load the frozen LLM in 'bfloat16' or 'float16'. "
+                          "The projectors and the new token embeddings still train in float32."})
     # use_modality_token_prefix: bool = field(default=False)
     use_modality_string_prefix: bool = field(default=False)
     mm_use_vid_start_end: bool = field(default=False)
@@ -88,6 +92,18 @@ class TrainingArguments(transformers.TrainingArguments):
                 "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    gradient_checkpointing_layers: str = field(
+        default="all",
+        metadata={
+            "help":
+                "Decoder layers recomputed in the backward pass with --gradient_checkpointing: 'all', 'every_<k>' "
+                "for every k-th layer or a fraction of the layers, e.g. '0.5'."
+        },
+    )
+    offload_activations: bool = field(
+        default=False,
+        metadata={"help": "Keep the activations saved for the backward pass in CPU memory."},
+    )
 
 
 def safe_save_model_for_hf_trainer(trainer: transformers.Trainer,
@@ -723,10 +739,23 @@ def train():
     import os
     os.environ["PYTORCH_CUDA_ALLOC_CONF"] = "max_split_size_mb:128,garbage_collection_threshold:0.6"
 
+    torch_dtype = None
+    if model_args.frozen_llm_dtype is not None:
+        if not model_args.tune_mm_mlp_adapter:
+            raise ValueError("--frozen_llm_dtype requires --tune_mm_mlp_adapter, otherwise the LLM trains")
+        if model_args.frozen_llm_dtype not in ("bfloat16", "float16"):
+            raise ValueError(f"Unsupported frozen_llm_dtype {model_args.frozen_llm_dtype}, use bfloat16 or float16")
+        torch_dtype = getattr(torch, model_args.frozen_llm_dtype)
+
+    config = LLAVIDALConfig.from_pretrained(model_args.model_name_or_path, cache_dir=training_args.cache_dir)
+    config.mm_projector_type = model_args.mm_projector_type
+
     model = LLAVIDALLlamaForCausalLM.from_pretrained(
         model_args.model_name_or_path,
+        config=config,
         cache_dir=training_args.cache_dir,
         model_args=modality_info,
+        torch_dtype=torch_dtype,
         attn_implementation = "flash_attention_2" 
     )
     total_params = sum(p.numel() for p in model.parameters())
@@ -746,6 +775,9 @@ def train():
     )
     # model.config.attn_implementation = "flash_attention_2"   
     model.config.use_cache = False
+    # the Trainer enables gradient checkpointing with --gradient_checkpointing
+    model.get_model().set_activation_memory(checkpoint_layers=training_args.gradient_checkpointing_layers,
+                                            offload_activations=training_args.offload_activations)
 
     if model_args.freeze_backbone:
         model.model.requires_grad_(False)
@@ -780,6 +812,8 @@ def train():
             if hasattr(model.get_model(), projector_name):
                 projector = getattr(model.get_model(), projector_name)
 
+                # trainable weights stay in float32 on top of a reduced precision LLM (--frozen_llm_dtype)
+                projector.float()
                 for p in projector.parameters():
                     p.requires_grad = True
 
@@ -119,6 +119,23 @@ def violates_moderation(text):
     return flagged
 
 
+def truncate_at_stop_str(text, stop_str):
+    """
+    Splits streamed text at the stop string.
+
+    Returns:
+    tuple: (text that can be shown, whether the stop string was found). A trailing partial match of the stop
+    string is held back, it is shown with the next tokens if they do not complete the stop string.
+    """
+    index = text.find(stop_str)
+    if index != -1:
+        return text[:index], True
+    for i in range(min(len(stop_str) - 1, len(text)), 0, -1):
+        if stop_str.startswith(text[-i:]):
+            return text[:-i], False
+    return text, False
+
+
 def pretty_print_semaphore(semaphore):
     if semaphore is None:
         return "None"
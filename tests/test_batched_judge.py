@@ -0,0 +1,39 @@
+"""
+Batched judge responses must be parsed also when the judge answers with Python literals, and pairs already
+judged one at a time must be taken from the cache instead of being sent again.
+"""
+import json
+
+from llavidal.eval.batched_judge import judge_in_batches, parse_batch_response
+from llavidal.eval.judge_cache import JudgeCache
+
+
+def messages(pred):
+    return [
+        {"role": "system", "content": "You are a judge."},
+        {"role": "user", "content": "Please evaluate the following video-based question-answer pair:\n\n"
+                                    f"Question: q\nCorrect Answer: a\nPredicted Answer: {pred}\n\n"
+                                    "Provide your evaluation only as a score. Please generate the response as a dictionary."},
+    ]
+
+
+def test_parse_python_literals_with_apostrophes():
+    response = "[{'id': '1', 'score': 4, 'reason': \"the model's answer\"}, {'id': '2', 'score': 2}]"
+    assert parse_batch_response(response, 2) == {0: 4, 1: 2}
+    assert parse_batch_response("[{'id': '1', 'score': 4}", 1) == {}
+
+
+def test_single_pair_cache_is_reused(tmp_path):
+    cache = JudgeCache(str(tmp_path / 'cache.sqlite'))
+    cache.put('correctness', 'judge', messages('cached'), "{'score': 3}")
+    requests = []
+
+    def chat(batch_messages):
+        requests.append(batch_messages)
+        return json.dumps([{"id": "1", "score": 5}])
+
+    items = [('cached', messages('cached')), ('new', messages('new'))]
+    scores, _, failed = judge_in_batches(items, chat, batch_size=4, cache=cache, metric='correctness', model='judge')
+
+    assert scores == {'cached': 3, 'new': 5} and failed == []
+    assert len(requests) == 1 and 'Pair id: 2' not in requests[0][1]['content']
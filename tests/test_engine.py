@@ -0,0 +1,85 @@
+"""
+The continuous batching engine must generate what model.generate generates for each request alone, also when
+a request joins a batch that is already decoding (its cache is left padded) and when rows leave the batch (the
+padding columns are trimmed).
+"""
+import torch
+
+from llavidal.model import LLAVIDALConfig, LLAVIDALLlamaForCausalLM
+from llavidal.serve.engine import BatchedEngine, GenerationRequest
+
+
+class Tokenizer(object):
+    pad_token_id = 0
+    eos_token_id = None  # requests run to max_new_tokens
+
+    def decode(self, ids, skip_special_tokens=True):
+        return "".join(chr(97 + i % 26) for i in ids)
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = LLAVIDALConfig(vocab_size=64, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                            num_attention_heads=4, max_position_embeddings=256, mm_hidden_size=16)
+    model = LLAVIDALLlamaForCausalLM(config).eval()
+    with torch.no_grad():
+        # a default initialized tiny model is too flat for a shifted RoPE position to change its greedy tokens
+        for name, param in model.named_parameters():
+            if "norm" not in name:
+                param.mul_(4)
+    return model
+
+
+def reference(model, input_ids, max_new_tokens):
+    with torch.inference_mode():
+        output = model.generate(torch.tensor([input_ids]), do_sample=False, max_new_tokens=max_new_tokens,
+                                pad_token_id=0, eos_token_id=None)
+    return output[0, len(input_ids):].tolist()
+
+
+def run(engine, schedule):
+    """
+    Drives the engine loop by hand: schedule maps a decode step to the requests admitted before it.
+    """
+    step = 0
+    with torch.inference_mode():
+        while engine.running or any(s >= step for s in schedule):
+            if step in schedule:
+                engine._admit(schedule[step])
+            if engine.running:
+                engine._decode_step()
+            step += 1
+
+
+def prompt(length, offset):
+    return [1] + [3 + (offset + i) % 60 for i in range(length - 1)]
+
+
+def test_request_joining_and_leaving_a_decoding_batch():
+    model = make_model()
+    engine = BatchedEngine(model, Tokenizer(), vision_tower=None, max_batch_size=4)
+
+    long = GenerationRequest(prompt(40, 0), temperature=0, max_new_tokens=8)
+    short = GenerationRequest(prompt(8, 17), temperature=0, max_new_tokens=16)
+    late = GenerationRequest(prompt(5, 31), temperature=0, max_new_tokens=6)
+    # short joins the cache of long (left padded by 32 + 3 columns), long then finishes first and the padding
+    # columns of short are trimmed while short and late keep decoding
+    run(engine, {0: [long], 3: [short], 5: [late]})
+
+    for request in (long, short, late):
+        assert request.finish_reason == "length"
+        assert request.generated_ids == reference(model, request.input_ids, request.max_new_tokens)
+    assert engine.running == [] and engine.past_key_values is None
+
+
+def test_partial_stop_string_is_emitted_when_the_request_ends():
+    model = make_model()
+    engine = BatchedEngine(model, Tokenizer(), vision_tower=None, max_batch_size=4)
+    text = Tokenizer().decode(reference(model, prompt(8, 5), 6))
+
+    # the answer ends with the first character of the stop string, which is held back until the request ends
+    request = GenerationRequest(prompt(8, 5), temperature=0, max_new_tokens=6, stop_str=text[-1] + "#")
+    run(engine, {0: [request]})
+
+    assert request.finish_reason == "length"
+    assert request.text == text
@@ -0,0 +1,49 @@
+"""
+The local tiers of the MCQ parser must only answer when the letter is unambiguous, everything else goes to the LLM.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'evaluation', 'ADL-X'))
+import mcq_parsing_llm  # noqa: E402
+
+CHOICES = {'A': 'drinking water', 'B': 'reading a book', 'C': 'walking to the door', 'D': 'eating'}
+
+
+@pytest.mark.parametrize('prediction, expected', [
+    ('(D)', ('D', 'regex')),
+    ('B) reading', ('B', 'regex')),
+    ('The Answer Is (B)', ('B', 'regex')),
+    ('Answer: C', ('C', 'regex')),
+    ('The answer is B, reading a book.', ('B', 'regex')),
+    ('It is option (C).', ('C', 'regex')),
+    ('The person drinks from a cup (A).', ('A', 'regex')),
+    ('A person is reading a book.', ('B', 'string')),
+    ('The person drinks water', ('A', 'fuzzy')),
+    # left to the LLM
+    ('The answer is a person drinking from a cup.', (None, None)),
+    ('The answer is d', (None, None)),
+    ('The answer is A person drinking', (None, None)),
+    ('Unlike (A), the person reads a book.', (None, None)),
+    ('The person reads a book, unlike (A)', (None, None)),
+    ('The person is not drinking water.', (None, None)),
+    ("The person doesn't drink water", (None, None)),
+])
+def test_parse_local(prediction, expected):
+    assert mcq_parsing_llm.MCQParser().parse_local(prediction, CHOICES) == expected
+
+
+def test_agreement_report():
+    choices = '(A) drinking water (B) eating'
+    records = [
+        {'prediction': 'The person is drinking water.', 'question_to_llm': choices, 'parsed_answer_from_llm': 'A', 'parse_tier': 'llm'},
+        {'prediction': 'B) eat', 'question_to_llm': choices, 'parsed_answer_from_llm': 'A', 'parse_tier': 'llm'},
+        {'prediction': 'hmm', 'question_to_llm': choices, 'parsed_answer_from_llm': 'Z', 'parse_tier': 'llm'},
+    ]
+    report = mcq_parsing_llm.agreement_report(records, mcq_parsing_llm.MCQParser())
+    assert report['tiers']['string'] == {'records': 1, 'compared': 1, 'agree': 1, 'agreement': 1.0}
+    assert report['tiers']['regex']['agreement'] == 0.0
+    assert report['tiers']['llm']['records'] == 1
+    assert [d['prediction'] for d in report['disagreements']] == ['B) eat']